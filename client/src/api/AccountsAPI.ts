@@ -29,6 +29,27 @@ interface ApiResponse<T = unknown> {
   data?: T;
 }
 
+interface Bootstrap {
+  user: {
+    id: string;
+    username: string;
+    email: string;
+    role: string;
+    two_factor_enabled: boolean;
+  };
+  vm: {
+    id: number;
+    websocket_port: number;
+    name: string;
+    version: string;
+    desktop: string;
+    vnc_password: string;
+  } | null;
+  vm_count: number;
+  max_vm_count: number;
+  catalog_version: string;
+}
+
 /**
  * Log in to the application
  * @param {string} username - The username of the user
@@ -271,6 +292,42 @@ export async function getUserDetails(): Promise<ApiResponse> {
   }
 }
 
+/**
+ * Get everything the home screen needs in one request: the user, their virtual machine, the virtual machine count
+ * and the version of the ISO catalog
+ * @returns {Promise<ApiResponse>} - The response from the server
+ */
+export async function getBootstrap(): Promise<ApiResponse<Bootstrap>> {
+  try {
+    const response: AxiosResponse = await axios.get(
+      `${API_URL}/api/user/bootstrap/`,
+      {
+        withCredentials: true,
+        headers: {
+          "X-CSRF-TOKEN": cookies.get("csrf_access_token"),
+        },
+      }
+    );
+    return {
+      status: response.status,
+      message: response.data.message,
+      data: response.data,
+    };
+  } catch (error: unknown) {
+    if (error instanceof AxiosError) {
+      return {
+        status: error.response?.status || 500,
+        message: error.response?.data.message || "Internal Server Error",
+      };
+    } else {
+      return {
+        status: 500,
+        message: "Internal Server Error",
+      };
+    }
+  }
+}
+
 /**
  * Change the username of the currently logged in user
  * @param {string} username - The new username
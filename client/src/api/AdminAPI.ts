@@ -33,15 +33,28 @@ interface ApiResponse<T = unknown> {
   data?: T;
 }
 
+interface Page<T = unknown> {
+  items: T[];
+  next_cursor: string | null;
+}
+
+// Rows fetched per page of the admin listings
+const PAGE_SIZE = 50;
+
 /**
- * Get a list of all virtual machines
+ * Get one page of an admin listing
+ * @param {string} path - The path of the listing
+ * @param {string} cursor - The next_cursor of the previous page, or undefined for the first page
  * @returns {Promise<ApiResponse>} - The response from the server
  */
-export async function getAllVMs(): Promise<ApiResponse> {
+async function getPage(
+  path: string,
+  cursor?: string
+): Promise<ApiResponse<Page>> {
   try {
-    const response: AxiosResponse = await axios.get(
-      `${API_URL}/api/admin/vm/all/`
-    );
+    const response: AxiosResponse = await axios.get(`${API_URL}${path}`, {
+      params: cursor ? { limit: PAGE_SIZE, cursor } : { limit: PAGE_SIZE },
+    });
     return {
       status: response.status,
       message: response.data.message,
@@ -63,32 +76,21 @@ export async function getAllVMs(): Promise<ApiResponse> {
 }
 
 /**
- * Get a list of all users
+ * Get a page of virtual machines
+ * @param {string} cursor - The next_cursor of the previous page, or undefined for the first page
  * @returns {Promise<ApiResponse>} - The response from the server
  */
-export async function getAllUsers(): Promise<ApiResponse> {
-  try {
-    const response: AxiosResponse = await axios.get(
-      `${API_URL}/api/admin/user/all/`
-    );
-    return {
-      status: response.status,
-      message: response.data.message,
-      data: response.data,
-    };
-  } catch (error: unknown) {
-    if (error instanceof AxiosError) {
-      return {
-        status: error.response?.status || 500,
-        message: error.response?.data.message || "Internal Server Error",
-      };
-    } else {
-      return {
-        status: 500,
-        message: "Internal Server Error",
-      };
-    }
-  }
+export async function getAllVMs(cursor?: string): Promise<ApiResponse<Page>> {
+  return getPage("/api/admin/vm/all/", cursor);
+}
+
+/**
+ * Get a page of users
+ * @param {string} cursor - The next_cursor of the previous page, or undefined for the first page
+ * @returns {Promise<ApiResponse>} - The response from the server
+ */
+export async function getAllUsers(cursor?: string): Promise<ApiResponse<Page>> {
+  return getPage("/api/admin/user/all/", cursor);
 }
 
 /**
@@ -333,61 +335,21 @@ export async function unbanUser(user_id: string): Promise<ApiResponse> {
 }
 
 /**
- * Get a list of all banned users
+ * Get a page of banned users
+ * @param {string} cursor - The next_cursor of the previous page, or undefined for the first page
  * @returns {Promise<ApiResponse>} - The response from the server
  */
-export async function getBannedUsers(): Promise<ApiResponse> {
-  try {
-    const response: AxiosResponse = await axios.get(
-      `${API_URL}/api/admin/user/banned/`
-    );
-    return {
-      status: response.status,
-      message: response.data.message,
-      data: response.data,
-    };
-  } catch (error: unknown) {
-    if (error instanceof AxiosError) {
-      return {
-        status: error.response?.status || 500,
-        message: error.response?.data.message || "Internal Server Error",
-      };
-    } else {
-      return {
-        status: 500,
-        message: "Internal Server Error",
-      };
-    }
-  }
+export async function getBannedUsers(cursor?: string): Promise<ApiResponse<Page>> {
+  return getPage("/api/admin/user/banned/", cursor);
 }
 
 /**
- * Get a list of all unverified users
+ * Get a page of unverified users
+ * @param {string} cursor - The next_cursor of the previous page, or undefined for the first page
  * @returns {Promise<ApiResponse>} - The response from the server
  */
-export async function getUnverifiedUsers(): Promise<ApiResponse> {
-  try {
-    const response: AxiosResponse = await axios.get(
-      `${API_URL}/api/admin/user/unverified/`
-    );
-    return {
-      status: response.status,
-      message: response.data.message,
-      data: response.data,
-    };
-  } catch (error: unknown) {
-    if (error instanceof AxiosError) {
-      return {
-        status: error.response?.status || 500,
-        message: error.response?.data.message || "Internal Server Error",
-      };
-    } else {
-      return {
-        status: 500,
-        message: "Internal Server Error",
-      };
-    }
-  }
+export async function getUnverifiedUsers(cursor?: string): Promise<ApiResponse<Page>> {
+  return getPage("/api/admin/user/unverified/", cursor);
 }
 
 /**
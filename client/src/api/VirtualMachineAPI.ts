@@ -229,3 +229,51 @@ export async function getRunningVMs(): Promise<ApiResponse<VmCount>> {
     }
   }
 }
+
+interface VmCapacity {
+  vm_count: number;
+  max_vm_count: number;
+  available: number;
+}
+
+interface VmState {
+  id: number;
+  websocket_port: number;
+  name: string;
+  version: string;
+  desktop: string;
+  vnc_password: string;
+}
+
+/**
+ * Follow the virtual machine count and the current user's virtual machine.
+ * The server sends both on connecting and again whenever they change. It closes the stream every few minutes, after
+ * which the browser reconnects on its own. If the server refuses the stream, i.e. because the worker is busy, the
+ * browser gives up and onClosed is called.
+ * @param {function} onCapacity - Called with the virtual machine count
+ * @param {function} onVm - Called with the user's virtual machine, or null if they have none
+ * @param {function} [onClosed] - Called if the stream closes for good
+ * @returns {EventSource} - The stream, to close when it is no longer needed
+ */
+export function subscribeToVirtualMachineEvents(
+  onCapacity: (capacity: VmCapacity) => void,
+  onVm: (vm: VmState | null) => void,
+  onClosed?: () => void
+): EventSource {
+  const events = new EventSource(`${API_URL}/api/vm/events/`, {
+    withCredentials: true,
+  });
+  events.addEventListener("capacity", (event) => {
+    onCapacity(JSON.parse((event as MessageEvent).data));
+  });
+  events.addEventListener("vm", (event) => {
+    onVm(JSON.parse((event as MessageEvent).data));
+  });
+  events.onerror = () => {
+    // The browser retries after the server ends a stream, but not after it answers with an error
+    if (events.readyState === EventSource.CLOSED) {
+      onClosed?.();
+    }
+  };
+  return events;
+}
@@ -122,45 +122,89 @@ const AdminPanelScreen: FC = (): ReactElement => {
   const [showDeleteUnverifiedModal, setShowDeleteUnverifiedModal] =
     useState(false);
   const [deleteUnverifiedMessage, setDeleteUnverifiedMessage] = useState("");
+  const [usersCursor, setUsersCursor] = useState<string | null>(null);
+  const [vmsCursor, setVMsCursor] = useState<string | null>(null);
+  const [bannedCursor, setBannedCursor] = useState<string | null>(null);
+  const [unverifiedCursor, setUnverifiedCursor] = useState<string | null>(null);
   const navigate = useNavigate();
 
   useEffect(() => {
     document.title = "Buffet - Admin";
   }, []);
 
-  // Get all users, VMs, banned users, unverified users, and logs
-  useEffect(() => {
-    // Get all users
-    getAllUsers()
-      .then((response) => {
-        if (response.status === 200) {
-          setUsers(response.data as User[]);
+  // Get a page of users, added to those already loaded if continuing from a cursor
+  const loadUsers = (cursor?: string) => {
+    getAllUsers(cursor).then((response) => {
+      if (response.status === 200 && response.data) {
+        const page = response.data;
+        setUsers((loaded) =>
+          (cursor ? loaded : []).concat(page.items as User[])
+        );
+        setUsersCursor(page.next_cursor);
+      }
+    });
+  };
+
+  // Get a page of VMs
+  const loadVMs = (cursor?: string) => {
+    getAllVMs(cursor).then((response) => {
+      if (response.status === 200 && response.data) {
+        const page = response.data;
+        setVMs((loaded) =>
+          (cursor ? loaded : []).concat(page.items as VM[])
+        );
+        setVMsCursor(page.next_cursor);
+        if (!cursor && page.items.length === 0) {
+          setVMMessage("No virtual machines");
         }
-      })
-    // Get all VMs
-    getAllVMs().then((response) => {
-      if (response.status === 200) {
-        setVMs(response.data as VM[]);
       } else {
         setVMMessage(response.message);
       }
     });
-    // Get all banned users
-    getBannedUsers().then((response) => {
-      if (response.status === 200) {
-        setBannedUsers(response.data as BannedUser[]);
+  };
+
+  // Get a page of banned users
+  const loadBannedUsers = (cursor?: string) => {
+    getBannedUsers(cursor).then((response) => {
+      if (response.status === 200 && response.data) {
+        const page = response.data;
+        setBannedUsers((loaded) =>
+          (cursor ? loaded : []).concat(page.items as BannedUser[])
+        );
+        setBannedCursor(page.next_cursor);
+        if (!cursor && page.items.length === 0) {
+          setBannedMessage("No banned users");
+        }
       } else {
         setBannedMessage(response.message);
       }
     });
-    // Get all unverified users
-    getUnverifiedUsers().then((response) => {
-      if (response.status === 200) {
-        setUnverifiedUsers(response.data as UnverifiedUser[]);
+  };
+
+  // Get a page of unverified users
+  const loadUnverifiedUsers = (cursor?: string) => {
+    getUnverifiedUsers(cursor).then((response) => {
+      if (response.status === 200 && response.data) {
+        const page = response.data;
+        setUnverifiedUsers((loaded) =>
+          (cursor ? loaded : []).concat(page.items as UnverifiedUser[])
+        );
+        setUnverifiedCursor(page.next_cursor);
+        if (!cursor && page.items.length === 0) {
+          setUnverifiedMessage("No unverified users");
+        }
       } else {
         setUnverifiedMessage(response.message);
       }
     });
+  };
+
+  // Get the first page of users, VMs, banned users and unverified users. Later pages are loaded on request.
+  useEffect(() => {
+    loadUsers();
+    loadVMs();
+    loadBannedUsers();
+    loadUnverifiedUsers();
   }, []);
 
   // Check if the user is banned
@@ -497,6 +541,15 @@ const AdminPanelScreen: FC = (): ReactElement => {
                   </Col>
                 ))}
               </Row>
+              {usersCursor && (
+                <Button
+                  variant="secondary"
+                  className="mb-3"
+                  onClick={() => loadUsers(usersCursor)}
+                >
+                  Load more
+                </Button>
+              )}
             </Container>
           </Tab>
           <Tab eventKey="vms" title="VMs">
@@ -555,6 +608,15 @@ const AdminPanelScreen: FC = (): ReactElement => {
                   </Col>
                 ))}
               </Row>
+              {vmsCursor && (
+                <Button
+                  variant="secondary"
+                  className="mb-3"
+                  onClick={() => loadVMs(vmsCursor)}
+                >
+                  Load more
+                </Button>
+              )}
             </Container>
           </Tab>
           <Tab eventKey="banned" title="Banned Users">
@@ -648,6 +710,15 @@ const AdminPanelScreen: FC = (): ReactElement => {
                   </Col>
                 ))}
               </Row>
+              {bannedCursor && (
+                <Button
+                  variant="secondary"
+                  className="mb-3"
+                  onClick={() => loadBannedUsers(bannedCursor)}
+                >
+                  Load more
+                </Button>
+              )}
             </Container>
           </Tab>
           <Tab eventKey="unverified" title="Unverified Users">
@@ -734,6 +805,15 @@ const AdminPanelScreen: FC = (): ReactElement => {
                   </Col>
                 ))}
               </Row>
+              {unverifiedCursor && (
+                <Button
+                  variant="secondary"
+                  className="mb-3"
+                  onClick={() => loadUnverifiedUsers(unverifiedCursor)}
+                >
+                  Load more
+                </Button>
+              )}
             </Container>
           </Tab>
         </Tabs>
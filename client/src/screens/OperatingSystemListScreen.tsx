@@ -42,12 +42,12 @@ import { useNavigate } from "react-router-dom";
 
 import RFB from "@novnc/novnc/lib/rfb";
 
+import { getBootstrap } from "../api/AccountsAPI";
 import {
   createVirtualMachine,
   deleteVirtualMachine,
   getIsoFiles,
-  getRunningVMs,
-  getVirtualMachineByUser,
+  subscribeToVirtualMachineEvents,
 } from "../api/VirtualMachineAPI";
 import Footer from "../components/FooterComponent";
 import NavbarComponent from "../components/NavbarComponent";
@@ -67,6 +67,15 @@ interface Image {
   arch: string;
 }
 
+interface VmState {
+  id: number;
+  websocket_port: number;
+  name: string;
+  version: string;
+  desktop: string;
+  vnc_password: string;
+}
+
 interface VmDetails {
   wsport: number;
   id: number;
@@ -106,68 +115,88 @@ const OperatingSystemListScreen: FC = (): ReactNode => {
     /(^\w+:|^)\/\//,
     ""
   );
-  const MAX_VM_COUNT = parseInt(import.meta.env.VITE_MAX_VM_COUNT, 10);
+  const [maxVMCount, setMaxVMCount] = useState(
+    parseInt(import.meta.env.VITE_MAX_VM_COUNT, 10)
+  );
   const navigate = useNavigate();
 
   useEffect(() => {
     document.title = "Buffet";
+    let events: EventSource | null = null;
 
     if (user) {
       setUsername(user.username);
 
-      const cachedImages = sessionStorage.getItem("images");
-      const cachedNonLinuxImages = sessionStorage.getItem("nonLinuxImages");
-
-      if (cachedImages && cachedNonLinuxImages) {
-        setImages(JSON.parse(cachedImages));
-        setNonLinuxImages(JSON.parse(cachedNonLinuxImages));
-      } else {
-        const getImages = async () => {
-          const response = await getIsoFiles();
-          if (response.status === 200) {
-            const linuxImages: Image[] = [];
-            const nonLinuxImages: Image[] = [];
-            (response.data as Image[]).forEach((image: Image) => {
-              if (image.linux) {
-                linuxImages.push(image);
-              } else {
-                nonLinuxImages.push(image);
-              }
-            });
-            setImages(linuxImages);
-            setNonLinuxImages(nonLinuxImages);
-            sessionStorage.setItem("images", JSON.stringify(linuxImages));
-            sessionStorage.setItem("nonLinuxImages", JSON.stringify(nonLinuxImages));
-          }
-        };
-        getImages();
-      }
-
-      const getVMCount = async () => {
-        const response = await getRunningVMs();
-        if (response.status === 200 && response.data) {
-          setVMCount(response.data.vm_count);
+      const getImages = async (catalogVersion: string) => {
+        const response = await getIsoFiles();
+        if (response.status === 200) {
+          const linuxImages: Image[] = [];
+          const nonLinuxImages: Image[] = [];
+          (response.data as Image[]).forEach((image: Image) => {
+            if (image.linux) {
+              linuxImages.push(image);
+            } else {
+              nonLinuxImages.push(image);
+            }
+          });
+          setImages(linuxImages);
+          setNonLinuxImages(nonLinuxImages);
+          sessionStorage.setItem("images", JSON.stringify(linuxImages));
+          sessionStorage.setItem("nonLinuxImages", JSON.stringify(nonLinuxImages));
+          sessionStorage.setItem("catalogVersion", catalogVersion);
         }
       };
 
-      const fetchVMDetails = async () => {
-        const response = await getVirtualMachineByUser();
+      const showVM = (vm: VmState | null) => {
+        setVmDetails({
+          wsport: vm ? vm.websocket_port : 0,
+          id: vm ? vm.id : 0,
+          name: vm ? vm.name : "",
+          version: vm ? vm.version : "",
+          desktop: vm ? vm.desktop : "",
+          password: vm ? vm.vnc_password : "",
+        });
+      };
+
+      // Get the user's virtual machine, the count and the catalog version in one request, and only fetch the
+      // catalog if the cached one is out of date
+      getBootstrap().then((response) => {
         const data = response.data;
-        if (data) {
-          setVmDetails({
-            wsport: data.wsport,
-            id: data.id,
-            name: data.name,
-            version: data.version,
-            desktop: data.desktop,
-            password: data.vnc_password,
-          });
+        if (response.status !== 200 || !data) {
+          return;
         }
-      };
+        setVMCount(data.vm_count);
+        setMaxVMCount(data.max_vm_count);
+        showVM(data.vm);
 
-      getVMCount();
-      fetchVMDetails();
+        const cachedImages = sessionStorage.getItem("images");
+        const cachedNonLinuxImages = sessionStorage.getItem("nonLinuxImages");
+        if (
+          cachedImages &&
+          cachedNonLinuxImages &&
+          sessionStorage.getItem("catalogVersion") === data.catalog_version
+        ) {
+          setImages(JSON.parse(cachedImages));
+          setNonLinuxImages(JSON.parse(cachedNonLinuxImages));
+        } else {
+          getImages(data.catalog_version);
+        }
+      });
+
+      // Then follow changes to the count and the user's virtual machine. If the server refuses the stream, the
+      // state from the bootstrap request is shown until the page is reloaded.
+      events = subscribeToVirtualMachineEvents(
+        (capacity) => {
+          setVMCount(capacity.vm_count);
+          setMaxVMCount(capacity.max_vm_count);
+        },
+        showVM
+      );
     }
+
+    return () => {
+      events?.close();
+    };
   }, [user]);
 
   const createVMButton = (iso: string) => {
@@ -272,7 +301,7 @@ const OperatingSystemListScreen: FC = (): ReactNode => {
               <p>
                 There {vmCount === 1 ? "is" : "are"} currently {vmCount} virtual {vmCount === 1 ? "machine" : "machines"} running. The
                 maximum number of virtual machines that can be run at once is{" "}
-                {MAX_VM_COUNT}.
+                {maxVMCount}.
               </p>
               {vmCount === 0 ? (
                 <ProgressBar
@@ -281,25 +310,25 @@ const OperatingSystemListScreen: FC = (): ReactNode => {
                   label
                   variant="success"
                   now={vmCount}
-                  max={MAX_VM_COUNT}
+                  max={maxVMCount}
                 />
-              ) : vmCount < MAX_VM_COUNT ? (
+              ) : vmCount < maxVMCount ? (
                 <ProgressBar
                   striped
                   animated
                   label
                   variant="info"
                   now={vmCount}
-                  max={MAX_VM_COUNT}
+                  max={maxVMCount}
                 />
-              ) : vmCount === MAX_VM_COUNT ? (
+              ) : vmCount === maxVMCount ? (
                 <ProgressBar
                   striped
                   animated
                   label
                   variant="danger"
                   now={vmCount}
-                  max={MAX_VM_COUNT}
+                  max={maxVMCount}
                 />
               ) : (
                 <ProgressBar
@@ -308,7 +337,7 @@ const OperatingSystemListScreen: FC = (): ReactNode => {
                   label
                   variant="warning"
                   now={vmCount}
-                  max={MAX_VM_COUNT}
+                  max={maxVMCount}
                 />
               )}
             </Alert>
@@ -17,60 +17,88 @@ import atexit
 import os
 import subprocess
 
-from config import ApplicationConfig, override_config_with_db
+from auth import is_token_revoked, revoked_token_response
+from cleanup_jobs import CLEANUP_JOBS
+from config import ApplicationConfig
+from db_pool import init_pool_stats
 from flask import Flask
-from flask_bcrypt import Bcrypt
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager
-from flask_limiter import Limiter
-from flask_mail import Mail
 from flask_migrate import Migrate
-from flask_ldap3_login import LDAP3LoginManager
-from models import VirtualMachines, Users, db
+from gevent_support import is_gevent_patched, patch_psycopg
+from json_provider import FastJSONProvider
+from mail_queue import init_mail_queue
+from models import VirtualMachines, Users, db, init_read_replicas
+from passwords import PasswordHasherBusy, busy_response, hash_password
+from query_log import init_query_log
+from rate_limits import limiter, rate_limit, request_cost
 from routes.admin_endpoints import admin_endpoints
 from routes.user_endpoints import user_endpoints
 from routes.vm_endpoints import vm_endpoints
 from routes.config_endpoints import config_endpoints
+from scheduler import init_scheduler
+from settings import load_settings
+from settings_sync import init_settings_sync
+from tracing import init_tracing
+from vm_logs import LOG_JOBS
 from werkzeug.middleware.proxy_fix import ProxyFix
-from flask_bcrypt import generate_password_hash
+
+# Under gunicorn's gevent worker, let other greenlets run while psycopg2 waits on PostgreSQL
+if is_gevent_patched():
+    patch_psycopg()
 
 # Create Flask app
 app = Flask(__name__)  # __name__ is the name of the current Python module
 app.config.from_object(ApplicationConfig)  # Load config from config.py
+app.json = FastJSONProvider(app)  # Encode responses with orjson if it is installed
 CORS(app, supports_credentials=True)  # Enable CORS for all routes
-Bcrypt = Bcrypt(app)  # Initialize Bcrypt for password hashing
 jwt = JWTManager(app)  # Initialize JWT for authentication
+jwt.token_in_blocklist_loader(is_token_revoked)  # Reject tokens issued before a role change, ban or deletion
+jwt.revoked_token_loader(revoked_token_response)
+app.register_error_handler(PasswordHasherBusy, busy_response)  # Passwords are hashed in a bounded process pool
 db.init_app(app)  # Initialize database connection
-mail = Mail(app)  # Initialize Mail for sending emails
+init_read_replicas(app, ApplicationConfig.DB_REPLICA_STICKY_SECONDS)  # Serve read-only endpoints from DB_REPLICA_URIS
 migrate = Migrate(app, db)  # Initialize Migrate for database migrations
-limiter = Limiter(app)
+limiter.init_app(app)  # Counters are shared between workers when RATE_LIMIT_STORAGE_URI points at Redis
+init_tracing(app)  # Record TRACE_SAMPLE_RATE of requests, with their SQL statements, as spans
+init_query_log(app)  # Log slow queries, and count queries per request against each endpoint's budget
+init_settings_sync(app, ApplicationConfig.SETTINGS_POLL_INTERVAL, ApplicationConfig.SETTINGS_CHANNEL_URL)  # Apply settings changed in other workers
 
-# If LDAP is enabled, initialize LDAP3LoginManager
+# If LDAP is enabled, initialize LDAP3LoginManager. QMP, 2FA QR codes and the password policy are imported on first use.
 if ApplicationConfig.LDAP_ENABLED:
-    ldap_manager = LDAP3LoginManager(app)
+    from ldap_auth import PooledLDAP3LoginManager
+
+    ldap_manager = PooledLDAP3LoginManager(app)
     app.ldap3_login_manager = ldap_manager
 
-# Rate limiting
-limiter.limit(ApplicationConfig.RATE_LIMIT)(user_endpoints)
-limiter.limit(ApplicationConfig.RATE_LIMIT)(vm_endpoints)
-limiter.limit(ApplicationConfig.RATE_LIMIT)(admin_endpoints)
-limiter.limit(ApplicationConfig.RATE_LIMIT)(config_endpoints)
+# Rate limiting, keyed by user id when logged in. Logins, registrations and VM creations cost more than other requests
+# The limit is read on each request, so a RATE_LIMIT changed through /api/config/ applies without a restart
+limiter.limit(rate_limit, cost=request_cost)(user_endpoints)
+limiter.limit(rate_limit, cost=request_cost)(vm_endpoints)
+limiter.limit(rate_limit, cost=request_cost)(admin_endpoints)
+limiter.limit(rate_limit, cost=request_cost)(config_endpoints)
 
 # Create database tables if they don't exist
 with app.app_context():
+    init_pool_stats(db.engine)  # Count connections opened and thrown away, alongside the pool's checkout waits
     db.create_all()
 
-    override_config_with_db(app=app)  # Override config with values from the database
+    load_settings()  # Override the .env file with the settings admins changed in the database
 
     # Create default user in user table called 'admin' with password 'admin' and email 'admin@admin.com'
     # This is for testing purposes only and should be removed in production
-    if not Users.query.filter_by(username="admin").first():
-        hashed_password = generate_password_hash("admin").decode("utf-8")
+    # Only the id is selected, so this still works on a database that is waiting for "flask db upgrade"
+    if not db.session.query(Users.id).filter_by(username="admin").first():
+        hashed_password = hash_password("admin")
         admin = Users(username="admin", email="admin@admin.com", password=hashed_password[:80], role="admin")
 
         db.session.add(admin)
         db.session.commit()
 
+init_mail_queue(app)  # Send email queued by the endpoints, and any left over from before a restart
+if ApplicationConfig.SCHEDULER_ENABLED:
+    init_scheduler(app, CLEANUP_JOBS + LOG_JOBS)  # Delete expired registrations and stopped virtual machines, and compress and expire captures
+
 # Register blueprints
 app.register_blueprint(user_endpoints)
 app.register_blueprint(vm_endpoints)
@@ -0,0 +1,200 @@
+# auth.py - Contains the JWT claims, token revocation and authorization decorators for the server.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from config import ApplicationConfig
+from flask import jsonify
+from flask_jwt_extended import create_access_token, get_jwt, jwt_required
+from models import Users, db
+
+
+class TokenVersionCache:
+    """Caches the current token version of recently seen users, so a token can be checked without loading the user on every request.
+    Entries expire after a few seconds, which bounds how long other workers keep accepting a revoked token.
+    """
+
+    def __init__(self, ttl, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._versions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """Get the token version of a user, loading it from the database if it is not cached
+
+        Args:
+            user_id (str): The id of the user
+
+        Returns:
+            int: The token version, or None if the user no longer exists
+        """
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._versions.get(user_id)
+            if entry and entry[1] > now:
+                self._versions.move_to_end(user_id)
+                return entry[0]
+
+        version = db.session.query(Users.token_version).filter_by(id=user_id).scalar()
+
+        with self._lock:
+            self._versions[user_id] = (version, now + self.ttl)
+            self._versions.move_to_end(user_id)
+            while len(self._versions) > self.max_size:
+                self._versions.popitem(last=False)
+        return version
+
+    def set(self, user_id, version):
+        """Cache a new token version for a user
+
+        Args:
+            user_id (str): The id of the user
+            version (int): The new token version, or None if the user is being removed
+        """
+
+        with self._lock:
+            self._versions[user_id] = (version, time.monotonic() + self.ttl)
+            self._versions.move_to_end(user_id)
+
+    def forget(self, user_id):
+        """Drop the cached token version of a user, so it is read from the database next time
+
+        Args:
+            user_id (str): The id of the user
+        """
+
+        with self._lock:
+            self._versions.pop(user_id, None)
+
+
+token_versions = TokenVersionCache(ApplicationConfig.JWT_REVOCATION_CACHE_TTL)
+
+
+def create_user_token(user):
+    """Create an access token carrying the user's role and token version
+
+    Args:
+        user (Users): The user to create the token for
+
+    Returns:
+        str: The access token
+    """
+
+    return create_access_token(identity=user.id, additional_claims={"role": user.role, "ver": user.token_version})
+
+
+def refresh_user_token(claims):
+    """Create a new access token with the same identity, role and token version as an existing one
+
+    Args:
+        claims (dict): The claims of the existing token
+
+    Returns:
+        str: The access token
+    """
+
+    return create_access_token(identity=claims["sub"], additional_claims={"role": claims.get("role"), "ver": claims.get("ver")})
+
+
+def revoke_user_tokens(user, removed=False):
+    """Revoke every token issued to a user by bumping their token version. The caller commits the session.
+
+    Args:
+        user (Users): The user whose tokens should be revoked
+        removed (bool): If the user is being banned or deleted, in which case no token is accepted for them
+    """
+
+    user.token_version = (user.token_version or 0) + 1
+    token_versions.set(user.id, None if removed else user.token_version)
+
+
+def forget_token_versions(user_ids, removed=False):
+    """Update the cached token versions of users changed by a bulk statement. Call this after committing.
+
+    Args:
+        user_ids (list): The ids of the users
+        removed (bool): If the users were banned or deleted, in which case no token is accepted for them
+    """
+
+    for user_id in user_ids:
+        if removed:
+            token_versions.set(user_id, None)
+        else:
+            token_versions.forget(user_id)
+
+
+def is_token_revoked(jwt_header, jwt_payload):
+    """Check if a token was issued before the user's role changed, or to a user who was banned or deleted
+
+    Args:
+        jwt_header (dict): The header of the token
+        jwt_payload (dict): The claims of the token
+
+    Returns:
+        bool: If the token is revoked
+    """
+
+    if "ver" not in jwt_payload:
+        return True
+    return token_versions.get(jwt_payload["sub"]) != jwt_payload["ver"]
+
+
+def revoked_token_response(jwt_header, jwt_payload):
+    """Respond to a request made with a revoked token
+
+    Returns:
+        json: Message
+    """
+
+    return jsonify({"message": "Invalid user"}), 401
+
+
+def role_required(*roles):
+    """Require a valid token whose role claim is one of the given roles, without loading the user
+
+    Args:
+        roles (str): The roles allowed to use the endpoint
+
+    Returns:
+        function: The decorator
+    """
+
+    def wrapper(fn):
+        @wraps(fn)
+        @jwt_required()
+        def decorator(*args, **kwargs):
+            if get_jwt().get("role") not in roles:
+                return jsonify({"message": "Insufficient permissions"}), 403
+            return fn(*args, **kwargs)
+
+        return decorator
+
+    return wrapper
+
+
+def admin_required():
+    """Require a valid token belonging to an admin
+
+    Returns:
+        function: The decorator
+    """
+
+    return role_required("admin")
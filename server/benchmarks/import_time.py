@@ -0,0 +1,71 @@
+# import_time.py - Compares how long a worker takes to import the app with the optional dependencies loaded lazily or up front.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Run from the server directory, with the .env file in place:
+
+    python benchmarks/import_time.py [runs]
+
+"Eager" imports the modules the app used to import at start up before the app itself, as every worker did before
+they were loaded on first use. Each run is a fresh interpreter using python -X importtime, and the medians are printed.
+"""
+
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+# The modules that are now imported on first use: 2FA QR codes, LDAP, QMP, the password policy and Flask-Mail
+LAZY_MODULES = ["qrcode", "qrcode.image.pure", "qrcode.image.svg", "flask_ldap3_login", "qemu.qmp", "password_strength", "flask_mail"]
+IMPORT_TIME = re.compile(r"^import time:\s+\d+ \|\s+(\d+) \|(\s*)(\S+)$")
+
+# Print the peak memory of the interpreter once the app is loaded, so it is measured in the same process
+REPORT_RSS = "import resource; print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)"
+
+
+def measure(preload):
+    """Import the app in a fresh interpreter
+
+    Args:
+        preload (list): The modules to import before the app
+
+    Returns:
+        tuple: The cumulative import time in milliseconds and the peak resident memory in megabytes
+    """
+
+    code = "".join(f"import {module}; " for module in preload) + "import app; " + REPORT_RSS
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, check=True)
+
+    # Only top level imports are added up, their cumulative time already includes what they imported
+    total = 0
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME.match(line)
+        if match and len(match.group(2)) == 1:
+            total += int(match.group(1))
+    return total / 1000, int(result.stdout.split()[-1]) / 1024
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    print(f"{'':<6} {'import ms':>10} {'peak RSS MB':>12}")
+    for name, preload in (("eager", LAZY_MODULES), ("lazy", [])):
+        samples = [measure(preload) for _ in range(runs)]
+        print(f"{name:<6} {statistics.median(s[0] for s in samples):>10.1f} {statistics.median(s[1] for s in samples):>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+# json_encoding.py - Compares how long responses take to encode with the json module and with orjson.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Run from the server directory:
+
+    python benchmarks/json_encoding.py [runs]
+
+Encodes the same responses as jsonify does with Flask's default provider and with FastJSONProvider: a list of admin
+user rows, a catalog of ISOs with their logos embedded, and the NDJSON export of the user rows. The median of each is
+printed in milliseconds.
+"""
+
+import base64
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+from flask import Flask, jsonify
+from flask.json.provider import DefaultJSONProvider
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from json_provider import FastJSONProvider, encode_default, orjson  # noqa: E402
+
+USERS = 10000
+ISOS = 50
+LOGO_SIZE = 16 * 1024  # Bytes in each logo before it is base64 encoded
+
+
+def make_users():
+    """Build admin user rows like serialize_user returns
+
+    Returns:
+        list: The rows
+    """
+
+    start = datetime(2024, 1, 1)
+    return [
+        {
+            "id": f"{i:032x}",
+            "username": f"user{i}",
+            "email": f"user{i}@example.com",
+            "role": "user",
+            "login_time": start + timedelta(minutes=i),
+            "ip": f"10.0.{i // 256 % 256}.{i % 256}",
+        }
+        for i in range(USERS)
+    ]
+
+
+def make_catalog():
+    """Build a catalog like get_catalog returns, with each logo embedded
+
+    Returns:
+        dict: The catalog
+    """
+
+    logo = base64.b64encode(os.urandom(LOGO_SIZE)).decode("utf-8")
+    return {
+        "isos": [{"iso": f"distro-{i}.iso", "name": f"Distro {i}", "version": "1.0", "desktop": "GNOME", "logo": logo} for i in range(ISOS)],
+        "version": "0" * 64,
+    }
+
+
+def make_app(provider):
+    """Create an app using a JSON provider
+
+    Args:
+        provider (class): The JSON provider class
+
+    Returns:
+        Flask: The app
+    """
+
+    app = Flask(__name__)
+    app.json = provider(app)
+    return app
+
+
+def median_ms(fn, runs):
+    """Time a function
+
+    Returns:
+        float: The median time in milliseconds
+    """
+
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    if orjson is None:
+        sys.exit("orjson is not installed, so both providers would use the json module")
+
+    users, catalog = make_users(), make_catalog()
+
+    class StdlibJSONProvider(DefaultJSONProvider):
+        """Flask's default provider, with the same datetime encoding as FastJSONProvider"""
+
+        default = staticmethod(encode_default)
+        sort_keys = False
+
+    print(f"{'':<10} {'users':>10} {'catalog':>10} {'export':>10}")
+    for name, provider in (("json", StdlibJSONProvider), ("orjson", FastJSONProvider)):
+        app = make_app(provider)
+        with app.app_context():
+            results = (
+                median_ms(lambda: jsonify(users).get_data(), runs),
+                median_ms(lambda: jsonify(catalog).get_data(), runs),
+                median_ms(lambda: "".join(app.json.dumps(user) + "\n" for user in users), runs),
+            )
+        print(f"{name:<10} " + " ".join(f"{result:>10.2f}" for result in results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+# catalog.py - Caches the index of ISO files and the version hash clients use to cache it.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import base64
+import hashlib
+import json
+import os
+import threading
+
+from config import ApplicationConfig
+
+UNKNOWN_LOGO = "assets/unknown.png"
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def catalog_files(index):
+    """List the files the catalog is built from, so it is rebuilt when any of them changes
+
+    Args:
+        index (list): The index of the ISO files
+
+    Returns:
+        list: The paths of index.json and each logo
+    """
+
+    paths = [f"{ApplicationConfig.ISO_DIR}/index.json", UNKNOWN_LOGO]
+    paths.extend(f"{ApplicationConfig.ISO_DIR}/logos/{iso['logo']}" for iso in index)
+    return paths
+
+
+def file_stamps(paths):
+    """Get the modification time and size of files, or None for files that don't exist
+
+    Args:
+        paths (list): The paths of the files
+
+    Returns:
+        tuple: The stamp of each file
+    """
+
+    stamps = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            stamps.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            stamps.append(None)
+    return tuple(stamps)
+
+
+def build_catalog():
+    """Read index.json and embed each logo, falling back to the unknown logo
+
+    Returns:
+        dict: The index, the index keyed by ISO file name, the catalog body, its version hash and the files it was built from
+    """
+
+    with open(f"{ApplicationConfig.ISO_DIR}/index.json", "r", encoding="utf-8") as f:
+        index = json.load(f)
+
+    # Stamp the files before reading them, so a change while building is picked up by the next request
+    paths = catalog_files(index)
+    stamps = file_stamps(paths)
+
+    data = []
+    for iso in index:
+        logo_path = f"{ApplicationConfig.ISO_DIR}/logos/{iso['logo']}"
+        if not os.path.exists(logo_path):
+            logo_path = UNKNOWN_LOGO
+        with open(logo_path, "rb") as f:
+            data.append({**iso, "logo": base64.b64encode(f.read()).decode("utf-8")})
+
+    body = json.dumps(data).encode("utf-8")
+    return {
+        "index": index,
+        "isos": {iso["iso"]: iso for iso in index},
+        "body": body,
+        "version": hashlib.sha256(body).hexdigest()[:16],
+        "paths": paths,
+        "stamps": stamps,
+    }
+
+
+def get_catalog():
+    """Get the catalog, rebuilding it only when index.json or a logo has changed.
+    Checking costs a stat per file rather than reading and encoding every logo on each request.
+
+    Returns:
+        dict: The index of the ISO files, the catalog body with logos, and its version hash
+    """
+
+    global _catalog
+    catalog = _catalog
+    if catalog is not None and file_stamps(catalog["paths"]) == catalog["stamps"]:
+        return catalog
+
+    with _catalog_lock:
+        if _catalog is None or file_stamps(_catalog["paths"]) != _catalog["stamps"]:
+            _catalog = build_catalog()
+        return _catalog
@@ -0,0 +1,178 @@
+# cleanup_jobs.py - Periodic jobs that delete expired registrations, virtual machines that stopped, empty log directories and failed email.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import subprocess
+import time
+from datetime import date, timedelta
+
+from config import ApplicationConfig
+from mail_queue import MAX_ATTEMPTS
+from models import OutboundEmails, UnverifiedUsers, Users, VirtualMachines, db
+from scheduler import Job, utcnow
+from sqlalchemy import and_, delete, select
+from vm_logs import VM_LOG_ROOT
+
+BATCH_SIZE = 500  # Rows deleted per transaction, so locks on the table are held briefly
+BATCH_PAUSE = 0.05  # Seconds between batches, so requests waiting on the table get a turn
+UNVERIFIED_USER_EXPIRY = ApplicationConfig.UNVERIFIED_USER_EXPIRY  # Hours before an unverified registration is deleted
+FAILED_EMAIL_RETENTION = ApplicationConfig.MAIL_FAILED_RETENTION  # Days an email that was given up on is kept
+
+
+def delete_in_batches(model, condition):
+    """Delete the rows matching a condition, BATCH_SIZE at a time, each batch in its own transaction
+
+    Args:
+        model (Model): The model of the table
+        condition (ColumnElement): The rows to delete
+
+    Returns:
+        int: The number of rows deleted
+    """
+
+    deleted = 0
+    while True:
+        ids = db.session.execute(select(model.id).where(condition).limit(BATCH_SIZE)).scalars().all()
+        if not ids:
+            return deleted
+
+        # The condition is checked again, in case a row changed since it was selected
+        deleted += db.session.execute(delete(model).where(model.id.in_(ids), condition)).rowcount
+        db.session.commit()
+        if len(ids) < BATCH_SIZE:
+            return deleted
+        time.sleep(BATCH_PAUSE)
+
+
+def expire_unverified_users():
+    """Delete registrations that were never verified within UNVERIFIED_USER_EXPIRY hours, freeing their usernames and emails
+
+    Returns:
+        str: What was deleted
+    """
+
+    cutoff = utcnow() - timedelta(hours=UNVERIFIED_USER_EXPIRY)
+    deleted = delete_in_batches(UnverifiedUsers, UnverifiedUsers.created < cutoff)
+    return f"Deleted {deleted} expired unverified users" if deleted else None
+
+
+def prune_failed_email():
+    """Delete queued email the mail sender gave up on after MAX_ATTEMPTS, once it has been kept for
+    FAILED_EMAIL_RETENTION days with its last error
+
+    Returns:
+        str: What was deleted
+    """
+
+    cutoff = utcnow() - timedelta(days=FAILED_EMAIL_RETENTION)
+    deleted = delete_in_batches(OutboundEmails, and_(OutboundEmails.attempts >= MAX_ATTEMPTS, OutboundEmails.next_attempt < cutoff))
+    return f"Deleted {deleted} emails that could not be sent" if deleted else None
+
+
+def process_running(pid):
+    """Check if a process is running. A process that exited but was not yet reaped by its parent counts as stopped.
+
+    Args:
+        pid (int): The process id
+
+    Returns:
+        bool: If the process is running
+    """
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    try:
+        with open(f"/proc/{pid}/stat", "r", encoding="utf-8") as f:
+            state = f.read().rsplit(")", 1)[1].split()[0]
+    except (OSError, IndexError):
+        # Without /proc, i.e. on macOS, the signal getting through is all there is to go on
+        return not os.path.isdir("/proc")
+    return state != "Z"
+
+
+def prune_orphan_vms():
+    """Delete the virtual machines whose QEMU process stopped without the user deleting them, i.e. after a shutdown
+    from inside the guest or a reboot of the host, and those of users that no longer exist. Their websockify and
+    QEMU processes are stopped, and their ports freed for new virtual machines.
+
+    Returns:
+        str: What was deleted
+    """
+
+    rows = db.session.execute(
+        select(VirtualMachines.id, VirtualMachines.process_id, VirtualMachines.websockify_process_id, Users.id.label("owner"))
+        .outerjoin(Users, Users.id == VirtualMachines.user_id)
+        .order_by(VirtualMachines.id)
+    ).all()
+
+    orphans = []
+    for row in rows:
+        if row.owner is not None and process_running(row.process_id):
+            continue
+        orphans.append(row.id)
+        for pid in (row.websockify_process_id, row.process_id):
+            if process_running(pid):
+                subprocess.Popen(["kill", str(pid)], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    deleted = 0
+    for i in range(0, len(orphans), BATCH_SIZE):
+        deleted += db.session.execute(delete(VirtualMachines).where(VirtualMachines.id.in_(orphans[i : i + BATCH_SIZE]))).rowcount
+        db.session.commit()
+    return f"Deleted {deleted} orphaned virtual machines" if deleted else None
+
+
+def compact_log_directories():
+    """Remove the empty user and date directories under the virtual machine logs, leaving today's in place
+
+    Returns:
+        str: What was removed
+    """
+
+    if not os.path.isdir(VM_LOG_ROOT):
+        return None
+
+    today = date.today().isoformat()
+    removed = 0
+    for day in sorted(os.listdir(VM_LOG_ROOT)):
+        day_dir = os.path.join(VM_LOG_ROOT, day)
+        if day >= today or not os.path.isdir(day_dir):
+            continue
+        for user_dir in os.listdir(day_dir):
+            try:
+                os.rmdir(os.path.join(day_dir, user_dir))
+                removed += 1
+            except OSError:
+                # Not empty, or not a directory
+                pass
+        try:
+            os.rmdir(day_dir)
+            removed += 1
+        except OSError:
+            pass
+    return f"Removed {removed} empty log directories" if removed else None
+
+
+CLEANUP_JOBS = [
+    Job("expire_unverified_users", expire_unverified_users, interval=900, lease=600),
+    Job("prune_orphan_vms", prune_orphan_vms, interval=60, lease=300),
+    Job("compact_log_directories", compact_log_directories, interval=3600, lease=600),
+    Job("prune_failed_email", prune_failed_email, interval=3600, lease=600),
+]
@@ -16,7 +16,7 @@
 
 import os
 from datetime import timedelta
-from models import ApplicationConfigDb, db
+from db_pool import engine_options, replica_binds
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -24,9 +24,13 @@ load_dotenv()
 
 class ApplicationConfig:
     """Contains the configuration for the server. Modify the values in the .env file to change the configuration.
-    Overridden by the ApplicationConfigDb table in the database.
+    The settings in settings.SCHEMA can be overridden by admins, and are read through settings.current_settings().
     """
 
+    BCRYPT_LOG_ROUNDS = int(os.environ.get("BCRYPT_LOG_ROUNDS", 12))  # Bcrypt work factor, existing hashes are upgraded on login
+    BCRYPT_MAX_PENDING = int(os.environ.get("BCRYPT_MAX_PENDING", 0))  # Passwords that may wait for the pool before requests get a 503, 0 for four times the pool size
+    BCRYPT_POOL_SIZE = int(os.environ.get("BCRYPT_POOL_SIZE", 0))  # Processes per worker hashing passwords, 0 for the CPU count shared between workers
+
     CLIENT_URL = os.environ.get("CLIENT_URL")  # Front-end address
     CORS_HEADERS = os.environ.get("CORS_HEADERS")
 
@@ -35,6 +39,7 @@ class ApplicationConfig:
     GUNICORN_ERROR_LOG = os.environ.get("GUNICORN_ERROR_LOG")  # Gunicorn error log
     GUNICORN_LOG_LEVEL = os.environ.get("GUNICORN_LOG_LEVEL")  # Gunicorn log level
     GUNICORN_WORKER_CLASS = os.environ.get("GUNICORN_WORKER_CLASS")  # Gunicorn worker class
+    GUNICORN_WORKERS = int(os.environ.get("GUNICORN_WORKERS", os.cpu_count() * 2 + 1))  # Gunicorn workers, counted as in gunicorn.conf.py
 
     ISO_DIR = os.environ.get("ISO_DIR")  # ISO path
 
@@ -42,6 +47,7 @@ class ApplicationConfig:
     JWT_COOKIE_CSRF_PROTECT = os.environ.get("JWT_COOKIE_CSRF_PROTECT")  # CSRF protection
     JWT_COOKIE_SECURE = os.environ.get("JWT_COOKIE_SECURE")  # Secure cookies
     JWT_REFRESH_TOKEN_EXPIRES = timedelta(days=int(os.environ.get("JWT_REFRESH_TOKEN_EXPIRES")))  # Refresh token expiration time
+    JWT_REVOCATION_CACHE_TTL = float(os.environ.get("JWT_REVOCATION_CACHE_TTL", 30))  # Seconds a worker caches a user's token version
     JWT_SECRET_KEY = os.environ.get("JWT_SECRET_KEY")  # Secret key
     JWT_TOKEN_LOCATION = os.environ.get("JWT_TOKEN_LOCATION")  # Token location, i.e. cookies
 
@@ -58,16 +64,39 @@ class ApplicationConfig:
     MAIL_USE_SSL = False
     MAIL_USE_TLS = True
     MAIL_USERNAME = os.environ.get("MAIL_USERNAME")  # Mail server username
+    MAIL_QUEUE_POLL_INTERVAL = float(os.environ.get("MAIL_QUEUE_POLL_INTERVAL", 5))  # Seconds between checks for queued email
+    MAIL_MAX_ATTEMPTS = int(os.environ.get("MAIL_MAX_ATTEMPTS", 8))  # Attempts before a queued email is given up on
+    MAIL_FAILED_RETENTION = float(os.environ.get("MAIL_FAILED_RETENTION", 7))  # Days an email that was given up on is kept before it is deleted
 
     MAX_VM_CORES = os.environ.get("MAX_VM_CORES")  # Maximum CPU core count for virtual machines
     MAX_VM_COUNT = os.environ.get("MAX_VM_COUNT")  # Maximum number of virtual machines
     MAX_VM_MEMORY = os.environ.get("MAX_VM_MEMORY")  # Maximum memory for virtual machines
+    VM_EVENTS_INTERVAL = float(os.environ.get("VM_EVENTS_INTERVAL", 5))  # Seconds between checks for changes made by other workers
+    VM_EVENTS_MAX_STREAMS = int(os.environ.get("VM_EVENTS_MAX_STREAMS", 0))  # Event streams per worker, 0 for 1000 under gevent and 2 otherwise
+    VM_EVENTS_MAX_AGE = float(os.environ.get("VM_EVENTS_MAX_AGE", 300))  # Seconds before an event stream is closed and the browser reconnects
 
     SECRET_KEY = os.environ.get("SECRET_KEY")  # Secret key
 
     SQLALCHEMY_DATABASE_URI = os.environ.get("SQLALCHEMY_DATABASE_URI")  # Database URI
     SQLALCHEMY_ECHO = os.environ.get("SQLALCHEMY_ECHO")  # Echo SQL queries to the console
     SQLALCHEMY_TRACK_MODIFICATIONS = os.environ.get("SQLALCHEMY_TRACK_MODIFICATIONS")  # Track modifications
+    SLOW_QUERY_THRESHOLD = float(os.environ.get("SLOW_QUERY_THRESHOLD", 200))  # Milliseconds before a query is logged as slow, 0 turns it off
+    QUERY_BUDGET_ENFORCE = os.environ.get("QUERY_BUDGET_ENFORCE", "false").lower() == "true"  # Fail requests over their query budget
+
+    DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))  # Connections kept open per worker
+    DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))  # Extra connections per worker under load, closed when returned
+    DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 30))  # Seconds a request waits for a connection before failing
+    DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))  # Seconds before a connection is replaced, below the server's idle timeout
+    DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true").lower() == "true"  # Test connections before use
+    DB_PGBOUNCER = os.environ.get("DB_PGBOUNCER", "false").lower() == "true"  # PgBouncer pools connections in transaction mode
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(
+        SQLALCHEMY_DATABASE_URI, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING, DB_PGBOUNCER
+    )
+    DB_REPLICA_URIS = [uri.strip() for uri in os.environ.get("DB_REPLICA_URIS", "").split(",") if uri.strip()]  # Read replicas
+    DB_REPLICA_STICKY_SECONDS = float(os.environ.get("DB_REPLICA_STICKY_SECONDS", 5))  # Seconds a client reads from the primary after writing
+    SQLALCHEMY_BINDS = replica_binds(
+        DB_REPLICA_URIS, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING, DB_PGBOUNCER
+    )
 
     WEBSOCKET_SSL_ENABLED = os.environ.get("WEBSOCKET_SSL_ENABLED")  # SSL enabled
     GUNICORN_SSL_ENABLED = os.environ.get("GUNICORN_SSL_ENABLED")  # SSL enabled
@@ -76,8 +105,31 @@ class ApplicationConfig:
     SSL_KEY_PATH = os.environ.get("SSL_KEY_PATH")  # Key path
 
     RATE_LIMIT = os.environ.get("RATE_LIMIT")  # Rate limit
-
-    LDAP_ENABLED = os.environ.get("LDAP_ENABLED")  # LDAP enabled
+    RATE_LIMIT_LOGIN = os.environ.get("RATE_LIMIT_LOGIN", "10/minute")  # Logins per IP address
+    RATE_LIMIT_VM_CREATE = os.environ.get("RATE_LIMIT_VM_CREATE", "5/minute")  # Virtual machines created per user
+    RATE_LIMIT_VM_BOOT = os.environ.get("RATE_LIMIT_VM_BOOT", "30/minute")  # Virtual machines booted across the whole server
+    RATELIMIT_STORAGE_URI = os.environ.get("RATE_LIMIT_STORAGE_URI", "memory://")  # Shared counters, i.e. redis://localhost:6379
+    RATELIMIT_STRATEGY = os.environ.get("RATE_LIMIT_STRATEGY", "moving-window")  # fixed-window, moving-window or sliding-window-counter
+    RATELIMIT_IN_MEMORY_FALLBACK_ENABLED = True  # Keep limiting per worker if the shared storage is unreachable
+    RATELIMIT_KEY_PREFIX = "buffet"
+
+    SETTINGS_POLL_INTERVAL = float(os.environ.get("SETTINGS_POLL_INTERVAL", 5))  # Most seconds before a worker applies settings changed by another
+    SETTINGS_CHANNEL_URL = os.environ.get("SETTINGS_CHANNEL_URL")  # Redis that changes are published on, i.e. redis://localhost:6379
+
+    SCHEDULER_ENABLED = os.environ.get("SCHEDULER_ENABLED", "true").lower() == "true"  # Run the periodic cleanup jobs in this server's workers
+    UNVERIFIED_USER_EXPIRY = float(os.environ.get("UNVERIFIED_USER_EXPIRY", 48))  # Hours before an unverified registration is deleted
+
+    LOG_RETENTION_DAYS = int(os.environ.get("LOG_RETENTION_DAYS", 30))  # Days virtual machine captures are kept, 0 to keep them until a quota is reached
+    LOG_USER_QUOTA = int(os.environ.get("LOG_USER_QUOTA", 1024))  # Megabytes of captures kept per user, 0 for no limit
+    LOG_TOTAL_QUOTA = int(os.environ.get("LOG_TOTAL_QUOTA", 0))  # Megabytes of captures kept in total, 0 for no limit
+    LOG_COMPRESS_WORKERS = int(os.environ.get("LOG_COMPRESS_WORKERS", 2))  # Captures compressed at once
+
+    TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 0))  # Fraction of requests traced, i.e. 0.01, 0 turns tracing off
+    TRACE_EXPORTER = os.environ.get("TRACE_EXPORTER", "file")  # file or otlp
+    TRACE_FILE = os.environ.get("TRACE_FILE")  # Spans as JSON lines, defaults to traces.jsonl in LOG_DIR
+    TRACE_OTLP_ENDPOINT = os.environ.get("TRACE_OTLP_ENDPOINT")  # OTLP/HTTP collector, i.e. http://localhost:4318/v1/traces
+
+    LDAP_ENABLED = os.environ.get("LDAP_ENABLED", "false").lower() == "true"  # LDAP enabled
     LDAP_HOST = os.environ.get("LDAP_HOST")  # LDAP host
     LDAP_BASE_DN = os.environ.get("LDAP_BASE_DN")  # LDAP base DN
     LDAP_USER_DN = os.environ.get("LDAP_USER_DN")  # LDAP user DN
@@ -86,21 +138,8 @@ class ApplicationConfig:
     LDAP_USER_LOGIN_ATTR = os.environ.get("LDAP_USER_LOGIN_ATTR")  # LDAP user login attribute
     LDAP_BIND_USER_DN = os.environ.get("LDAP_BIND_USER_DN")  # LDAP bind user DN
     LDAP_BIND_USER_PASSWORD = os.environ.get("LDAP_BIND_USER_PASSWORD")  # LDAP bind user password
+    LDAP_POOL_SIZE = int(os.environ.get("LDAP_POOL_SIZE", 4))  # Connections bound as the bind user kept open per worker
+    LDAP_CACHE_TTL = float(os.environ.get("LDAP_CACHE_TTL", 60))  # Seconds successful logins, user and group lookups are cached
 
     VM_PORT_START = os.environ.get("VM_PORT_START")  # VM port start
     WEBSOCKET_PORT_START = os.environ.get("WEBSOCKET_PORT_START")  # Websocket port start
-
-    @staticmethod
-    def get_config():
-        for key, value in ApplicationConfig.__dict__.items():
-            if not key.startswith("__") and not callable(value):
-                ApplicationConfig.__dict__[key] = os.environ.get(key)
-
-
-def override_config_with_db(app):
-    """Override environment variables with database entries if they exist."""
-    with app.app_context():
-        config_entries = db.session.query(ApplicationConfigDb).all()
-        for entry in config_entries:
-            if entry.key in os.environ:
-                os.environ[entry.key] = entry.value
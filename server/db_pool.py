@@ -0,0 +1,201 @@
+# db_pool.py - Configures the database connection pool and records how long requests wait for a connection.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import threading
+import time
+
+from models import REPLICA_BIND_PREFIX
+from sqlalchemy import event, exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import NullPool, QueuePool
+
+
+class PoolStats:
+    """Counts connection checkouts and how long they waited, for the worker's database pool"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Clear the counters, i.e. in a worker after gunicorn forks"""
+
+        self.pid = os.getpid()
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.timeouts = 0
+        self.connects = 0
+        self.invalidations = 0
+
+    def _check_pid(self):
+        """Start counting afresh in a forked worker. The caller holds the lock."""
+
+        if self.pid != os.getpid():
+            self.reset()
+
+    def record_checkout(self, wait):
+        """Record a connection checked out of the pool
+
+        Args:
+            wait (float): Seconds spent waiting for it
+        """
+
+        with self._lock:
+            self._check_pid()
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+    def record_timeout(self):
+        """Record a request that gave up waiting for a connection"""
+
+        with self._lock:
+            self._check_pid()
+            self.timeouts += 1
+
+    def record_connect(self):
+        """Record a new connection to the database"""
+
+        with self._lock:
+            self._check_pid()
+            self.connects += 1
+
+    def record_invalidation(self):
+        """Record a connection thrown away, i.e. because a pre-ping found it dead"""
+
+        with self._lock:
+            self._check_pid()
+            self.invalidations += 1
+
+    def snapshot(self, pool):
+        """Describe the pool and its counters
+
+        Args:
+            pool (Pool): The engine's pool
+
+        Returns:
+            dict: The pool's size, usage and waits in this worker
+        """
+
+        with self._lock:
+            self._check_pid()
+            stats = {
+                "pid": self.pid,
+                "pool": type(pool).__name__,
+                "checkouts": self.checkouts,
+                "wait_avg_ms": round(self.wait_total / self.checkouts * 1000, 3) if self.checkouts else 0,
+                "wait_max_ms": round(self.wait_max * 1000, 3),
+                "timeouts": self.timeouts,
+                "connects": self.connects,
+                "invalidations": self.invalidations,
+            }
+
+        if isinstance(pool, QueuePool):
+            capacity = pool.size() + max(pool._max_overflow, 0)
+            stats.update({
+                "size": pool.size(),
+                "max_overflow": pool._max_overflow,
+                "checked_out": pool.checkedout(),
+                "idle": pool.checkedin(),
+                "utilization": round(pool.checkedout() / capacity, 3) if capacity else 0,
+            })
+        return stats
+
+
+pool_stats = PoolStats()
+
+
+class TimedQueuePool(QueuePool):
+    """A QueuePool that records how long each checkout waited for a free connection"""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            pool_stats.record_timeout()
+            raise
+        pool_stats.record_checkout(time.perf_counter() - start)
+        return connection
+
+
+def engine_options(uri, pool_size, max_overflow, pool_timeout, pool_recycle, pre_ping, pgbouncer):
+    """Build the SQLAlchemy engine options for a database
+
+    Args:
+        uri (str): The database URI
+        pool_size (int): Connections kept open per worker
+        max_overflow (int): Extra connections opened under load, closed when returned
+        pool_timeout (float): Seconds to wait for a connection before failing the request
+        pool_recycle (int): Seconds before a connection is replaced, so it is never used after the server dropped it
+        pre_ping (bool): If connections are tested before each checkout
+        pgbouncer (bool): If PgBouncer pools connections in transaction mode, in which case each checkout opens a new
+            connection to PgBouncer and prepared statements are turned off
+
+    Returns:
+        dict: The engine options
+    """
+
+    if not uri:
+        return {}
+    url = make_url(uri)
+
+    # In-memory SQLite only exists within its one connection, so Flask-SQLAlchemy's own pool is kept
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        return {}
+
+    if pgbouncer:
+        options = {"poolclass": NullPool}
+        # psycopg 3 prepares repeated statements on the server connection, which PgBouncer hands to other clients
+        if url.get_driver_name() == "psycopg":
+            options["connect_args"] = {"prepare_threshold": None}
+        return options
+
+    return {
+        "poolclass": TimedQueuePool,
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_timeout": pool_timeout,
+        "pool_recycle": pool_recycle,
+        "pool_pre_ping": pre_ping,
+    }
+
+
+def replica_binds(uris, *pool_options):
+    """Build the SQLALCHEMY_BINDS of the read replicas, each pooled like the primary
+
+    Args:
+        uris (list): The database URIs of the replicas
+        pool_options: The pool options, as passed to engine_options
+
+    Returns:
+        dict: The binds, keyed by replica
+    """
+
+    return {f"{REPLICA_BIND_PREFIX}{i}": {"url": uri, **engine_options(uri, *pool_options)} for i, uri in enumerate(uris)}
+
+
+def init_pool_stats(engine):
+    """Count new and invalidated connections of an engine
+
+    Args:
+        engine (Engine): The engine
+    """
+
+    event.listen(engine, "connect", lambda dbapi_connection, connection_record: pool_stats.record_connect())
+    event.listen(engine, "invalidate", lambda dbapi_connection, connection_record, exception: pool_stats.record_invalidation())
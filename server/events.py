@@ -0,0 +1,231 @@
+# events.py - Pushes virtual machine state to clients as Server-Sent Events.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import queue
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+HEARTBEAT_INTERVAL = 15  # Seconds between comments sent to keep idle streams open through proxies
+QUEUE_SIZE = 100  # Events a slow client may fall behind by before it is disconnected
+RECONNECT_DELAY = 1000  # Milliseconds a browser waits before reopening a stream the server closed
+
+
+class EventHub:
+    """Fans out the server's capacity and each user's virtual machine to their event streams.
+    One thread per worker loads the state of every subscribed user with a single query, and pushes only what changed,
+    so N open streams cost one query per refresh rather than N polls. It refreshes as soon as this worker changes a
+    virtual machine, and every interval seconds to pick up changes made by other workers.
+    Each open stream holds a worker thread, or a greenlet under gevent, so a worker only accepts max_streams of them,
+    and closes each after max_age seconds so the browser reconnects, possibly to a less busy worker.
+    """
+
+    def __init__(self, load_state, interval, max_streams, max_age):
+        """
+        Args:
+            load_state (function): Takes a set of user ids, and returns the capacity and a dict of each user's state
+            interval (float): Seconds between refreshes when nothing in this worker changed
+            max_streams (int): Streams a worker keeps open at once
+            max_age (float): Seconds before a stream is closed
+        """
+
+        self.load_state = load_state
+        self.interval = interval
+        self.max_streams = max_streams
+        self.max_age = max_age
+        self._subscribers = {}
+        self._capacity = None
+        self._states = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def _start(self, app):
+        """Start the refresh thread, once per process so gunicorn workers each get their own after forking"""
+
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, args=(app,), name="event-hub", daemon=True)
+            self._thread.start()
+
+    def notify(self):
+        """Refresh now, i.e. after a virtual machine was created or deleted"""
+
+        self._wake.set()
+
+    def _run(self, app):
+        """Refresh the state until the process exits"""
+
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                with app.app_context():
+                    self.refresh()
+            except Exception:
+                app.logger.exception("Failed to refresh virtual machine events")
+
+    def refresh(self):
+        """Load the state of every subscribed user and publish whatever changed"""
+
+        with self._lock:
+            user_ids = set(self._subscribers.values())
+        if not user_ids:
+            return
+
+        capacity, states = self.load_state(user_ids)
+
+        with self._lock:
+            if capacity != self._capacity:
+                self._capacity = capacity
+                self._publish("capacity", capacity)
+            for user_id in user_ids:
+                state = states.get(user_id)
+                if user_id not in self._states or self._states[user_id] != state:
+                    self._states[user_id] = state
+                    self._publish("vm", state, user_id)
+            # Forget users whose streams have all closed
+            for user_id in set(self._states) - user_ids:
+                del self._states[user_id]
+
+    def _publish(self, name, data, user_id=None):
+        """Queue an event for every subscriber, or only for one user's. The caller holds the lock.
+
+        Args:
+            name (str): The event name
+            data: The event data
+            user_id (str): The user the event is for, or None for everyone
+        """
+
+        for subscriber, subscriber_user_id in list(self._subscribers.items()):
+            if user_id is not None and subscriber_user_id != user_id:
+                continue
+            try:
+                subscriber.put_nowait((name, data))
+            except queue.Full:
+                # Close the stream of a client that stopped reading, it reconnects and gets a fresh snapshot.
+                # One queued event is dropped to make room, as waiting for the client would stall every other stream.
+                del self._subscribers[subscriber]
+                try:
+                    subscriber.get_nowait()
+                except queue.Empty:
+                    pass
+                subscriber.put_nowait((None, None))
+
+    def subscribe(self, app, user_id):
+        """Subscribe to the events for a user, starting with their current state
+
+        Args:
+            app (Flask): The Flask app, used by the refresh thread
+            user_id (str): The id of the user
+
+        Returns:
+            Queue: The queue the events arrive on, or None if this worker already has max_streams open
+        """
+
+        with self._lock:
+            if len(self._subscribers) >= self.max_streams:
+                return None
+
+        self._start(app)
+        capacity, states = self.load_state({user_id})
+        subscriber = queue.Queue(QUEUE_SIZE + 2)
+        subscriber.put(("capacity", capacity))
+        subscriber.put(("vm", states.get(user_id)))
+        with self._lock:
+            if len(self._subscribers) >= self.max_streams:
+                return None
+            self._subscribers[subscriber] = user_id
+            # Remember the snapshot so the next refresh doesn't send it again
+            self._states.setdefault(user_id, states.get(user_id))
+            if self._capacity is None:
+                self._capacity = capacity
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """Stop sending events to a queue
+
+        Args:
+            subscriber (Queue): The queue returned by subscribe
+        """
+
+        with self._lock:
+            self._subscribers.pop(subscriber, None)
+
+    def stream(self, app, subscriber, expires_at):
+        """Generate a Server-Sent Events stream for a subscriber. It ends after max_age seconds, or when the user's token
+        expires if that is sooner, and the browser reconnects with a fresh token.
+
+        Args:
+            app (Flask): The Flask app
+            subscriber (Queue): The queue returned by subscribe
+            expires_at (float): The UNIX time the user's token expires
+
+        Yields:
+            str: The events
+        """
+
+        ends_at = min(expires_at, time.time() + self.max_age)
+        try:
+            yield f"retry: {RECONNECT_DELAY}\n\n"
+            while time.time() < ends_at:
+                try:
+                    name, data = subscriber.get(timeout=min(HEARTBEAT_INTERVAL, max(ends_at - time.time(), 0)))
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if name is None:
+                    return
+                yield f"event: {name}\ndata: {app.json.dumps(data)}\n\n"
+        finally:
+            self.unsubscribe(subscriber)
+
+
+def watch_model(model, hub):
+    """Refresh a hub whenever a transaction that inserted, updated or deleted rows of a model commits,
+    including bulk statements, so every code path that changes a virtual machine is covered.
+
+    Args:
+        model (db.Model): The model to watch
+        hub (EventHub): The hub to refresh
+    """
+
+    @event.listens_for(Session, "after_flush")
+    def after_flush(session, flush_context):
+        if any(isinstance(obj, model) for obj in (*session.new, *session.dirty, *session.deleted)):
+            session.info["events_changed"] = True
+
+    @event.listens_for(Session, "do_orm_execute")
+    def do_orm_execute(orm_execute_state):
+        if (orm_execute_state.is_delete or orm_execute_state.is_update or orm_execute_state.is_insert) and (
+            orm_execute_state.bind_mapper is not None and orm_execute_state.bind_mapper.class_ is model
+        ):
+            orm_execute_state.session.info["events_changed"] = True
+
+    @event.listens_for(Session, "after_commit")
+    def after_commit(session):
+        if session.info.pop("events_changed", False):
+            hub.notify()
+
+    @event.listens_for(Session, "after_rollback")
+    def after_rollback(session):
+        session.info.pop("events_changed", None)
@@ -0,0 +1,94 @@
+# gevent_support.py - Keeps blocking work cooperative when gunicorn runs gevent workers.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import threading
+
+_threadpool = None
+_threadpool_pid = None
+_threadpool_lock = threading.Lock()
+
+
+def is_gevent_patched():
+    """Check if gevent has monkey patched the standard library, as gunicorn's gevent worker does before loading the app
+
+    Returns:
+        bool: If sockets, sleeps and subprocesses are cooperative
+    """
+
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("socket")
+
+
+def patch_psycopg():
+    """Make psycopg2 wait for the database through gevent instead of blocking the whole worker, as psycogreen does"""
+
+    try:
+        import psycopg2
+        from psycopg2 import extensions
+    except ImportError:
+        return
+
+    from gevent.socket import wait_read, wait_write
+
+    def wait_callback(conn, timeout=None):
+        while True:
+            state = conn.poll()
+            if state == extensions.POLL_OK:
+                break
+            elif state == extensions.POLL_READ:
+                wait_read(conn.fileno(), timeout=timeout)
+            elif state == extensions.POLL_WRITE:
+                wait_write(conn.fileno(), timeout=timeout)
+            else:
+                raise psycopg2.OperationalError(f"Bad result from poll: {state}")
+
+    extensions.set_wait_callback(wait_callback)
+
+
+def run_in_threadpool(size, fn, *args, timeout=None):
+    """Run a function that releases the GIL, i.e. bcrypt, in a native thread so other greenlets keep running
+
+    Args:
+        size (int): The number of threads in the pool, used when it is first created in each worker
+        fn (function): The function to run
+        args: The arguments to the function
+        timeout (float): Seconds to wait for the result
+
+    Raises:
+        TimeoutError: If the function did not finish in time
+
+    Returns:
+        The result of the function
+    """
+
+    from gevent import Timeout
+    from gevent.threadpool import ThreadPool
+
+    global _threadpool, _threadpool_pid
+    with _threadpool_lock:
+        if _threadpool is None or _threadpool_pid != os.getpid():
+            _threadpool = ThreadPool(size)
+            _threadpool_pid = os.getpid()
+        pool = _threadpool
+
+    try:
+        return pool.spawn(fn, *args).get(timeout=timeout)
+    except Timeout as e:
+        raise TimeoutError() from e
@@ -0,0 +1,123 @@
+# identity.py - Resolves which account owns a username or email across the user tables.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from collections import namedtuple
+
+from models import BannedUsers, UnverifiedUsers, Users, db
+from sqlalchemy import String, cast, literal, null, or_, select, union_all
+
+ACTIVE = "active"
+UNVERIFIED = "unverified"
+BANNED = "banned"
+
+Identity = namedtuple("Identity", ["state", "id", "username", "email", "ban_reason"])
+
+
+def _select_identities(model, state, id_column, ban_reason, usernames, emails):
+    """Build the SELECT for one user table
+
+    Args:
+        model (db.Model): The user table to search
+        state (str): The state of accounts in this table
+        id_column (db.Column): The column holding the user's id
+        ban_reason (db.Column): The column holding the ban reason, or NULL
+        usernames (list): The usernames to match
+        emails (list): The emails to match
+
+    Returns:
+        Select: The SELECT statement
+    """
+
+    conditions = []
+    if usernames:
+        conditions.append(model.username.in_(usernames))
+    if emails:
+        conditions.append(model.email.in_(emails))
+
+    return select(
+        literal(state, String).label("state"),
+        id_column.label("id"),
+        model.username.label("username"),
+        model.email.label("email"),
+        ban_reason.label("ban_reason"),
+    ).where(or_(*conditions))
+
+
+def find_identities(usernames=(), emails=(), states=(ACTIVE, UNVERIFIED, BANNED)):
+    """Find every account that owns one of the given usernames or emails with a single UNION query
+
+    Args:
+        usernames (list): The usernames to match
+        emails (list): The emails to match
+        states (tuple): Which of the active, unverified and banned tables to search
+
+    Returns:
+        list: The matching accounts as Identity tuples
+    """
+
+    usernames = [username for username in usernames if username]
+    emails = [email for email in emails if email]
+    if not usernames and not emails:
+        return []
+
+    selects = []
+    if ACTIVE in states:
+        selects.append(_select_identities(Users, ACTIVE, Users.id, cast(null(), String), usernames, emails))
+    if UNVERIFIED in states:
+        selects.append(_select_identities(UnverifiedUsers, UNVERIFIED, UnverifiedUsers.id, cast(null(), String), usernames, emails))
+    if BANNED in states:
+        selects.append(_select_identities(BannedUsers, BANNED, BannedUsers.user_id, BannedUsers.ban_reason, usernames, emails))
+
+    return [Identity(*row) for row in db.session.execute(union_all(*selects))]
+
+
+def _same(value, other):
+    """Compare a username or email the way a case-insensitive collation does, i.e. MySQL's default one
+
+    Args:
+        value (str): The value asked for
+        other (str): The value the database returned
+
+    Returns:
+        bool: If they are the same
+    """
+
+    return value.casefold() == (other or "").casefold()
+
+
+def first_identity(identities, state=None, username=None, email=None):
+    """Get the first account matching a state, username or email from the result of find_identities.
+    Usernames and emails match regardless of case, as the database may have matched them that way.
+
+    Args:
+        identities (list): The Identity tuples to search
+        state (str): The state to match
+        username (str): The username to match
+        email (str): The email to match
+
+    Returns:
+        Identity: The first matching account, or None
+    """
+
+    for identity in identities:
+        if state is not None and identity.state != state:
+            continue
+        if username is not None and not _same(username, identity.username):
+            continue
+        if email is not None and not _same(email, identity.email):
+            continue
+        return identity
+    return None
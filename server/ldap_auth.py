@@ -0,0 +1,238 @@
+# ldap_auth.py - Pools LDAP connections for the bind user and caches directory lookups.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import copy
+import hashlib
+import hmac
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from flask import current_app
+from flask_ldap3_login import AuthenticationResponseStatus, LDAP3LoginManager
+
+IDLE_TIMEOUT = 60  # Seconds an unused connection is kept before it is closed rather than risk the server having dropped it
+
+
+class TTLCache:
+    """A small thread safe cache whose entries expire after a number of seconds, dropping the least recently used past max_size."""
+
+    def __init__(self, ttl, max_size=1000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get a cached value
+
+        Args:
+            key: The key of the value
+
+        Returns:
+            tuple: If the value was cached, and a copy of the value
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry or entry[1] <= time.monotonic():
+                self._entries.pop(key, None)
+                return False, None
+            self._entries.move_to_end(key)
+            return True, copy.deepcopy(entry[0])
+
+    def set(self, key, value):
+        """Cache a copy of a value
+
+        Args:
+            key: The key of the value
+            value: The value
+        """
+
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (copy.deepcopy(value), time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Drop every cached value"""
+
+        with self._lock:
+            self._entries.clear()
+
+
+class LDAPConnectionPool:
+    """Keeps up to size connections bound as the bind user open between requests, so a login doesn't wait on TCP and TLS setup.
+    Each connection is used by one thread at a time, and the pool is emptied in each gunicorn worker after forking.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._idle = []
+        self._members = weakref.WeakSet()
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def get(self, create):
+        """Take an idle connection from the pool, or create a new one
+
+        Args:
+            create (function): Creates a new, unbound connection
+
+        Returns:
+            ldap3.Connection: The connection
+        """
+
+        expired = []
+        connection = None
+        with self._lock:
+            if self._pid != os.getpid():
+                # Connections inherited from the master share its sockets, so they are never reused
+                self._idle = []
+                self._members = weakref.WeakSet()
+                self._pid = os.getpid()
+            now = time.monotonic()
+            while self._idle:
+                candidate, returned = self._idle.pop()
+                if candidate.closed or now - returned > IDLE_TIMEOUT:
+                    expired.append(candidate)
+                    continue
+                connection = candidate
+                break
+
+        for candidate in expired:
+            self._close(candidate)
+
+        if connection is None:
+            connection = create()
+            with self._lock:
+                self._members.add(connection)
+        return connection
+
+    def owns(self, connection):
+        """Check if a connection was handed out by the pool
+
+        Args:
+            connection (ldap3.Connection): The connection
+
+        Returns:
+            bool: If the connection belongs to the pool
+        """
+
+        with self._lock:
+            return connection in self._members
+
+    def put(self, connection):
+        """Return a connection to the pool, closing it if the pool is full or it is no longer open
+
+        Args:
+            connection (ldap3.Connection): The connection
+        """
+
+        with self._lock:
+            if not connection.closed and connection.bound and len(self._idle) < self.size:
+                self._idle.append((connection, time.monotonic()))
+                return
+            self._members.discard(connection)
+        self._close(connection)
+
+    def _close(self, connection):
+        """Unbind a connection, ignoring errors from one the server already dropped"""
+
+        try:
+            connection.unbind()
+        except Exception:
+            pass
+
+
+class PooledLDAP3LoginManager(LDAP3LoginManager):
+    """LDAP3LoginManager that reuses connections bound as LDAP_BIND_USER_DN, and caches successful logins,
+    user and group lookups for LDAP_CACHE_TTL seconds so a burst of logins doesn't hit the directory for each one.
+    """
+
+    def init_app(self, app):
+        super().init_app(app)
+        self.pool = LDAPConnectionPool(app.config["LDAP_POOL_SIZE"])
+        self.cache = TTLCache(app.config["LDAP_CACHE_TTL"])
+
+    def _make_connection(self, bind_user=None, bind_password=None, contextualise=True, app=None, **kwargs):
+        # Only connections for the bind user are shared, users bind on their own connection
+        if kwargs or bind_user != (app or current_app).config.get("LDAP_BIND_USER_DN"):
+            return super()._make_connection(bind_user, bind_password, contextualise=contextualise, app=app, **kwargs)
+
+        connection = self.pool.get(lambda: super(PooledLDAP3LoginManager, self)._make_connection(bind_user, bind_password, contextualise=False, app=app))
+
+        # Connections left in the app context are handed to destroy_connection on teardown, which returns them to the pool
+        if contextualise:
+            self._contextualise_connection(connection)
+        return connection
+
+    def destroy_connection(self, connection):
+        if self.pool.owns(connection):
+            self._decontextualise_connection(connection)
+            self.pool.put(connection)
+            return
+        super().destroy_connection(connection)
+
+    def _password_key(self, username, password):
+        """Get the cache key for a successful login, without keeping the password in memory
+
+        Args:
+            username (str): The username
+            password (str): The password
+
+        Returns:
+            tuple: The key
+        """
+
+        digest = hmac.new(current_app.config["SECRET_KEY"].encode("utf-8"), password.encode("utf-8"), hashlib.sha256).hexdigest()
+        return ("bind", username, digest)
+
+    def authenticate(self, username, password):
+        key = self._password_key(username, password)
+        cached, response = self.cache.get(key)
+        if cached:
+            return response
+
+        response = super().authenticate(username, password)
+
+        # Failures are never cached, so a changed password or a lockout takes effect straight away
+        if response.status == AuthenticationResponseStatus.success:
+            response.exception = None
+            self.cache.set(key, response)
+        return response
+
+    def get_user_groups(self, dn, group_search_dn=None, _connection=None):
+        key = ("groups", dn, group_search_dn)
+        cached, groups = self.cache.get(key)
+        if not cached:
+            groups = super().get_user_groups(dn, group_search_dn=group_search_dn, _connection=_connection)
+            self.cache.set(key, groups)
+        return groups
+
+    def get_object(self, dn, filter, attributes, _connection=None):
+        key = ("object", dn, filter, repr(attributes))
+        cached, data = self.cache.get(key)
+        if not cached:
+            data = super().get_object(dn, filter, attributes, _connection=_connection)
+            if data is not None:
+                self.cache.set(key, data)
+        return data
@@ -0,0 +1,244 @@
+# mail_queue.py - Queues outbound email in the database and sends it from a background thread.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import smtplib
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
+
+from config import ApplicationConfig
+from models import OutboundEmails, db
+from sqlalchemy import or_
+from tracing import span, trace
+
+BATCH_SIZE = int(ApplicationConfig.MAIL_MAX_EMAILS or 50)  # Emails sent over one SMTP connection before it is reopened
+POLL_INTERVAL = ApplicationConfig.MAIL_QUEUE_POLL_INTERVAL  # Seconds between checks for queued email
+IDLE_TIMEOUT = 60  # Seconds an unused SMTP connection is kept open
+CLAIM_TIMEOUT = 300  # Seconds before email claimed by a worker that died is picked up by another
+MAX_ATTEMPTS = ApplicationConfig.MAIL_MAX_ATTEMPTS
+RETRY_DELAY = 30  # Seconds before the first retry, doubled on each attempt
+MAX_RETRY_DELAY = 3600
+
+
+def utcnow():
+    """Get the current UTC time without a timezone, as stored in the database
+
+    Returns:
+        datetime: The current time
+    """
+
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def retry_delay(attempts):
+    """Get how long to wait before retrying an email, doubling with each failed attempt
+
+    Args:
+        attempts (int): The number of attempts made so far
+
+    Returns:
+        timedelta: The delay
+    """
+
+    return timedelta(seconds=min(RETRY_DELAY * 2 ** max(attempts - 1, 0), MAX_RETRY_DELAY))
+
+
+class MailSender:
+    """Sends queued email from a daemon thread in each worker.
+    The SMTP connection is kept open between batches and reopened after every BATCH_SIZE emails, or when it fails.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.worker_id = uuid4().hex
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._connection = None
+        self._sent = 0
+        self._last_used = 0
+
+    def start(self):
+        """Start the sender thread, once per process so gunicorn workers each get their own after forking"""
+
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._connection = None
+            self._thread = threading.Thread(target=self.run, name="mail-sender", daemon=True)
+            self._thread.start()
+
+    def notify(self):
+        """Wake the sender thread so newly queued email is sent straight away"""
+
+        self.start()
+        self._wake.set()
+
+    def run(self):
+        """Send queued email until the process exits"""
+
+        while True:
+            self._wake.wait(POLL_INTERVAL)
+            self._wake.clear()
+            try:
+                with self.app.app_context():
+                    while self.send_batch():
+                        pass
+            except Exception:
+                self.app.logger.exception("Failed to send queued email")
+                self.close()
+            finally:
+                if self._connection is not None and time.monotonic() - self._last_used > IDLE_TIMEOUT:
+                    self.close()
+
+    def claim_batch(self):
+        """Claim up to BATCH_SIZE emails that are due, so other workers skip them
+
+        Returns:
+            list: The claimed emails
+        """
+
+        now = utcnow()
+        due = (
+            db.session.query(OutboundEmails.id)
+            .filter(OutboundEmails.next_attempt <= now)
+            .filter(OutboundEmails.attempts < MAX_ATTEMPTS)
+            .filter(or_(OutboundEmails.claimed_until.is_(None), OutboundEmails.claimed_until < now))
+            .order_by(OutboundEmails.next_attempt)
+            .limit(BATCH_SIZE)
+        )
+        ids = [row.id for row in due]
+        if not ids:
+            return []
+
+        # Only rows nobody else claimed in the meantime are updated
+        db.session.query(OutboundEmails).filter(OutboundEmails.id.in_(ids)).filter(
+            or_(OutboundEmails.claimed_until.is_(None), OutboundEmails.claimed_until < now)
+        ).update(
+            {"claimed_by": self.worker_id, "claimed_until": now + timedelta(seconds=CLAIM_TIMEOUT)},
+            synchronize_session=False,
+        )
+        db.session.commit()
+
+        return OutboundEmails.query.filter(OutboundEmails.id.in_(ids), OutboundEmails.claimed_by == self.worker_id).all()
+
+    def connect(self):
+        """Get the open SMTP connection, opening one if needed
+
+        Returns:
+            Connection: The Flask-Mail connection
+        """
+
+        from flask_mail import Mail
+
+        if self._connection is not None and self._sent >= BATCH_SIZE:
+            self.close()
+        if self._connection is None:
+            if "mail" not in self.app.extensions:
+                Mail(self.app)
+            with span("smtp.connect", host=self.app.config.get("MAIL_SERVER") or ""):
+                self._connection = Mail().connect().__enter__()
+            self._sent = 0
+        return self._connection
+
+    def close(self):
+        """Close the SMTP connection, ignoring errors from a connection that already dropped"""
+
+        if self._connection is not None:
+            try:
+                self._connection.__exit__(None, None, None)
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._connection = None
+
+    def send_batch(self):
+        """Send one batch of queued email, reusing the open SMTP connection
+
+        Returns:
+            bool: If a full batch was sent, so there may be more waiting
+        """
+
+        from flask_mail import Message
+
+        emails = self.claim_batch()
+        if not emails:
+            return False
+
+        # Trace the batch on its own, as it is sent after the request that queued it has finished
+        with trace("mail.send_batch", batch_size=len(emails)):
+            for email in emails:
+                try:
+                    msg = Message(email.subject, sender=os.environ.get("MAIL_USERNAME"), recipients=email.recipients.split(","))
+                    msg.html = email.html
+                    with span("smtp.send", email_id=email.id):
+                        self.connect().send(msg)
+                except Exception as e:
+                    # Reschedule the email and drop the connection, as it may be the cause. Any error counts as an attempt,
+                    # or an email that always fails the same way would keep its claim and be retried forever.
+                    email.attempts += 1
+                    email.next_attempt = utcnow() + retry_delay(email.attempts)
+                    email.claimed_by = None
+                    email.claimed_until = None
+                    email.last_error = str(e)[:255]
+                    db.session.commit()
+                    self.close()
+                    if email.attempts >= MAX_ATTEMPTS:
+                        self.app.logger.error("Giving up on email %s to %s: %s", email.id, email.recipients, e)
+                    continue
+
+                self._sent += 1
+                self._last_used = time.monotonic()
+                db.session.delete(email)
+                db.session.commit()
+
+        return len(emails) == BATCH_SIZE
+
+
+_sender = None
+
+
+def init_mail_queue(app):
+    """Create the mail sender for the app and start it, so email queued before a restart is sent
+
+    Args:
+        app (Flask): The Flask app
+    """
+
+    global _sender
+    _sender = MailSender(app)
+    _sender.start()
+
+
+def queue_mail(subject, recipients, html):
+    """Queue an email and commit the session, so it is sent with any other pending changes or not at all
+
+    Args:
+        subject (str): The subject of the email
+        recipients (list): The email addresses to send the email to
+        html (str): The HTML body of the email
+    """
+
+    now = utcnow()
+    with span("mail.queue"):
+        db.session.add(OutboundEmails(recipients=",".join(recipients), subject=subject, html=html, created=now, next_attempt=now))
+        db.session.commit()
+
+    if _sender is not None:
+        _sender.notify()
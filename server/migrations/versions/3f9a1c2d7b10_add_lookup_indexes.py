@@ -0,0 +1,44 @@
+"""Add indexes for the columns looked up on login, registration and VM endpoints
+
+Revision ID: 3f9a1c2d7b10
+Revises:
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f9a1c2d7b10'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+# (index name, table, column, unique)
+INDEXES = [
+    ("ix_users_email", "users", "email", True),
+    ("ix_unverified_users_email", "unverified_users", "email", True),
+    ("ix_banned_users_email", "banned_users", "email", True),
+    ("ix_banned_users_user_id", "banned_users", "user_id", True),
+    ("ix_virtual_machines_user_id", "virtual_machines", "user_id", False),
+    ("ix_virtual_machines_port", "virtual_machines", "port", True),
+]
+
+
+def existing_indexes(table):
+    """Get the names of the indexes already on a table, as db.create_all() creates them on new databases."""
+    inspector = sa.inspect(op.get_bind())
+    return {index["name"] for index in inspector.get_indexes(table)}
+
+
+def upgrade():
+    for name, table, column, unique in INDEXES:
+        if name not in existing_indexes(table):
+            op.create_index(name, table, [column], unique=unique)
+
+
+def downgrade():
+    for name, table, column, unique in reversed(INDEXES):
+        if name in existing_indexes(table):
+            op.drop_index(name, table_name=table)
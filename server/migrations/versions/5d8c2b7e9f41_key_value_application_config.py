@@ -0,0 +1,122 @@
+"""Store the settings changed by admins as typed, versioned key/value rows
+
+Revision ID: 5d8c2b7e9f41
+Revises: c41d7e9a2f58
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+import json
+from datetime import datetime, timezone
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d8c2b7e9f41'
+down_revision = 'c41d7e9a2f58'
+branch_labels = None
+depends_on = None
+
+# The settings kept by the key/value table, with their type in the old table
+SETTINGS = {
+    'CLIENT_URL': sa.String(length=255),
+    'KVM_ENABLED': sa.Boolean(),
+    'MAX_VM_CORES': sa.Integer(),
+    'MAX_VM_COUNT': sa.Integer(),
+    'MAX_VM_MEMORY': sa.Integer(),
+    'SSL_CERTIFICATE_PATH': sa.String(length=255),
+    'SSL_KEY_PATH': sa.String(length=255),
+    'VM_PORT_START': sa.Integer(),
+    'WEBSOCKET_PORT_START': sa.Integer(),
+    'WEBSOCKET_SSL_ENABLED': sa.Boolean(),
+}
+
+# The other columns of the old table, which nothing reads any more
+OLD_COLUMNS = {
+    'API_URL': sa.String(length=255),
+    'CORS_HEADERS': sa.String(length=255),
+    'GUNICORN_ACCESS_LOG': sa.String(length=255),
+    'GUNICORN_BIND_ADDRESS': sa.String(length=255),
+    'GUNICORN_ERROR_LOG': sa.String(length=255),
+    'GUNICORN_LOG_LEVEL': sa.String(length=255),
+    'GUNICORN_WORKER_CLASS': sa.String(length=255),
+    'ISO_DIR': sa.String(length=255),
+    'JWT_ACCESS_TOKEN_EXPIRES': sa.Interval(),
+    'JWT_COOKIE_CSRF_PROTECT': sa.Boolean(),
+    'JWT_COOKIE_SECURE': sa.Boolean(),
+    'JWT_REFRESH_TOKEN_EXPIRES': sa.Interval(),
+    'JWT_SECRET_KEY': sa.String(length=255),
+    'JWT_TOKEN_LOCATION': sa.String(length=255),
+    'MAIL_ASCII_ATTACHMENTS': sa.Boolean(),
+    'MAIL_DEFAULT_SENDER': sa.String(length=255),
+    'MAIL_MAX_EMAILS': sa.Integer(),
+    'MAIL_PASSWORD': sa.String(length=255),
+    'MAIL_PORT': sa.Integer(),
+    'MAIL_SERVER': sa.String(length=255),
+    'MAIL_USE_SSL': sa.Boolean(),
+    'MAIL_USE_TLS': sa.Boolean(),
+    'MAIL_USERNAME': sa.String(length=255),
+    'SECRET_KEY': sa.String(length=255),
+    'SQLALCHEMY_DATABASE_URI': sa.String(length=255),
+    'SQLALCHEMY_ECHO': sa.Boolean(),
+    'SQLALCHEMY_TRACK_MODIFICATIONS': sa.Boolean(),
+    'GUNICORN_SSL_ENABLED': sa.Boolean(),
+    'RATE_LIMIT': sa.String(length=255),
+}
+
+
+def upgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+
+    # Carry over the settings of the old wide table, which was created by db.create_all()
+    stored = {}
+    if inspector.has_table('application_config_db'):
+        columns = {column['name'] for column in inspector.get_columns('application_config_db')}
+        if 'key' in columns:
+            return
+        names = [name for name in SETTINGS if name in columns]
+        if names:
+            # Typed columns, so booleans come back as booleans rather than the database's integers
+            old_table = sa.table('application_config_db', sa.column('id'), *[sa.column(name, SETTINGS[name]) for name in names])
+            row = bind.execute(
+                sa.select(*[old_table.c[name] for name in names]).order_by(old_table.c.id).limit(1)
+            ).mappings().first()
+            if row:
+                stored = {name: row[name] for name in names if row[name] is not None}
+        op.drop_table('application_config_db')
+
+    table = op.create_table('application_config_db',
+    sa.Column('key', sa.String(length=80), nullable=False),
+    sa.Column('value', sa.Text(), nullable=True),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('updated', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('key')
+    )
+    op.create_index('ix_application_config_db_version', 'application_config_db', ['version'], unique=False)
+
+    if stored:
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        op.bulk_insert(table, [
+            {'key': name, 'value': json.dumps(value), 'version': 1, 'updated': now}
+            for name, value in stored.items()
+        ])
+
+
+def downgrade():
+    bind = op.get_bind()
+    settings = sa.table('application_config_db', sa.column('key'), sa.column('value'))
+    rows = bind.execute(sa.select(settings.c.key, settings.c.value)).all()
+    stored = {key: json.loads(value) for key, value in rows if key in SETTINGS and value is not None}
+
+    op.drop_index('ix_application_config_db_version', table_name='application_config_db')
+    op.drop_table('application_config_db')
+    table = op.create_table('application_config_db',
+    sa.Column('id', sa.Integer(), nullable=False),
+    *[sa.Column(name, column_type, nullable=True) for name, column_type in {**SETTINGS, **OLD_COLUMNS}.items()],
+    sa.PrimaryKeyConstraint('id')
+    )
+
+    if stored:
+        op.bulk_insert(table, [{'id': 1, **stored}])
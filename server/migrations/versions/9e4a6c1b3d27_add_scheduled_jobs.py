@@ -0,0 +1,41 @@
+"""Add a table for the periodic jobs, and index unverified users by when they registered
+
+Revision ID: 9e4a6c1b3d27
+Revises: 5d8c2b7e9f41
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9e4a6c1b3d27'
+down_revision = '5d8c2b7e9f41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    if 'ix_unverified_users_created' not in {index['name'] for index in inspector.get_indexes('unverified_users')}:
+        op.create_index('ix_unverified_users_created', 'unverified_users', ['created'], unique=False)
+
+    if inspector.has_table('scheduled_jobs'):
+        return
+    op.create_table('scheduled_jobs',
+    sa.Column('name', sa.String(length=80), nullable=False),
+    sa.Column('next_run', sa.DateTime(), nullable=False),
+    sa.Column('claimed_by', sa.String(length=32), nullable=True),
+    sa.Column('claimed_until', sa.DateTime(), nullable=True),
+    sa.Column('last_run', sa.DateTime(), nullable=True),
+    sa.Column('last_duration', sa.Float(), nullable=True),
+    sa.Column('last_result', sa.String(length=255), nullable=True),
+    sa.Column('last_error', sa.String(length=255), nullable=True),
+    sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    op.drop_table('scheduled_jobs')
+    op.drop_index('ix_unverified_users_created', table_name='unverified_users')
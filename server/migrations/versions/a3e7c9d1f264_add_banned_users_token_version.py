@@ -0,0 +1,33 @@
+"""Keep the token version of banned users, so tokens issued before a ban stay revoked after the unban
+
+Revision ID: a3e7c9d1f264
+Revises: f8c2d6e0a471
+Create Date: 2026-10-18 22:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3e7c9d1f264'
+down_revision = 'f8c2d6e0a471'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columns = {column["name"] for column in sa.inspect(op.get_bind()).get_columns("banned_users")}
+    if "token_version" in columns:
+        return
+    with op.batch_alter_table('banned_users', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('token_version', sa.Integer(), nullable=False, server_default='0'))
+
+    # Users banned before this have no version to carry over. Every user starts on 0, so starting them on 1 keeps the
+    # tokens of anyone who never had their role changed revoked after the unban.
+    op.execute(sa.table('banned_users', sa.column('token_version', sa.Integer)).update().values(token_version=1))
+
+
+def downgrade():
+    with op.batch_alter_table('banned_users', schema=None) as batch_op:
+        batch_op.drop_column('token_version')
@@ -0,0 +1,41 @@
+"""Drop the foreign key from banned users to users, since a banned user is moved out of the users table
+
+Revision ID: b7d3e5a9c142
+Revises: 9e4a6c1b3d27
+Create Date: 2026-10-18 18:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7d3e5a9c142'
+down_revision = '9e4a6c1b3d27'
+branch_labels = None
+depends_on = None
+
+# SQLite doesn't name the constraint, so batch mode names it by this convention to drop it
+NAMING_CONVENTION = {"fk": "fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s"}
+
+
+def upgrade():
+    bind = op.get_bind()
+    foreign_keys = [
+        foreign_key for foreign_key in sa.inspect(bind).get_foreign_keys('banned_users') if foreign_key['referred_table'] == 'users'
+    ]
+    if not foreign_keys:
+        return
+
+    if bind.dialect.name == 'sqlite':
+        with op.batch_alter_table('banned_users', schema=None, naming_convention=NAMING_CONVENTION) as batch_op:
+            batch_op.drop_constraint('fk_banned_users_user_id_users', type_='foreignkey')
+    else:
+        for foreign_key in foreign_keys:
+            op.drop_constraint(foreign_key['name'], 'banned_users', type_='foreignkey')
+
+
+def downgrade():
+    # The foreign key can't be restored while anyone is banned, as their user ids are no longer in the users table,
+    # and the previous revisions work without it
+    pass
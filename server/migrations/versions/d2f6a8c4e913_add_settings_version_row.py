@@ -0,0 +1,32 @@
+"""Add a row holding the newest settings version, which each save increments while holding its lock
+
+Revision ID: d2f6a8c4e913
+Revises: b7d3e5a9c142
+Create Date: 2026-10-18 19:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2f6a8c4e913'
+down_revision = 'b7d3e5a9c142'
+branch_labels = None
+depends_on = None
+
+VERSION_KEY = '_version'
+
+settings = sa.table('application_config_db', sa.column('key', sa.String), sa.column('version', sa.Integer))
+
+
+def upgrade():
+    bind = op.get_bind()
+    if bind.execute(sa.select(settings.c.key).where(settings.c.key == VERSION_KEY)).first():
+        return
+    version = bind.execute(sa.select(sa.func.max(settings.c.version))).scalar() or 0
+    op.bulk_insert(settings, [{'key': VERSION_KEY, 'version': version}])
+
+
+def downgrade():
+    op.execute(settings.delete().where(settings.c.key == VERSION_KEY))
@@ -0,0 +1,42 @@
+"""Add indexes for paging through the admin panel's user lists sorted by role or last login, and then by id
+
+Revision ID: e4a1b9d7c358
+Revises: d2f6a8c4e913
+Create Date: 2026-10-18 20:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4a1b9d7c358'
+down_revision = 'd2f6a8c4e913'
+branch_labels = None
+depends_on = None
+
+# (index name, table, sorted column), each followed by the id
+INDEXES = [
+    ("ix_users_role", "users", "role"),
+    ("ix_users_login_time", "users", "login_time"),
+    ("ix_banned_users_role", "banned_users", "role"),
+    ("ix_banned_users_login_time", "banned_users", "login_time"),
+]
+
+
+def existing_indexes(table):
+    """Get the names of the indexes already on a table, as db.create_all() creates them on new databases."""
+    inspector = sa.inspect(op.get_bind())
+    return {index["name"] for index in inspector.get_indexes(table)}
+
+
+def upgrade():
+    for name, table, column in INDEXES:
+        if name not in existing_indexes(table):
+            op.create_index(name, table, [column, "id"], unique=False)
+
+
+def downgrade():
+    for name, table, column in reversed(INDEXES):
+        if name in existing_indexes(table):
+            op.drop_index(name, table_name=table)
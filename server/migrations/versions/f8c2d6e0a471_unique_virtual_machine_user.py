@@ -0,0 +1,51 @@
+"""Allow one virtual machine per user in the database, so two requests booting at once can't both store theirs
+
+Revision ID: f8c2d6e0a471
+Revises: e4a1b9d7c358
+Create Date: 2026-10-18 21:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f8c2d6e0a471'
+down_revision = 'e4a1b9d7c358'
+branch_labels = None
+depends_on = None
+
+virtual_machines = sa.table('virtual_machines', sa.column('id', sa.Integer), sa.column('user_id', sa.String))
+
+
+def user_id_index():
+    """Get the index on virtual_machines.user_id, or None if there isn't one."""
+    indexes = sa.inspect(op.get_bind()).get_indexes('virtual_machines')
+    return next((index for index in indexes if index['name'] == 'ix_virtual_machines_user_id'), None)
+
+
+def delete_duplicates():
+    """Delete all but the newest virtual machine of each user.
+    MySQL can't delete from a table it selects from in a subquery, so the ids to keep are read from a derived table instead.
+    """
+    newest = sa.select(sa.func.max(virtual_machines.c.id).label('id')).group_by(virtual_machines.c.user_id).subquery('keep')
+    return virtual_machines.delete().where(virtual_machines.c.id.not_in(sa.select(newest.c.id)))
+
+
+def upgrade():
+    index = user_id_index()
+    if index and index['unique']:
+        return
+
+    # Keep only the newest virtual machine of a user with several, stored by requests that raced before this constraint.
+    # The server stops every virtual machine when it shuts down for the upgrade, so only the rows are left to remove.
+    op.execute(delete_duplicates())
+
+    if index:
+        op.drop_index('ix_virtual_machines_user_id', table_name='virtual_machines')
+    op.create_index('ix_virtual_machines_user_id', 'virtual_machines', ['user_id'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_virtual_machines_user_id', table_name='virtual_machines')
+    op.create_index('ix_virtual_machines_user_id', 'virtual_machines', ['user_id'], unique=False)
@@ -16,11 +16,115 @@
 
 import random
 import string
+import time
 from uuid import uuid4
 
+from flask import g, has_request_context, request
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
 
-db = SQLAlchemy()
+REPLICA_BIND_PREFIX = "replica_"  # Bind keys of the read replicas in SQLALCHEMY_BINDS
+STICKY_COOKIE = "db_primary_until"
+
+
+class RoutingSession(Session):
+    """Sends the queries of read-only endpoints to a read replica, and everything else to the primary.
+    Once the session has written, the rest of its queries go to the primary so it reads its own writes.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.reads_from_replica(clause):
+            replica = self.info.get("replica")
+            if replica is None:
+                # Stay on one replica for the whole session, so its reads are consistent with each other
+                replicas = [key for key in self._db.engines if key and key.startswith(REPLICA_BIND_PREFIX)]
+                if replicas:
+                    replica = self.info["replica"] = random.choice(replicas)
+            if replica is not None:
+                return self._db.engines[replica]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def reads_from_replica(self, clause):
+        """Check if a statement may run on a read replica
+
+        Args:
+            clause (ClauseElement): The statement
+
+        Returns:
+            bool: If the statement is a read by a read-only endpoint, in a session that hasn't written
+        """
+
+        return (
+            not self._flushing
+            and not self.info.get("wrote")
+            and clause is not None
+            and getattr(clause, "is_select", False)
+            and has_request_context()
+            and g.get("read_replica", False)
+        )
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def mark_flush_written(session, flush_context):
+    """Send the session's later reads to the primary, which has its changes"""
+
+    session.info["wrote"] = True
+
+
+@event.listens_for(RoutingSession, "do_orm_execute")
+def mark_statement_written(orm_execute_state):
+    """Send bulk inserts, updates and deletes, and the session's later reads, to the primary"""
+
+    if not orm_execute_state.is_select:
+        orm_execute_state.session.info["wrote"] = True
+
+
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+
+
+def read_only(view):
+    """Mark an endpoint as only reading from the database, so it may be served by a read replica.
+    Place it directly below the route decorator.
+
+    Args:
+        view (function): The endpoint
+
+    Returns:
+        function: The endpoint
+    """
+
+    view.read_only = True
+    return view
+
+
+def init_read_replicas(app, sticky_seconds):
+    """Route read-only endpoints to the read replicas in SQLALCHEMY_BINDS. After a request writes, the client's
+    requests go to the primary for sticky_seconds, so it reads its own writes while the replicas catch up.
+
+    Args:
+        app (Flask): The Flask app
+        sticky_seconds (float): Seconds a client reads from the primary after writing
+    """
+
+    if not any(key.startswith(REPLICA_BIND_PREFIX) for key in app.config.get("SQLALCHEMY_BINDS") or {}):
+        return
+
+    @app.before_request
+    def choose_database():
+        view = app.view_functions.get(request.endpoint)
+        try:
+            primary_until = float(request.cookies.get(STICKY_COOKIE, 0))
+        except ValueError:
+            primary_until = 0
+        g.read_replica = getattr(view, "read_only", False) and primary_until < time.time()
+
+    @app.after_request
+    def stick_to_primary(response):
+        if db.session.info.get("wrote"):
+            primary_until = time.time() + sticky_seconds
+            response.set_cookie(STICKY_COOKIE, f"{primary_until:.3f}", max_age=int(sticky_seconds) + 1, httponly=True, samesite="Lax")
+        return response
 
 
 def generate_uuid():
@@ -50,9 +154,9 @@ class UnverifiedUsers(db.Model):
 
     id = db.Column(db.String(32), primary_key=True, default=generate_uuid)
     username = db.Column(db.String(80), nullable=False, unique=True)
-    email = db.Column(db.String(80), nullable=False)
+    email = db.Column(db.String(80), nullable=False, unique=True, index=True)
     password = db.Column(db.String(80), nullable=False)
-    created = db.Column(db.DateTime, nullable=False)
+    created = db.Column(db.DateTime, nullable=False, index=True)  # Indexed for the job that deletes expired registrations
     unique_code = db.Column(db.String(6), nullable=False, default=generate_unique_code)
 
 
@@ -63,15 +167,22 @@ class Users(db.Model):
         db (SQLAlchemy): The SQLAlchemy object.
     """
 
+    # The admin panel's user lists are sorted by these columns and then the id, a page at a time
+    __table_args__ = (
+        db.Index("ix_users_role", "role", "id"),
+        db.Index("ix_users_login_time", "login_time", "id"),
+    )
+
     id = db.Column(db.String(32), primary_key=True, default=generate_uuid)
     username = db.Column(db.String(80), nullable=False, unique=True)
-    email = db.Column(db.String(80), nullable=False)
+    email = db.Column(db.String(80), nullable=False, unique=True, index=True)
     password = db.Column(db.String(80), nullable=False)
     login_time = db.Column(db.DateTime, nullable=True)
     ip = db.Column(db.String(80), nullable=True)
     role = db.Column(db.String(80), nullable=False)
     two_factor_enabled = db.Column(db.Boolean, nullable=False, default=False)
     two_factor_secret = db.Column(db.String(80), nullable=True)
+    token_version = db.Column(db.Integer, nullable=False, default=0, server_default="0")
     hard_drives = db.relationship("VirtualMachines", backref="user", lazy=True, primaryjoin="Users.id == VirtualMachines.user_id")
 
 
@@ -82,12 +193,16 @@ class BannedUsers(db.Model):
         db (SQLAlchemy): The SQLAlchemy object.
     """
 
+    # The admin panel's user lists are sorted by these columns and then the id, a page at a time
+    __table_args__ = (
+        db.Index("ix_banned_users_role", "role", "id"),
+        db.Index("ix_banned_users_login_time", "login_time", "id"),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.String(32), db.ForeignKey("users.id"), nullable=False)
-    username = db.Column(db.String(80), nullable=False, unique=True)
-    email = db.Column(db.String(80), nullable=False)
+    user_id = db.Column(db.String(32), nullable=False, unique=True, index=True)  # The id the user had, and gets back when unbanned
     username = db.Column(db.String(80), nullable=False, unique=True)
-    email = db.Column(db.String(80), nullable=False)
+    email = db.Column(db.String(80), nullable=False, unique=True, index=True)
     password = db.Column(db.String(80), nullable=False)
     login_time = db.Column(db.DateTime, nullable=True)
     ip = db.Column(db.String(80), nullable=True)
@@ -95,6 +210,7 @@ class BannedUsers(db.Model):
     two_factor_enabled = db.Column(db.Boolean, nullable=False, default=False)
     two_factor_secret = db.Column(db.String(80), nullable=True)
     ban_reason = db.Column(db.String(80), nullable=True)
+    token_version = db.Column(db.Integer, nullable=False, default=0, server_default="0")  # Carried back to the users table when unbanned
 
 
 class VirtualMachines(db.Model):
@@ -105,69 +221,62 @@ class VirtualMachines(db.Model):
     """
 
     id = db.Column(db.Integer, primary_key=True)
-    port = db.Column(db.Integer, nullable=False)
+    port = db.Column(db.Integer, nullable=False, unique=True, index=True)
     websocket_port = db.Column(db.Integer, nullable=False)
     iso = db.Column(db.String(80), nullable=False)
     websockify_process_id = db.Column(db.Integer, nullable=False)
     process_id = db.Column(db.Integer, nullable=False)
-    user_id = db.Column(db.String(32), db.ForeignKey("users.id"), nullable=False)
+    user_id = db.Column(db.String(32), db.ForeignKey("users.id"), nullable=False, unique=True, index=True)  # One per user
     log_file = db.Column(db.String(80), nullable=False)
     vnc_password = db.Column(db.String(80), nullable=True)
     hard_drive = db.Column(db.String(80), nullable=True)
 
 
-class ApplicationConfigDb(db.Model):
-    """Contains the configuration for the server. This overrides the .env file. Modify the values in the database to change the configuration."""
-
-    id = db.Column(db.Integer, primary_key=True)
-    API_URL = db.Column(db.String(255), nullable=True)
-    CLIENT_URL = db.Column(db.String(255), nullable=True)
-    CORS_HEADERS = db.Column(db.String(255), nullable=True)
-
-    GUNICORN_ACCESS_LOG = db.Column(db.String(255), nullable=True)
-    GUNICORN_BIND_ADDRESS = db.Column(db.String(255), nullable=True)
-    GUNICORN_ERROR_LOG = db.Column(db.String(255), nullable=True)
-    GUNICORN_LOG_LEVEL = db.Column(db.String(255), nullable=True)
-    GUNICORN_WORKER_CLASS = db.Column(db.String(255), nullable=True)
-
-    ISO_DIR = db.Column(db.String(255), nullable=True)
+class OutboundEmails(db.Model):
+    """Contains the database model for an email waiting to be sent by the background mail sender.
 
-    JWT_ACCESS_TOKEN_EXPIRES = db.Column(db.Interval, nullable=True)
-    JWT_COOKIE_CSRF_PROTECT = db.Column(db.Boolean, nullable=True)
-    JWT_COOKIE_SECURE = db.Column(db.Boolean, nullable=True)
-    JWT_REFRESH_TOKEN_EXPIRES = db.Column(db.Interval, nullable=True)
-    JWT_SECRET_KEY = db.Column(db.String(255), nullable=True)
-    JWT_TOKEN_LOCATION = db.Column(db.String(255), nullable=True)
+    Args:
+        db (SQLAlchemy): The SQLAlchemy object.
+    """
 
-    KVM_ENABLED = db.Column(db.Boolean, nullable=True)
+    id = db.Column(db.Integer, primary_key=True)
+    recipients = db.Column(db.Text, nullable=False)  # Comma separated
+    subject = db.Column(db.String(255), nullable=False)
+    html = db.Column(db.Text, nullable=False)
+    created = db.Column(db.DateTime, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt = db.Column(db.DateTime, nullable=False, index=True)
+    claimed_by = db.Column(db.String(32), nullable=True)
+    claimed_until = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.String(255), nullable=True)
 
-    MAIL_ASCII_ATTACHMENTS = db.Column(db.Boolean, nullable=True)
-    MAIL_DEFAULT_SENDER = db.Column(db.String(255), nullable=True)
-    MAIL_MAX_EMAILS = db.Column(db.Integer, nullable=True)
-    MAIL_PASSWORD = db.Column(db.String(255), nullable=True)
-    MAIL_PORT = db.Column(db.Integer, nullable=True)
-    MAIL_SERVER = db.Column(db.String(255), nullable=True)
-    MAIL_USE_SSL = db.Column(db.Boolean, nullable=True)
-    MAIL_USE_TLS = db.Column(db.Boolean, nullable=True)
-    MAIL_USERNAME = db.Column(db.String(255), nullable=True)
 
-    MAX_VM_CORES = db.Column(db.Integer, nullable=True)
-    MAX_VM_COUNT = db.Column(db.Integer, nullable=True)
-    MAX_VM_MEMORY = db.Column(db.Integer, nullable=True)
+class ScheduledJobs(db.Model):
+    """Contains when each periodic job next runs, and which worker holds it. A worker claims a due job by setting
+    claimed_until, so only one worker across the deployment runs it, and another takes over if that worker dies.
 
-    SECRET_KEY = db.Column(db.String(255), nullable=True)
+    Args:
+        db (SQLAlchemy): The SQLAlchemy object.
+    """
 
-    SQLALCHEMY_DATABASE_URI = db.Column(db.String(255), nullable=True)
-    SQLALCHEMY_ECHO = db.Column(db.Boolean, nullable=True)
-    SQLALCHEMY_TRACK_MODIFICATIONS = db.Column(db.Boolean, nullable=True)
+    name = db.Column(db.String(80), primary_key=True)
+    next_run = db.Column(db.DateTime, nullable=False)
+    claimed_by = db.Column(db.String(32), nullable=True)
+    claimed_until = db.Column(db.DateTime, nullable=True)
+    last_run = db.Column(db.DateTime, nullable=True)
+    last_duration = db.Column(db.Float, nullable=True)  # Seconds
+    last_result = db.Column(db.String(255), nullable=True)
+    last_error = db.Column(db.String(255), nullable=True)
 
-    WEBSOCKET_SSL_ENABLED = db.Column(db.Boolean, nullable=True)
-    GUNICORN_SSL_ENABLED = db.Column(db.Boolean, nullable=True)
 
-    SSL_CERTIFICATE_PATH = db.Column(db.String(255), nullable=True)
-    SSL_KEY_PATH = db.Column(db.String(255), nullable=True)
+class ApplicationConfigDb(db.Model):
+    """Contains the settings changed by admins, which override the .env file. The types and defaults are in settings.py.
 
-    RATE_LIMIT = db.Column(db.String(255), nullable=True)
+    Args:
+        db (SQLAlchemy): The SQLAlchemy object.
+    """
 
-    VM_PORT_START = db.Column(db.Integer, nullable=True)
-    WEBSOCKET_PORT_START = db.Column(db.Integer, nullable=True)
+    key = db.Column(db.String(80), primary_key=True)
+    value = db.Column(db.Text, nullable=True)  # JSON, or NULL to use the default
+    version = db.Column(db.Integer, nullable=False, default=0, index=True)  # The version of the settings this was last changed in
+    updated = db.Column(db.DateTime, nullable=True)
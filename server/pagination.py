@@ -0,0 +1,180 @@
+# pagination.py - Contains keyset pagination for the admin listings.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from sqlalchemy import DateTime, and_, or_
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+PAGINATION_ARGS = ("limit", "cursor", "sort", "order", "count")
+
+
+def wants_page(args):
+    """Check if the request asked for a page, rather than the whole table
+
+    Args:
+        args (MultiDict): The request's query string
+
+    Returns:
+        bool: If any pagination argument was given
+    """
+
+    return any(arg in args for arg in PAGINATION_ARGS)
+
+
+def encode_cursor(value, row_id):
+    """Encode the sort value and id of the last row on a page as an opaque cursor
+
+    Args:
+        value: The sort value of the row
+        row_id: The id of the row
+
+    Returns:
+        str: The cursor
+    """
+
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    return base64.urlsafe_b64encode(json.dumps([value, row_id]).encode("utf-8")).decode("utf-8")
+
+
+def decode_cursor(cursor, column):
+    """Decode a cursor into the sort value and id it was created from
+
+    Args:
+        cursor (str): The cursor
+        column (ColumnElement): The column the page is sorted by
+
+    Raises:
+        ValueError: If the cursor is malformed
+
+    Returns:
+        tuple: The sort value and the id
+    """
+
+    try:
+        value, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode("utf-8")))
+    except (binascii.Error, TypeError, UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError("Invalid cursor") from e
+
+    if value is not None and isinstance(column.type, DateTime):
+        value = datetime.fromisoformat(value)
+    return value, row_id
+
+
+def page_segment(query, column, id_column, descending, null_segment, cursor, limit):
+    """Get the rows of a page from either the NULLs of the sort column or its values, continuing from a cursor
+
+    Args:
+        query (Query): The filtered query to paginate
+        column (ColumnElement): The column the page is sorted by
+        id_column (Column): The primary key of the queried table
+        descending (bool): If the page is sorted in descending order
+        null_segment (bool): If the rows where the column is NULL are wanted, rather than those with a value
+        cursor (tuple): The sort value and id of the last row of the previous page, or None to start from the beginning
+        limit (int): The number of rows to get
+
+    Returns:
+        list: The rows, each with its sort value
+    """
+
+    if null_segment:
+        query = query.filter(column.is_(None))
+        if cursor:
+            query = query.filter(id_column < cursor[1] if descending else id_column > cursor[1])
+        order = [id_column.desc() if descending else id_column.asc()]
+    else:
+        if getattr(column, "nullable", False):
+            query = query.filter(column.isnot(None))
+        if cursor:
+            value, row_id = cursor
+            if descending:
+                query = query.filter(or_(column < value, and_(column == value, id_column < row_id)))
+            else:
+                query = query.filter(or_(column > value, and_(column == value, id_column > row_id)))
+        order = [column.desc(), id_column.desc()] if descending else [column.asc(), id_column.asc()]
+
+    return query.order_by(*order).add_columns(column).limit(limit).all()
+
+
+def paginate(query, id_column, sort_columns, default_sort, args):
+    """Get one page of a query, ordered by a sort column and then the id so every row has a stable position.
+    Pages after the first continue from the cursor of the previous one instead of using OFFSET, so each page costs the same.
+
+    Args:
+        query (Query): The filtered query to paginate
+        id_column (Column): The primary key of the queried table
+        sort_columns (dict): The columns the page may be sorted by, keyed by name
+        default_sort (str): The name of the column to sort by if none is given
+        args (MultiDict): The request's query string
+
+    Raises:
+        ValueError: If the pagination arguments are invalid
+
+    Returns:
+        dict: The rows on the page, the cursor of the next page and, if asked for, the total number of rows
+    """
+
+    sort = args.get("sort", default_sort)
+    if sort not in sort_columns:
+        raise ValueError(f"Cannot sort by {sort}")
+    column = sort_columns[sort]
+
+    order = args.get("order", "asc")
+    if order not in ("asc", "desc"):
+        raise ValueError("Order must be asc or desc")
+    descending = order == "desc"
+
+    limit = args.get("limit", DEFAULT_PAGE_SIZE, type=int)
+    if limit is None or limit < 1:
+        raise ValueError("Limit must be a positive integer")
+    limit = min(limit, MAX_PAGE_SIZE)
+
+    page = {}
+    if args.get("count", "false").lower() == "true":
+        page["total"] = query.order_by(None).count()
+
+    # A nullable column is paged through its NULLs and its values separately, NULLs first ascending and last descending.
+    # Databases disagree on where NULLs sort, and a filter on IS NULL can use the column's index where coalesce can't.
+    segments = [False]
+    if getattr(column, "nullable", False):
+        segments = [True, False] if not descending else [False, True]
+
+    cursor = None
+    if args.get("cursor"):
+        cursor = decode_cursor(args["cursor"], column)
+        if len(segments) > 1:
+            segments = segments[segments.index(cursor[0] is None) :]
+
+    rows = []
+    for null_segment in segments:
+        rows += page_segment(query, column, id_column, descending, null_segment, cursor, limit + 1 - len(rows))
+        cursor = None
+        if len(rows) > limit:
+            break
+
+    page["next_cursor"] = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last, last_value = rows[-1]
+        page["next_cursor"] = encode_cursor(last_value, getattr(last, id_column.key))
+
+    page["items"] = [row for row, _ in rows]
+    return page
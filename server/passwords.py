@@ -0,0 +1,166 @@
+# passwords.py - Hashes and verifies passwords with bcrypt in a bounded process pool.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+from config import ApplicationConfig
+from flask import jsonify
+from gevent_support import is_gevent_patched, run_in_threadpool
+
+LOG_ROUNDS = ApplicationConfig.BCRYPT_LOG_ROUNDS
+# Every gunicorn worker has a pool of its own, so by default the CPU cores are shared between them rather than each taking all
+POOL_SIZE = ApplicationConfig.BCRYPT_POOL_SIZE or max(1, os.cpu_count() // ApplicationConfig.GUNICORN_WORKERS)
+MAX_PENDING = ApplicationConfig.BCRYPT_MAX_PENDING or POOL_SIZE * 4
+TIMEOUT = 30  # Seconds to wait for a free slot, and then for the hash itself
+RETRY_AFTER = 5  # Seconds a client that was refused is asked to wait before trying again
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_pending = threading.BoundedSemaphore(MAX_PENDING)
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when too many passwords are already waiting to be hashed or checked, or one took too long."""
+
+
+def busy_response(error):
+    """Respond to a request that could not hash or check a password because the pool is full
+
+    Returns:
+        json: Message
+    """
+
+    return jsonify({"message": "The server is busy. Please try again later."}), 503, {"Retry-After": str(RETRY_AFTER)}
+
+
+def _hash(password, rounds):
+    """Hash a password in a pool process."""
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds)).decode("utf-8")
+
+
+def _check(pw_hash, password):
+    """Check a password in a pool process."""
+    return bcrypt.checkpw(password.encode("utf-8"), pw_hash.encode("utf-8"))
+
+
+def _pool_context():
+    """Get the way pool processes are started. Forking a worker that runs other threads can copy a lock one of them holds,
+    and deadlock the child, so they are started from a clean forkserver process instead, or spawned where there is none.
+    Either way they import the __main__ module, so start the app with gunicorn or flask run rather than running app.py.
+
+    Returns:
+        BaseContext: The multiprocessing context
+    """
+
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+
+    # Only this module is loaded into the forkserver, not the app it was started from, which would run its set up again
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload([__name__])
+    return context
+
+
+def _get_pool():
+    """Get the process pool, creating it on first use in each gunicorn worker rather than in the master before forking
+
+    Returns:
+        ProcessPoolExecutor: The process pool
+    """
+
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(max_workers=POOL_SIZE, mp_context=_pool_context())
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def _run(fn, *args):
+    """Run a bcrypt function in the process pool, or a thread pool under gevent, refusing the work if the pool already has too much queued
+
+    Raises:
+        PasswordHasherBusy: If no slot became free in time, or the pool did not finish the work in time
+
+    Returns:
+        The result of the function
+    """
+
+    if not _pending.acquire(timeout=TIMEOUT):
+        raise PasswordHasherBusy()
+    try:
+        # Under gevent a process pool doesn't mix with monkey patching, but bcrypt releases the GIL so native threads work as well
+        if is_gevent_patched():
+            return run_in_threadpool(POOL_SIZE, fn, *args, timeout=TIMEOUT)
+        future = _get_pool().submit(fn, *args)
+        try:
+            return future.result(timeout=TIMEOUT)
+        except TimeoutError:
+            # Don't leave the work queued for a request that has given up on it
+            future.cancel()
+            raise
+    except TimeoutError as e:
+        raise PasswordHasherBusy() from e
+    finally:
+        _pending.release()
+
+
+def hash_password(password):
+    """Hash a password with the configured work factor
+
+    Args:
+        password (str): The password to hash
+
+    Returns:
+        str: The bcrypt hash
+    """
+
+    return _run(_hash, password, LOG_ROUNDS)
+
+
+def check_password(pw_hash, password):
+    """Check a password against a bcrypt hash
+
+    Args:
+        pw_hash (str): The bcrypt hash
+        password (str): The password to check
+
+    Returns:
+        bool: If the password matches
+    """
+
+    return _run(_check, pw_hash, password)
+
+
+def needs_rehash(pw_hash):
+    """Check if a hash was made with a different work factor than the one configured
+
+    Args:
+        pw_hash (str): The bcrypt hash, i.e. $2b$12$...
+
+    Returns:
+        bool: If the password should be hashed again
+    """
+
+    try:
+        return int(pw_hash.split("$")[2]) != LOG_ROUNDS
+    except (IndexError, ValueError):
+        return True
@@ -0,0 +1,96 @@
+# query_log.py - Logs slow SQL queries and holds each endpoint to a budget of queries per request.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import threading
+import time
+
+from config import ApplicationConfig
+from flask import g, has_request_context, jsonify, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+SLOW_QUERY_THRESHOLD = ApplicationConfig.SLOW_QUERY_THRESHOLD  # Milliseconds before a query is logged, 0 turns the log off
+MAX_STATEMENT_LENGTH = 1000
+
+
+def query_budget(count):
+    """Declare the most SQL queries an endpoint may run per request. Place it directly below the route decorator.
+    Going over is logged, and fails the request when QUERY_BUDGET_ENFORCE is set or the app is testing.
+
+    Args:
+        count (int): The number of queries
+
+    Returns:
+        function: The decorator
+    """
+
+    def decorator(view):
+        view.query_budget = count
+        return view
+
+    return decorator
+
+
+def init_query_log(app):
+    """Time every SQL query, log the slow ones with the endpoint or thread that ran them, and count queries per request
+
+    Args:
+        app (Flask): The Flask app
+    """
+
+    enforce = ApplicationConfig.QUERY_BUDGET_ENFORCE or app.testing
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._query_start = time.perf_counter()
+        if has_request_context():
+            g.query_count = g.get("query_count", 0) + 1
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_query_start", None)
+        if start is None or SLOW_QUERY_THRESHOLD <= 0:
+            return
+        elapsed = (time.perf_counter() - start) * 1000
+        if elapsed >= SLOW_QUERY_THRESHOLD:
+            caller = request.endpoint if has_request_context() else threading.current_thread().name
+            app.logger.warning("Slow query (%.1f ms) in %s: %s", elapsed, caller, statement[:MAX_STATEMENT_LENGTH])
+
+    event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+
+    @app.before_request
+    def reset_query_count():
+        # g belongs to the app context, which a test client or a copied context can keep across requests
+        g.query_count = 0
+
+    @app.after_request
+    def check_query_budget(response):
+        view = app.view_functions.get(request.endpoint)
+        budget = getattr(view, "query_budget", None)
+        count = g.get("query_count", 0)
+        if enforce:
+            response.headers["X-Query-Count"] = str(count)
+        if budget is None or count <= budget:
+            return response
+
+        app.logger.warning("%s ran %d queries, over its budget of %d", request.endpoint, count, budget)
+        if not enforce:
+            return response
+
+        # Fail the request, so the regression is caught before it reaches production
+        failure = jsonify({"message": f"{request.endpoint} ran {count} queries, over its budget of {budget}"})
+        failure.status_code = 500
+        return failure
@@ -0,0 +1,92 @@
+# rate_limits.py - Contains the rate limiter, its keys and the cost of expensive endpoints.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from flask import request
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+from settings import current_settings
+
+# How many requests each endpoint counts as against RATE_LIMIT, so a burst of logins or VM creations runs out sooner than a burst of cheap reads
+REQUEST_COSTS = {
+    "user_endpoints.login": 5,
+    "user_endpoints.register": 5,
+    "vm.create_vm": 10,
+}
+
+
+def user_or_ip_key():
+    """Key a request by the id of the user making it, or by their IP address if they are not logged in.
+    Users behind the same NAT, i.e. a university lab, then don't share one limit.
+
+    Returns:
+        str: The key
+    """
+
+    try:
+        verify_jwt_in_request(optional=True)
+        user_id = get_jwt_identity()
+    except Exception:
+        # An expired, revoked or malformed token is rejected by the endpoint itself
+        user_id = None
+
+    if user_id:
+        return "user:" + str(user_id)
+    return "ip:" + get_remote_address()
+
+
+def ip_key():
+    """Key a request by the IP address it came from
+
+    Returns:
+        str: The key
+    """
+
+    return "ip:" + get_remote_address()
+
+
+def hypervisor_key():
+    """Key every request the same, for limits shared by the whole server
+
+    Returns:
+        str: The key
+    """
+
+    return "hypervisor"
+
+
+def rate_limit():
+    """Get the limit on requests to each blueprint, from the current settings
+
+    Returns:
+        str: The limit, i.e. "100/minute", or an empty string for no limit
+    """
+
+    return current_settings().RATE_LIMIT or ""
+
+
+def request_cost():
+    """Get how many requests the current request counts as
+
+    Returns:
+        int: The cost
+    """
+
+    return REQUEST_COSTS.get(request.endpoint, 1)
+
+
+# Storage, strategy and fallback are read from the RATELIMIT_* settings in ApplicationConfig by init_app
+limiter = Limiter(user_or_ip_key)
@@ -14,19 +14,52 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import json
+import csv
+import io
 import re
 import subprocess
 
-from flask import Blueprint, jsonify, request
-from flask_bcrypt import Bcrypt
-from flask_jwt_extended import get_jwt_identity, jwt_required
-from models import BannedUsers, UnverifiedUsers, Users, VirtualMachines, db
-from password_strength import PasswordPolicy
-from config import ApplicationConfig
+from flask import Blueprint, Response, current_app, jsonify, request, stream_with_context
+from auth import admin_required, forget_token_versions, revoke_user_tokens
+from catalog import get_catalog
+from db_pool import pool_stats
+from identity import ACTIVE, BANNED, find_identities
+from models import BannedUsers, UnverifiedUsers, Users, VirtualMachines, db, read_only
+from pagination import paginate, wants_page
+from query_log import query_budget
+from scheduler import describe_jobs, scheduled_jobs
+from vm_logs import log_usage
+from sqlalchemy import delete, false, insert, literal, or_, select, update
 
 admin_endpoints = Blueprint("admin", __name__)
-Bcrypt = Bcrypt()
+
+# Number of rows fetched from the database and written to the response at a time when exporting
+EXPORT_BATCH_SIZE = 1000
+
+# Columns the admin listings can be sorted by
+VM_SORT_COLUMNS = {
+    "id": VirtualMachines.id,
+    "port": VirtualMachines.port,
+    "iso": VirtualMachines.iso,
+    "user_id": VirtualMachines.user_id,
+}
+USER_SORT_COLUMNS = {
+    "username": Users.username,
+    "email": Users.email,
+    "role": Users.role,
+    "login_time": Users.login_time,
+}
+BANNED_USER_SORT_COLUMNS = {
+    "username": BannedUsers.username,
+    "email": BannedUsers.email,
+    "role": BannedUsers.role,
+    "login_time": BannedUsers.login_time,
+}
+UNVERIFIED_USER_SORT_COLUMNS = {
+    "username": UnverifiedUsers.username,
+    "email": UnverifiedUsers.email,
+    "created": UnverifiedUsers.created,
+}
 
 
 def is_valid_username(username):
@@ -55,72 +88,254 @@ def is_valid_email(email):
     return re.match(r"[^@]+@[^@]+\.[^@]+", email)
 
 
-# Check passwords on the back-end and on the front-end just in case
-policy = PasswordPolicy.from_names(
-    length=8,
-    uppercase=1,
-    numbers=2,
-    special=1,
-    nonletters=2,
-)
+def filter_users(model):
+    """Filter a user table by the username or email prefix and role given in the request's query string
+
+    Args:
+        model (db.Model): The user table to filter
+
+    Returns:
+        Query: The filtered query
+    """
+
+    query = model.query
+    search = request.args.get("search")
+    if search:
+        query = query.filter(or_(model.username.startswith(search, autoescape=True), model.email.startswith(search, autoescape=True)))
+    if request.args.get("role") and hasattr(model, "role"):
+        query = query.filter_by(role=request.args["role"])
+    return query
+
+
+def filter_vms(query):
+    """Filter virtual machines by the user and ISO given in the request's query string
+
+    Args:
+        query (Query): The query to filter
+
+    Returns:
+        Query: The filtered query
+    """
+
+    if request.args.get("user_id"):
+        query = query.filter_by(user_id=request.args["user_id"])
+    if request.args.get("iso"):
+        query = query.filter_by(iso=request.args["iso"])
+    return query
+
+
+def serialize_user(user):
+    """Convert a user into a dictionary for the admin panel
+
+    Args:
+        user (Users): The user
+
+    Returns:
+        dict: The user
+    """
+
+    return {
+        "id": user.id,
+        "username": user.username,
+        "email": user.email,
+        "role": user.role,
+        "login_time": user.login_time,
+        "ip": user.ip,
+    }
+
+
+def serialize_banned_user(banned_user):
+    """Convert a banned user into a dictionary for the admin panel
+
+    Args:
+        banned_user (BannedUsers): The banned user
+
+    Returns:
+        dict: The banned user
+    """
+
+    return {
+        "id": banned_user.id,
+        "user_id": banned_user.user_id,
+        "username": banned_user.username,
+        "email": banned_user.email,
+        "login_time": banned_user.login_time,
+        "ip": banned_user.ip,
+        "role": banned_user.role,
+        "ban_reason": banned_user.ban_reason,
+        "two_factor_enabled": banned_user.two_factor_enabled,
+    }
+
+
+def serialize_unverified_user(unverified_user):
+    """Convert an unverified user into a dictionary for the admin panel
+
+    Args:
+        unverified_user (UnverifiedUsers): The unverified user
+
+    Returns:
+        dict: The unverified user
+    """
+
+    return {
+        "id": unverified_user.id,
+        "username": unverified_user.username,
+        "email": unverified_user.email,
+    }
+
+
+def serialize_vm(vm, isos):
+    """Convert a virtual machine into a dictionary for the admin panel
+
+    Args:
+        vm (VirtualMachines): The virtual machine
+        isos (dict): The ISO index keyed by file name, from the catalog
+
+    Returns:
+        dict: The virtual machine
+    """
+
+    iso = isos.get(vm.iso, {})
+    return {
+        "id": vm.id,
+        "port": vm.port,
+        "wsport": vm.websocket_port,
+        "iso": vm.iso,
+        "process_id": vm.process_id,
+        "user_id": vm.user_id,
+        "name": iso.get("name"),
+        "version": iso.get("version"),
+        "desktop": iso.get("desktop"),
+    }
+
+
+def list_response(query, id_column, sort_columns, default_sort, serialize, empty_message):
+    """Respond with one keyset-paginated page of a listing if the request asks for one, or with every row otherwise
+
+    Args:
+        query (Query): The filtered query to list
+        id_column (Column): The primary key of the queried table
+        sort_columns (dict): The columns the listing may be sorted by, keyed by name
+        default_sort (str): The name of the column to sort by if none is given
+        serialize (function): Converts a row into a dictionary
+        empty_message (str): The message to return if there are no rows and no page was asked for
+
+    Returns:
+        json: The page, or the list of rows
+    """
+
+    if wants_page(request.args):
+        try:
+            page = paginate(query, id_column, sort_columns, default_sort, request.args)
+        except ValueError as e:
+            return jsonify({"message": str(e)}), 400
+
+        page["items"] = [serialize(row) for row in page["items"]]
+        return jsonify(page), 200
+
+    rows = query.all()
+    if not rows:
+        return jsonify({"message": empty_message}), 404
+
+    return jsonify([serialize(row) for row in rows]), 200
+
+
+def export_response(query, id_column, serialize, fields, name):
+    """Stream every row of a query as NDJSON or CSV, depending on the format in the request's query string.
+    Rows are fetched from the database in batches, so memory use does not grow with the size of the table.
+
+    Args:
+        query (Query): The filtered query to export
+        id_column (Column): The primary key of the queried table
+        serialize (function): Converts a row into a dictionary
+        fields (list): The keys of the dictionaries, used as the CSV header
+        name (str): The name of the downloaded file, without an extension
+
+    Returns:
+        Response: The streamed export
+    """
+
+    export_format = request.args.get("format", "ndjson")
+    if export_format not in ("ndjson", "csv"):
+        return jsonify({"message": "Format must be ndjson or csv"}), 400
+
+    rows = query.order_by(id_column).yield_per(EXPORT_BATCH_SIZE)
+
+    def generate_ndjson():
+        batch = []
+        for row in rows:
+            batch.append(current_app.json.dumps(serialize(row)) + "\n")
+            if len(batch) >= EXPORT_BATCH_SIZE:
+                yield "".join(batch)
+                batch = []
+        yield "".join(batch)
+
+    def generate_csv():
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=fields)
+        writer.writeheader()
+        for count, row in enumerate(rows, start=1):
+            writer.writerow(serialize(row))
+            if count % EXPORT_BATCH_SIZE == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    if export_format == "csv":
+        generate, mimetype = generate_csv, "text/csv"
+    else:
+        generate, mimetype = generate_ndjson, "application/x-ndjson"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename={name}.{export_format}"},
+    )
 
 
 @admin_endpoints.route("/api/admin/vm/all/", methods=["GET"])
-@jwt_required()
+@read_only
+@query_budget(3)
+@admin_required()
 def get_all_vm():
-    """Get all virtual machines
+    """Get all virtual machines, optionally one page at a time and filtered by user or ISO
 
     Returns:
         json: List of virtual machines
     """
 
-    # Get the user from the authorization token
-    user = Users.query.filter_by(id=get_jwt_identity()).first()
-    if not user:
-        return jsonify({"message": "Invalid user"}), 401
+    # Get the name of the operating system, version and desktop environment
+    isos = get_catalog()["isos"]
 
-    # Ensure the user is an admin
-    if user.role != "admin":
-        return jsonify({"message": "Insufficient permissions"}), 403
+    return list_response(
+        filter_vms(VirtualMachines.query), VirtualMachines.id, VM_SORT_COLUMNS, "id", lambda vm: serialize_vm(vm, isos), "No virtual machines"
+    )
 
-    # Get all virtual machines
-    vms = VirtualMachines.query.all()
-    if not vms:
-        return jsonify({"message": "No virtual machines"}), 404
 
-    name = None
-    version = None
-    desktop = None
+@admin_endpoints.route("/api/admin/vm/export/", methods=["GET"])
+@read_only
+@admin_required()
+def export_vms():
+    """Export every virtual machine, optionally filtered by user or ISO, as NDJSON or CSV
 
-    # Get the name of the operating system, version and desktop environment
-    with open(f"{ApplicationConfig.ISO_DIR}/index.json") as f:
-        data = json.load(f)
-        for iso in data:
-            if iso["iso"] == vms[0].iso:
-                name = iso["name"]
-                version = iso["version"]
-                desktop = iso["desktop"]
-                break
-
-    vms_list = []
-    for vm in vms:
-        vms_list.append({
-            "id": vm.id,
-            "port": vm.port,
-            "wsport": vm.wsport,
-            "iso": vm.iso,
-            "process_id": vm.process_id,
-            "user_id": vm.user_id,
-            "name": name,
-            "version": version,
-            "desktop": desktop,
-        })
-
-    return jsonify(vms_list), 200
+    Returns:
+        Response: Streamed list of virtual machines
+    """
+
+    isos = get_catalog()["isos"]
+
+    return export_response(
+        filter_vms(VirtualMachines.query),
+        VirtualMachines.id,
+        lambda vm: serialize_vm(vm, isos),
+        ["id", "port", "wsport", "iso", "process_id", "user_id", "name", "version", "desktop"],
+        "virtual-machines",
+    )
 
 
 @admin_endpoints.route("/api/admin/vm/delete/", methods=["DELETE"])
-@jwt_required()
+@admin_required()
 def delete_vm_by_id():
     """Stop virtual machine by id
 
@@ -128,15 +343,6 @@ def delete_vm_by_id():
         json: Message
     """
 
-    # Get the user from the authorization token
-    user = Users.query.filter_by(id=get_jwt_identity()).first()
-    if not user:
-        return jsonify({"message": "Invalid user"}), 401
-
-    # Ensure the user is an admin
-    if user.role != "admin":
-        return jsonify({"message": "Insufficient permissions"}), 403
-
     # Get the virtual machine id from the request
     data = request.get_json()
     if not data or "vm_id" not in data:
@@ -162,44 +368,34 @@ def delete_vm_by_id():
 
 # Get all users
 @admin_endpoints.route("/api/admin/user/all/", methods=["GET"])
-@jwt_required()
+@read_only
+@query_budget(3)
+@admin_required()
 def get_all_users():
-    """Get all users
+    """Get all users, optionally one page at a time and filtered by a username or email prefix and role
 
     Returns:
         json: List of users
     """
 
-    # Get the user from the authorization token
-    user = Users.query.filter_by(id=get_jwt_identity()).first()
-    if not user:
-        return jsonify({"message": "Invalid user"}), 401
+    return list_response(filter_users(Users), Users.id, USER_SORT_COLUMNS, "username", serialize_user, "No users")
 
-    # Ensure the user is an admin
-    if user.role != "admin":
-        return jsonify({"message": "Insufficient permissions"}), 403
 
-    # Get all users
-    users = Users.query.all()
-    if not users:
-        return jsonify({"message": "No users"}), 404
+@admin_endpoints.route("/api/admin/user/export/", methods=["GET"])
+@read_only
+@admin_required()
+def export_users():
+    """Export every user, optionally filtered by a username or email prefix and role, as NDJSON or CSV
 
-    users_list = []
-    for user in users:
-        users_list.append({
-            "id": user.id,
-            "username": user.username,
-            "email": user.email,
-            "role": user.role,
-            "login_time": user.login_time,
-            "ip": user.ip,
-        })
+    Returns:
+        Response: Streamed list of users
+    """
 
-    return jsonify(users_list), 200
+    return export_response(filter_users(Users), Users.id, serialize_user, ["id", "username", "email", "role", "login_time", "ip"], "users")
 
 
 @admin_endpoints.route("/api/admin/user/delete/", methods=["DELETE"])
-@jwt_required()
+@admin_required()
 def delete_user_by_id():
     """Delete user by id
 
@@ -207,15 +403,6 @@ def delete_user_by_id():
         json: Message
     """
 
-    # Get the user from the authorization token
-    user = Users.query.filter_by(id=get_jwt_identity()).first()
-    if not user:
-        return jsonify({"message": "Invalid user"}), 401
-
-    # Ensure the user is an admin
-    if user.role != "admin":
-        return jsonify({"message": "Insufficient permissions"}), 403
-
     # Get the user id from the request
     data = request.get_json()
     if not data or "user_id" not in data:
@@ -245,6 +432,7 @@ def delete_user_by_id():
         except subprocess.CalledProcessError:
             return jsonify({"message": "Error deleting virtual machine"}), 500
 
+    revoke_user_tokens(user_to_delete, removed=True)
     db.session.delete(user_to_delete)
     db.session.commit()
 
@@ -252,7 +440,7 @@ def delete_user_by_id():
 
 
 @admin_endpoints.route("/api/admin/user/role/", methods=["PUT"])
-@jwt_required()
+@admin_required()
 def change_user_role():
     """Change the role of the user
 
@@ -260,15 +448,6 @@ def change_user_role():
         json: Message
     """
 
-    # Get the user from the authorization token
-    user = Users.query.filter_by(id=get_jwt_identity()).first()
-    if not user:
-        return jsonify({"message": "Invalid user"}), 401
-
-    # Ensure the user is an admin
-    if user.role != "admin":
-        return jsonify({"message": "Insufficient permissions"}), 403
-
     # Get the user id from the request
     data = request.get_json()
     if not data or "user_id" not in data or "role" not in data:
@@ -285,7 +464,9 @@ def change_user_role():
             403,
         )
 
+    # Revoke their tokens, so the new role takes effect the next time they log in
     user_to_change.role = data["role"]
+    revoke_user_tokens(user_to_change)
 
     db.session.commit()
 
@@ -293,7 +474,7 @@ def change_user_role():
 
 
 @admin_endpoints.route("/api/admin/user/username/", methods=["PUT"])
-@jwt_required()
+@admin_required()
 def change_user_username():
     """Change the username of the user
 
@@ -301,15 +482,6 @@ def change_user_username():
         json: Message
     """
 
-    # Get the user from the authorization token
-    user = Users.query.filter_by(id=get_jwt_identity()).first()
-    if not user:
-        return jsonify({"message": "Invalid user"}), 401
-
-    # Ensure the user is an admin
-    if user.role != "admin":
-        return jsonify({"message": "Insufficient permissions"}), 403
-
     # Get the user id from the request
     data = request.get_json()
     if not data or "user_id" not in data or "username" not in data:
@@ -320,14 +492,8 @@ def change_user_username():
     if not user_to_change:
         return jsonify({"message": "Invalid user"}), 404
 
-    # Check if the username is already taken in the users table
-    username_exists = Users.query.filter_by(username=data["username"]).first()
-    if username_exists:
-        return jsonify({"message": "Username already taken"}), 400
-
-    # Check if the username is already taken in the banned users table
-    username_exists = BannedUsers.query.filter_by(username=data["username"]).first()
-    if username_exists:
+    # Check if the username is already taken in the users or banned users tables
+    if find_identities(usernames=[data["username"]], states=(ACTIVE, BANNED)):
         return jsonify({"message": "Username already taken"}), 400
 
     # Check if the username is a valid format
@@ -342,7 +508,7 @@ def change_user_username():
 
 
 @admin_endpoints.route("/api/admin/user/email/", methods=["PUT"])
-@jwt_required()
+@admin_required()
 def change_user_email():
     """Change the email of the user
 
@@ -350,15 +516,6 @@ def change_user_email():
         json: Message
     """
 
-    # Get the user from the authorization token
-    user = Users.query.filter_by(id=get_jwt_identity()).first()
-    if not user:
-        return jsonify({"message": "Invalid user"}), 401
-
-    # Ensure the user is an admin
-    if user.role != "admin":
-        return jsonify({"message": "Insufficient permissions"}), 403
-
     # Get the user id from the request
     data = request.get_json()
     if not data or "user_id" not in data or "email" not in data:
@@ -369,14 +526,8 @@ def change_user_email():
     if not user_to_change:
         return jsonify({"message": "Invalid user"}), 404
 
-    # Check if the email is already taken
-    email_exists = Users.query.filter_by(email=data["email"]).first()
-    if email_exists:
-        return jsonify({"message": "Email already taken"}), 400
-
-    # Check if the email is already taken in the banned users table
-    email_exists = BannedUsers.query.filter_by(email=data["email"]).first()
-    if email_exists:
+    # Check if the email is already taken in the users or banned users tables
+    if find_identities(emails=[data["email"]], states=(ACTIVE, BANNED)):
         return jsonify({"message": "Email already taken"}), 400
 
     # Check if the email is valid
@@ -392,7 +543,8 @@ def change_user_email():
 
 # Get all virtual machines for a user
 @admin_endpoints.route("/api/admin/user/vm/", methods=["GET"])
-@jwt_required()
+@read_only
+@admin_required()
 def get_user_vms():
     """Get all virtual machines for a user
 
@@ -400,15 +552,6 @@ def get_user_vms():
         json: List of virtual machines
     """
 
-    # Get the user from the authorization token
-    admin = Users.query.filter_by(id=get_jwt_identity()).first()
-    if not admin:
-        return jsonify({"message": "Invalid user"}), 401
-
-    # Ensure the user is an admin
-    if admin.role != "admin":
-        return jsonify({"message": "Insufficient permissions"}), 403
-
     # Get the user id from the request
     data = request.get_json()
     if not data or "user_id" not in data:
@@ -424,22 +567,12 @@ def get_user_vms():
     if not vms:
         return jsonify({"message": "No virtual machines"}), 404
 
-    vms_list = []
-    for vm in vms:
-        vms_list.append({
-            "id": vm.id,
-            "port": vm.port,
-            "wsport": vm.wsport,
-            "iso": vm.iso,
-            "process_id": vm.process_id,
-            "user_id": vm.user_id,
-        })
-
-    return jsonify(vms_list), 200
+    isos = get_catalog()["isos"]
+    return jsonify([serialize_vm(vm, isos) for vm in vms]), 200
 
 
 @admin_endpoints.route("/api/admin/user/ban/", methods=["PUT"])
-@jwt_required()
+@admin_required()
 def ban_user():
     """Ban a user with an optional reason
 
@@ -447,15 +580,6 @@ def ban_user():
         json: Message
     """
 
-    # Get the user from the authorization token
-    admin = Users.query.filter_by(id=get_jwt_identity()).first()
-    if not admin:
-        return jsonify({"message": "Invalid user"}), 401
-
-    # Ensure the user is an admin
-    if admin.role != "admin":
-        return jsonify({"message": "Insufficient permissions"}), 403
-
     # Get the user id from the request
     data = request.get_json()
     if not data or "user_id" not in data:
@@ -498,6 +622,9 @@ def ban_user():
         two_factor_secret=user.two_factor_secret,
     )
 
+    # Tokens issued before the ban stay revoked once the user is unbanned
+    revoke_user_tokens(user, removed=True)
+    banned_user.token_version = user.token_version
     db.session.add(banned_user)
     db.session.delete(user)
     db.session.commit()
@@ -506,7 +633,7 @@ def ban_user():
 
 
 @admin_endpoints.route("/api/admin/user/unban/", methods=["PUT"])
-@jwt_required()
+@admin_required()
 def unban_user():
     """Unban a user by moving them back to the users table
 
@@ -514,15 +641,6 @@ def unban_user():
         json: Message
     """
 
-    # Get the user from the authorization token
-    admin = Users.query.filter_by(id=get_jwt_identity()).first()
-    if not admin:
-        return jsonify({"message": "Invalid user, user not found"}), 401
-
-    # Ensure the user is an admin
-    if admin.role != "admin":
-        return jsonify({"message": "Insufficient permissions"}), 403
-
     # Get the user id from the request
     data = request.get_json()
     if not data or "user_id" not in data:
@@ -543,6 +661,7 @@ def unban_user():
         role=banned_user.role,
         two_factor_enabled=banned_user.two_factor_enabled,
         two_factor_secret=banned_user.two_factor_secret,
+        token_version=banned_user.token_version,
     )
 
     db.session.add(user)
@@ -553,47 +672,21 @@ def unban_user():
 
 
 @admin_endpoints.route("/api/admin/user/banned/", methods=["GET"])
-@jwt_required()
+@read_only
+@query_budget(2)
+@admin_required()
 def get_banned_users():
-    """Get all banned users
+    """Get all banned users, optionally one page at a time and filtered by a username or email prefix and role
 
     Returns:
         json: List of banned users
     """
 
-    # Get the user from the authorization token
-    admin = Users.query.filter_by(id=get_jwt_identity()).first()
-    if not admin:
-        return jsonify({"message": "Invalid user"}), 401
-
-    # Ensure the user is an admin
-    if admin.role != "admin":
-        return jsonify({"message": "Insufficient permissions"}), 403
-
-    # Get all banned users
-    banned_users = BannedUsers.query.all()
-    if not banned_users:
-        return jsonify({"message": "No banned users"}), 404
-
-    banned_users_list = []
-    for banned_user in banned_users:
-        banned_users_list.append({
-            "id": banned_user.id,
-            "user_id": banned_user.user_id,
-            "username": banned_user.username,
-            "email": banned_user.email,
-            "login_time": banned_user.login_time,
-            "ip": banned_user.ip,
-            "role": banned_user.role,
-            "ban_reason": banned_user.ban_reason,
-            "two_factor_enabled": banned_user.two_factor_enabled,
-        })
-
-    return jsonify(banned_users_list), 200
+    return list_response(filter_users(BannedUsers), BannedUsers.id, BANNED_USER_SORT_COLUMNS, "username", serialize_banned_user, "No banned users")
 
 
 @admin_endpoints.route("/api/admin/user/banned/delete/", methods=["DELETE"])
-@jwt_required()
+@admin_required()
 def delete_banned_user():
     """Delete a banned user (effectively perma-ban)
 
@@ -601,15 +694,6 @@ def delete_banned_user():
         json: Message
     """
 
-    # Get the user from the authorization token
-    admin = Users.query.filter_by(id=get_jwt_identity()).first()
-    if not admin:
-        return jsonify({"message": "Invalid user"}), 401
-
-    # Ensure the user is an admin
-    if admin.role != "admin":
-        return jsonify({"message": "Insufficient permissions"}), 403
-
     # Get the user id from the request
     data = request.get_json()
     if not data or "user_id" not in data:
@@ -628,41 +712,23 @@ def delete_banned_user():
 
 # Get all unverified users
 @admin_endpoints.route("/api/admin/user/unverified/", methods=["GET"])
-@jwt_required()
+@read_only
+@query_budget(2)
+@admin_required()
 def get_unverified_users():
-    """Get all unverified users
+    """Get all unverified users, optionally one page at a time and filtered by a username or email prefix
 
     Returns:
         json: List of unverified users
     """
 
-    # Get the user from the authorization token
-    admin = Users.query.filter_by(id=get_jwt_identity()).first()
-    if not admin:
-        return jsonify({"message": "Invalid user"}), 401
-
-    # Ensure the user is an admin
-    if admin.role != "admin":
-        return jsonify({"message": "Insufficient permissions"}), 403
-
-    # Get all unverified users from the UnverifiedUsers table
-    unverified_users = UnverifiedUsers.query.all()
-    if not unverified_users:
-        return jsonify({"message": "No unverified users"}), 404
-
-    unverified_users_list = []
-    for unverified_user in unverified_users:
-        unverified_users_list.append({
-            "id": unverified_user.id,
-            "username": unverified_user.username,
-            "email": unverified_user.email,
-        })
-
-    return jsonify(unverified_users_list), 200
+    return list_response(
+        filter_users(UnverifiedUsers), UnverifiedUsers.id, UNVERIFIED_USER_SORT_COLUMNS, "username", serialize_unverified_user, "No unverified users"
+    )
 
 
 @admin_endpoints.route("/api/admin/user/unverified/delete/", methods=["DELETE"])
-@jwt_required()
+@admin_required()
 def delete_unverified_user():
     """Delete an unverified user
 
@@ -670,15 +736,6 @@ def delete_unverified_user():
         json: Message
     """
 
-    # Get the user from the authorization token
-    admin = Users.query.filter_by(id=get_jwt_identity()).first()
-    if not admin:
-        return jsonify({"message": "Invalid user"}), 401
-
-    # Ensure the user is an admin
-    if admin.role != "admin":
-        return jsonify({"message": "Insufficient permissions"}), 403
-
     # Get the user id from the request
     data = request.get_json()
     if not data or "user_id" not in data:
@@ -696,7 +753,7 @@ def delete_unverified_user():
 
 
 @admin_endpoints.route("/api/admin/user/unverified/verify/", methods=["PUT"])
-@jwt_required()
+@admin_required()
 def verify_unverified_user():
     """Verify an unverified user
 
@@ -704,15 +761,6 @@ def verify_unverified_user():
         json: Message
     """
 
-    # Get the user from the authorization token
-    admin = Users.query.filter_by(id=get_jwt_identity()).first()
-    if not admin:
-        return jsonify({"message": "Invalid user"}), 401
-
-    # Ensure the user is an admin
-    if admin.role != "admin":
-        return jsonify({"message": "Insufficient permissions"}), 403
-
     # Get the user id from the request
     data = request.get_json()
     if not data or "user_id" not in data:
@@ -740,3 +788,277 @@ def verify_unverified_user():
     db.session.commit()
 
     return jsonify({"message": "Unverified user verified"}), 200
+
+
+def get_user_ids(data):
+    """Get the list of user ids from the body of a bulk request
+
+    Args:
+        data (dict): The body of the request
+
+    Returns:
+        list: The unique user ids, or None if the body is invalid
+    """
+
+    if not data or not isinstance(data.get("user_ids"), list) or not data["user_ids"]:
+        return None
+    if not all(isinstance(user_id, str) for user_id in data["user_ids"]):
+        return None
+    return list(dict.fromkeys(data["user_ids"]))
+
+
+def stop_user_vms(user_ids):
+    """Stop the virtual machines of the given users with a single kill, and delete them. The caller commits the session.
+
+    Args:
+        user_ids (list): The ids of the users
+    """
+
+    pids = db.session.execute(
+        select(VirtualMachines.process_id, VirtualMachines.websockify_process_id).where(VirtualMachines.user_id.in_(user_ids))
+    ).all()
+    if pids:
+        subprocess.Popen(
+            ["kill", *[str(pid) for row in pids for pid in row]],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+    db.session.execute(delete(VirtualMachines).where(VirtualMachines.user_id.in_(user_ids)))
+
+
+@admin_endpoints.route("/api/admin/user/ban/bulk/", methods=["PUT"])
+@admin_required()
+def ban_users():
+    """Ban several users at once with an optional reason, in a single transaction
+
+    Returns:
+        json: Message and the number of users banned
+    """
+
+    data = request.get_json()
+    user_ids = get_user_ids(data)
+    if user_ids is None:
+        return jsonify({"message": "Invalid data format"}), 400
+
+    # Only ban users that exist, and stop their virtual machines
+    user_ids = db.session.execute(select(Users.id).where(Users.id.in_(user_ids))).scalars().all()
+    if not user_ids:
+        return jsonify({"message": "Invalid user"}), 404
+    stop_user_vms(user_ids)
+
+    # Ban the users by moving them to the banned users table, bumping their token version so tokens issued before the ban
+    # stay revoked once they are unbanned
+    db.session.execute(
+        insert(BannedUsers).from_select(
+            ["user_id", "username", "email", "password", "login_time", "ip", "role", "two_factor_enabled", "two_factor_secret", "ban_reason", "token_version"],
+            select(
+                Users.id,
+                Users.username,
+                Users.email,
+                Users.password,
+                Users.login_time,
+                Users.ip,
+                Users.role,
+                Users.two_factor_enabled,
+                Users.two_factor_secret,
+                literal(data.get("ban_reason"), BannedUsers.ban_reason.type),
+                Users.token_version + 1,
+            ).where(Users.id.in_(user_ids)),
+        )
+    )
+    db.session.execute(delete(Users).where(Users.id.in_(user_ids)))
+    db.session.commit()
+    forget_token_versions(user_ids, removed=True)
+
+    return jsonify({"message": "Users banned", "count": len(user_ids)}), 200
+
+
+@admin_endpoints.route("/api/admin/user/unban/bulk/", methods=["PUT"])
+@admin_required()
+def unban_users():
+    """Unban several users at once by moving them back to the users table under their original ids, in a single transaction
+
+    Returns:
+        json: Message and the number of users unbanned
+    """
+
+    user_ids = get_user_ids(request.get_json())
+    if user_ids is None:
+        return jsonify({"message": "Invalid data format"}), 400
+
+    user_ids = db.session.execute(select(BannedUsers.user_id).where(BannedUsers.user_id.in_(user_ids))).scalars().all()
+    if not user_ids:
+        return jsonify({"message": "Invalid user"}), 404
+
+    db.session.execute(
+        insert(Users).from_select(
+            ["id", "username", "email", "password", "login_time", "ip", "role", "two_factor_enabled", "two_factor_secret", "token_version"],
+            select(
+                BannedUsers.user_id,
+                BannedUsers.username,
+                BannedUsers.email,
+                BannedUsers.password,
+                BannedUsers.login_time,
+                BannedUsers.ip,
+                BannedUsers.role,
+                BannedUsers.two_factor_enabled,
+                BannedUsers.two_factor_secret,
+                BannedUsers.token_version,
+            ).where(BannedUsers.user_id.in_(user_ids)),
+        )
+    )
+    db.session.execute(delete(BannedUsers).where(BannedUsers.user_id.in_(user_ids)))
+    db.session.commit()
+    forget_token_versions(user_ids)
+
+    return jsonify({"message": "Users unbanned", "count": len(user_ids)}), 200
+
+
+@admin_endpoints.route("/api/admin/user/delete/bulk/", methods=["DELETE"])
+@admin_required()
+def delete_users():
+    """Delete several users at once, and their virtual machines, in a single transaction. Admins are skipped.
+
+    Returns:
+        json: Message and the number of users deleted
+    """
+
+    user_ids = get_user_ids(request.get_json())
+    if user_ids is None:
+        return jsonify({"message": "Invalid data format"}), 400
+
+    # Admins cannot be deleted, please contact the head admin
+    user_ids = db.session.execute(select(Users.id).where(Users.id.in_(user_ids), Users.role != "admin")).scalars().all()
+    if not user_ids:
+        return jsonify({"message": "Invalid user"}), 404
+
+    stop_user_vms(user_ids)
+    db.session.execute(delete(Users).where(Users.id.in_(user_ids)))
+    db.session.commit()
+    forget_token_versions(user_ids, removed=True)
+
+    return jsonify({"message": "Users deleted", "count": len(user_ids)}), 200
+
+
+@admin_endpoints.route("/api/admin/user/role/bulk/", methods=["PUT"])
+@admin_required()
+def change_users_role():
+    """Change the role of several users at once, revoking their tokens. Admins are skipped.
+
+    Returns:
+        json: Message and the number of users changed
+    """
+
+    data = request.get_json()
+    user_ids = get_user_ids(data)
+    if user_ids is None or not isinstance(data.get("role"), str):
+        return jsonify({"message": "Invalid data format"}), 400
+
+    # Admins cannot change their role, please contact the head admin
+    user_ids = db.session.execute(select(Users.id).where(Users.id.in_(user_ids), Users.role != "admin")).scalars().all()
+    if not user_ids:
+        return jsonify({"message": "Invalid user"}), 404
+
+    db.session.execute(
+        update(Users).where(Users.id.in_(user_ids)).values(role=data["role"], token_version=Users.token_version + 1)
+    )
+    db.session.commit()
+    forget_token_versions(user_ids)
+
+    return jsonify({"message": "User roles changed", "count": len(user_ids)}), 200
+
+
+@admin_endpoints.route("/api/admin/user/unverified/delete/bulk/", methods=["DELETE"])
+@admin_required()
+def delete_unverified_users():
+    """Delete several unverified users at once
+
+    Returns:
+        json: Message and the number of unverified users deleted
+    """
+
+    user_ids = get_user_ids(request.get_json())
+    if user_ids is None:
+        return jsonify({"message": "Invalid data format"}), 400
+
+    result = db.session.execute(delete(UnverifiedUsers).where(UnverifiedUsers.id.in_(user_ids)))
+    db.session.commit()
+    if not result.rowcount:
+        return jsonify({"message": "Invalid user"}), 404
+
+    return jsonify({"message": "Unverified users deleted", "count": result.rowcount}), 200
+
+
+@admin_endpoints.route("/api/admin/user/unverified/verify/bulk/", methods=["PUT"])
+@admin_required()
+def verify_unverified_users():
+    """Verify several unverified users at once by moving them to the users table, in a single transaction
+
+    Returns:
+        json: Message and the number of users verified
+    """
+
+    user_ids = get_user_ids(request.get_json())
+    if user_ids is None:
+        return jsonify({"message": "Invalid data format"}), 400
+
+    user_ids = db.session.execute(select(UnverifiedUsers.id).where(UnverifiedUsers.id.in_(user_ids))).scalars().all()
+    if not user_ids:
+        return jsonify({"message": "Invalid user"}), 404
+
+    # The unverified users' ids are already unique, so they are kept as their user ids
+    db.session.execute(
+        insert(Users).from_select(
+            ["id", "username", "email", "password", "role", "two_factor_enabled", "token_version"],
+            select(
+                UnverifiedUsers.id,
+                UnverifiedUsers.username,
+                UnverifiedUsers.email,
+                UnverifiedUsers.password,
+                literal("user", Users.role.type),
+                false(),
+                literal(0, Users.token_version.type),
+            ).where(UnverifiedUsers.id.in_(user_ids)),
+        )
+    )
+    db.session.execute(delete(UnverifiedUsers).where(UnverifiedUsers.id.in_(user_ids)))
+    db.session.commit()
+
+    return jsonify({"message": "Unverified users verified", "count": len(user_ids)}), 200
+
+
+@admin_endpoints.route("/api/admin/db/pool/", methods=["GET"])
+@admin_required()
+def get_db_pool():
+    """Get the database pool's size, usage and checkout waits in the worker that handled the request.
+    Each gunicorn worker has its own pool, so repeated requests sample different workers.
+
+    Returns:
+        json: Pool statistics
+    """
+
+    return jsonify(pool_stats.snapshot(db.engine.pool)), 200
+
+
+@admin_endpoints.route("/api/admin/jobs/", methods=["GET"])
+@admin_required()
+def get_jobs():
+    """Get each periodic job's interval, when it last ran and what it did, and when it runs next
+
+    Returns:
+        json: The jobs
+    """
+
+    return jsonify(describe_jobs(scheduled_jobs())), 200
+
+
+@admin_endpoints.route("/api/admin/logs/usage/", methods=["GET"])
+@admin_required()
+def get_log_usage():
+    """Get the disk used by virtual machine captures on each day, against the quotas and the space left on the disk
+
+    Returns:
+        json: The usage
+    """
+
+    return jsonify(log_usage()), 200
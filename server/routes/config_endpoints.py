@@ -1,60 +1,46 @@
-import json
-from datetime import timedelta
 from flask import Blueprint, jsonify, request
-from flask_jwt_extended import get_jwt_identity, jwt_required
-from models import Users, ApplicationConfigDb
-from config import ApplicationConfig
+from auth import admin_required
+from settings import current_settings, describe_settings, update_settings
+from settings_sync import publish_settings
 
 config_endpoints = Blueprint("config_endpoints", __name__)
 
 
 @config_endpoints.route("/api/config/", methods=["GET"])
-@jwt_required()
+@admin_required()
 def get_config():
-    # Get the user from the authorization token
-    user = Users.query.filter_by(id=get_jwt_identity()).first()
-    if not user:
-        return jsonify({"message": "Invalid user"}), 401
+    """Get the settings admins can change
 
-    # Ensure the user is an admin
-    if user.role != "admin":
-        return jsonify({"message": "Insufficient permissions"}), 403
+    Returns:
+        json: The settings version, and each setting's value and type
+    """
 
-    config = ApplicationConfig.get_config()
-    # Convert timedelta to string
-    for key, value in config.items():
-        if isinstance(value, timedelta):
-            config[key] = str(value)
-    return jsonify(config)
+    return jsonify(describe_settings(current_settings())), 200
 
 
 @config_endpoints.route("/api/config/", methods=["POST"])
-@jwt_required()
+@admin_required()
 def update_config():
-    # Get the user from the authorization token
-    user = Users.query.filter_by(id=get_jwt_identity()).first()
-    if not user:
-        return jsonify({"message": "Invalid user"}), 401
+    """Change settings, as a JSON object of setting names and values. A null value resets a setting to the .env file.
 
-    # Ensure the user is an admin
-    if user.role != "admin":
-        return jsonify({"message": "Insufficient permissions"}), 403
+    Returns:
+        json: Message and the new settings version
+    """
 
     # Get the new config from the request
-    new_config = request.json
-    if not new_config:
+    new_config = request.get_json(silent=True)
+    if not new_config or not isinstance(new_config, dict):
         return jsonify({"message": "No config provided"}), 400
 
-    # Update the config in the database
-    for key, value in new_config.items():
-        config_entry = ApplicationConfigDb.query.filter_by(key=key).first()
-        if config_entry:
-            config_entry.value = value
-        else:
-            config_entry = ApplicationConfigDb(key=key, value=value)
-        config_entry.save()
+    # Validate and store every setting, or none of them
+    try:
+        settings = update_settings(new_config)
+    except KeyError as e:
+        return jsonify({"message": f"Unknown setting {e.args[0]}"}), 400
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
 
-        # Update the environment variable
-        ApplicationConfig.__dict__[key] = value
+    # The other workers apply the new settings within SETTINGS_POLL_INTERVAL, or straight away with SETTINGS_CHANNEL_URL
+    publish_settings(settings.version)
 
-    return jsonify({"message": "Config updated"})
+    return jsonify({"message": "Config updated", "version": settings.version}), 200
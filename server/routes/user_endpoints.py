@@ -15,34 +15,36 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import base64
-import os
+import io
 import re
 import subprocess
 from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 
 import pyotp
-import qrcode
 from flask import Blueprint, jsonify, request
-from flask_bcrypt import Bcrypt
 from flask_jwt_extended import (
-    create_access_token,
     get_jwt,
     get_jwt_identity,
     jwt_required,
     set_access_cookies,
     unset_jwt_cookies,
 )
-from flask_mail import Mail, Message
-from flask_ldap3_login import LDAP3LoginManager
-from flask_ldap3_login.forms import LDAPLoginForm
+from auth import create_user_token, refresh_user_token
+from catalog import get_catalog
 from config import ApplicationConfig
-from models import BannedUsers, UnverifiedUsers, Users, VirtualMachines, db
-from password_strength import PasswordPolicy
+from identity import BANNED, UNVERIFIED, find_identities, first_identity
+from mail_queue import queue_mail
+from models import UnverifiedUsers, Users, VirtualMachines, db, read_only
+from passwords import check_password, hash_password, needs_rehash
+from query_log import query_budget
+from rate_limits import ip_key, limiter
+from routes.vm_endpoints import serialize_user_vm
+from settings import current_settings
+from sqlalchemy import func, select
+from sqlalchemy.orm import aliased
 
 user_endpoints = Blueprint("user_endpoints", __name__)
-Bcrypt = Bcrypt()
-mail = Mail()
-ldap_manager = LDAP3LoginManager()
 
 
 @user_endpoints.after_request
@@ -53,7 +55,7 @@ def refresh_expiring_jwts(response):
         now = datetime.now(timezone.utc)
         target_timestamp = datetime.timestamp(now + timedelta(minutes=30))
         if target_timestamp > exp_timestamp:
-            access_token = create_access_token(identity=get_jwt_identity())
+            access_token = refresh_user_token(get_jwt())
             set_access_cookies(response, access_token)
         return response
     except (RuntimeError, KeyError):
@@ -86,17 +88,48 @@ def is_valid_email(email):
     return re.match(r"[^@]+@[^@]+\.[^@]+", email)
 
 
-# Check passwords on the back-end and on the front-end just in case
-policy = PasswordPolicy.from_names(
-    length=8,
-    uppercase=1,
-    numbers=2,
-    special=1,
-    nonletters=2,
-)
+@lru_cache(maxsize=None)
+def get_password_policy():
+    """Build the password policy on first use, so password_strength is only imported when a password is checked
+
+    Returns:
+        PasswordPolicy: The password policy
+    """
+
+    from password_strength import PasswordPolicy
+
+    # Check passwords on the back-end and on the front-end just in case
+    return PasswordPolicy.from_names(
+        length=8,
+        uppercase=1,
+        numbers=2,
+        special=1,
+        nonletters=2,
+    )
+
+
+def serialize_user(user):
+    """Describe a user to themselves
+
+    Args:
+        user (Users): The user
+
+    Returns:
+        dict: User's information
+    """
+
+    return {
+        "id": user.id,
+        "username": user.username,
+        "email": user.email,
+        "role": user.role,
+        "two_factor_enabled": user.two_factor_enabled,
+    }
 
 
 @user_endpoints.route("/api/user/", methods=["GET"])
+@read_only
+@query_budget(2)
 @jwt_required()
 def get_user_info():
     """Get the user's information
@@ -111,13 +144,42 @@ def get_user_info():
         return jsonify({"message": "Invalid user"}), 401
 
     # Send the user's username
+    return jsonify(serialize_user(user)), 200
+
+
+@user_endpoints.route("/api/user/bootstrap/", methods=["GET"])
+@read_only
+@query_budget(2)
+@jwt_required()
+def bootstrap():
+    """Get everything the home screen needs in one request: the user's information, their virtual machine,
+    the number of virtual machines and the version of the ISO catalog. The catalog itself is only fetched from
+    /api/vm/iso/ when the client doesn't already have that version.
+
+    Returns:
+        json: User's information, virtual machine, virtual machine count and catalog version
+    """
+
+    # Get the user, their virtual machine and the number of virtual machines in a single query
+    all_vms = aliased(VirtualMachines)
+    row = db.session.execute(
+        select(Users, VirtualMachines, select(func.count(all_vms.id)).scalar_subquery())
+        .outerjoin(VirtualMachines, VirtualMachines.user_id == Users.id)
+        .where(Users.id == get_jwt_identity())
+    ).first()
+    if not row:
+        return jsonify({"message": "Invalid user"}), 401
+
+    user, vm, vm_count = row
+    catalog = get_catalog()
+
     return (
         jsonify({
-            "id": user.id,
-            "username": user.username,
-            "email": user.email,
-            "role": user.role,
-            "two_factor_enabled": user.two_factor_enabled,
+            "user": serialize_user(user),
+            "vm": serialize_user_vm(vm, catalog["index"]) if vm else None,
+            "vm_count": vm_count,
+            "max_vm_count": current_settings().MAX_VM_COUNT,
+            "catalog_version": catalog["version"],
         }),
         200,
     )
@@ -141,28 +203,11 @@ def register():
     email = data["email"]
     password = data["password"]
 
-    # Check if the username is already taken
-    if Users.query.filter_by(username=username).first():
+    # Check if the username or email is already taken in the users, unverified users or banned users tables
+    identities = find_identities(usernames=[username], emails=[email])
+    if first_identity(identities, username=username):
         return jsonify({"message": "Username already taken"}), 409
-
-    # Check if the email is already taken
-    if Users.query.filter_by(email=email).first():
-        return jsonify({"message": "Email already taken"}), 409
-
-    # Check if the username is already taken in the unverified users table
-    if UnverifiedUsers.query.filter_by(username=username).first():
-        return jsonify({"message": "Username already taken"}), 409
-
-    # Check if the email is already taken in the unverified users table
-    if UnverifiedUsers.query.filter_by(email=email).first():
-        return jsonify({"message": "Email already taken"}), 409
-
-    # Check if the username is already taken in the banned users table
-    if BannedUsers.query.filter_by(username=username).first():
-        return jsonify({"message": "Username already taken"}), 409
-
-    # Check if the email is already taken in the banned users table
-    if BannedUsers.query.filter_by(email=email).first():
+    if first_identity(identities, email=email):
         return jsonify({"message": "Email already taken"}), 409
 
     # Check if the username matches the username policy
@@ -170,7 +215,7 @@ def register():
         return jsonify({"message": "Invalid username"}), 400
 
     # Check if the password matches the password policy
-    if policy.test(password):
+    if get_password_policy().test(password):
         return (
             jsonify({
                 "message": "Password must be at least 8 characters long, contain at least 1 uppercase letter, 2 numbers, 1 special character, and 2 non-letter characters"
@@ -182,27 +227,22 @@ def register():
     new_user = UnverifiedUsers(
         username=username,
         email=email,
-        password=Bcrypt.generate_password_hash(password).decode("utf-8"),
+        password=hash_password(password),
     )
 
     # Get the current time and set in DateTime format for database
     created = datetime.now(timezone.utc)
     new_user.created = created
 
-    # Add the new user to the database
+    # Add the new user to the database. It is committed along with the verification email below
     db.session.add(new_user)
-    db.session.commit()
+    db.session.flush()
 
     # Generate a 6 character unique code
     unique_code = new_user.unique_code
 
     # Send the verification email
-    msg = Message(
-        "Buffet - Verify your account",
-        sender=(os.environ.get("MAIL_USERNAME")),
-        recipients=[email],
-    )
-    msg.html = f"""\
+    html = f"""\
     <html>
         <head>
             <style>
@@ -225,7 +265,7 @@ def register():
         </body>
     </html>
     """
-    mail.send(msg)
+    queue_mail("Buffet - Verify your account", [email], html)  # Sent in the background, so signup doesn't wait on the mail server
 
     return (
         jsonify({"message": "User created. Check your email to verify your account. Please check your spam folder if you do not see the email."}),
@@ -298,12 +338,7 @@ def resend_verification_email():
     unique_code = user.unique_code
 
     # Send the verification email
-    msg = Message(
-        "Buffet - Verify your account",
-        sender=(os.environ.get("MAIL_USERNAME")),
-        recipients=[user.email],
-    )
-    msg.html = f"""\
+    html = f"""\
     <html>
         <head>
             <style>
@@ -326,7 +361,7 @@ def resend_verification_email():
         </body>
     </html>
     """
-    mail.send(msg)
+    queue_mail("Buffet - Verify your account", [user.email], html)
 
     return (
         jsonify({
@@ -337,6 +372,8 @@ def resend_verification_email():
 
 
 @user_endpoints.route("/api/user/login/", methods=["POST"])
+@query_budget(5)
+@limiter.limit(ApplicationConfig.RATE_LIMIT_LOGIN, key_func=ip_key, override_defaults=False)
 def login():
     """Login a user
 
@@ -358,27 +395,31 @@ def login():
     # If the user is found in the unverified users table, return an error
     user = Users.query.filter((Users.username == username) | (Users.email == username)).first()
     if not user:
-        if BannedUsers.query.filter((BannedUsers.username == username) | (BannedUsers.email == username)).first():
+        identities = find_identities(usernames=[username], emails=[username], states=(UNVERIFIED, BANNED))
+        banned_user = first_identity(identities, state=BANNED)
+        if banned_user:
             return (
-                jsonify({
-                    "message": "You were banned for: "
-                    + BannedUsers.query.filter((BannedUsers.username == username) | (BannedUsers.email == username)).first().ban_reason
-                    + ". Please contact the head admin to appeal."
-                }),
+                jsonify({"message": "You were banned for: " + banned_user.ban_reason + ". Please contact the head admin to appeal."}),
                 403,
             )
-        if UnverifiedUsers.query.filter((UnverifiedUsers.username == username) | (UnverifiedUsers.email == username)).first():
+        if first_identity(identities, state=UNVERIFIED):
             return (
                 jsonify({"message": "Please verify your account before logging in"}),
                 401,
             )
         return jsonify({"message": "Invalid username or password"}), 401
 
-    if not Bcrypt.check_password_hash(user.password, password):
+    if not check_password(user.password, password):
         return jsonify({"message": "Invalid username or password"}), 401
 
+    # Upgrade the stored hash if the bcrypt work factor has changed, it is saved with the login time below
+    if needs_rehash(user.password):
+        user.password = hash_password(password)
+
     # Check if LDAP is enabled
     if ApplicationConfig.LDAP_ENABLED:
+        from flask_ldap3_login.forms import LDAPLoginForm
+
         # Get the LDAP login form
         login_form = LDAPLoginForm()
 
@@ -430,7 +471,7 @@ def login():
     db.session.commit()
 
     # Set access and refresh JWT cookies
-    access_token = create_access_token(identity=user.id)
+    access_token = create_user_token(user)
     resp = jsonify({"message": "Login successful"})
     set_access_cookies(resp, access_token)
 
@@ -494,17 +535,16 @@ def delete_user():
             403,
         )
 
-    if BannedUsers.query.filter_by(username=user.username).first():
+    # Check if the user is banned or unverified
+    identities = find_identities(usernames=[user.username], states=(UNVERIFIED, BANNED))
+    banned_user = first_identity(identities, state=BANNED)
+    if banned_user:
         return (
-            jsonify({
-                "message": "You were banned for: "
-                + BannedUsers.query.filter_by(username=user.username).first().ban_reason
-                + ". Please contact the head admin to appeal."
-            }),
+            jsonify({"message": "You were banned for: " + banned_user.ban_reason + ". Please contact the head admin to appeal."}),
             403,
         )
 
-    if UnverifiedUsers.query.filter_by(username=user.username).first():
+    if first_identity(identities, state=UNVERIFIED):
         return (
             jsonify({"message": "Please verify your account before deleting it"}),
             401,
@@ -523,7 +563,7 @@ def delete_user():
     password = data["password"]
 
     # Check if the password is correct
-    if not Bcrypt.check_password_hash(user.password, password):
+    if not check_password(user.password, password):
         return jsonify({"message": "Invalid password"}), 401
 
     # Stop the user's virtual machine
@@ -563,19 +603,17 @@ def change_password():
     if not data or "new_password" not in data or "current_password" not in data:
         return jsonify({"message": "Invalid data format"}), 400
 
-    # Check if the user is banned
-    if BannedUsers.query.filter_by(username=user.username).first():
+    # Check if the user is banned or unverified
+    identities = find_identities(usernames=[user.username], states=(UNVERIFIED, BANNED))
+    banned_user = first_identity(identities, state=BANNED)
+    if banned_user:
         return (
-            jsonify({
-                "message": "You were banned for: "
-                + BannedUsers.query.filter_by(username=user.username).first().ban_reason
-                + ". Please contact the head admin to appeal."
-            }),
+            jsonify({"message": "You were banned for: " + banned_user.ban_reason + ". Please contact the head admin to appeal."}),
             403,
         )
 
     # Check if the user is unverified
-    if UnverifiedUsers.query.filter_by(username=user.username).first():
+    if first_identity(identities, state=UNVERIFIED):
         return (
             jsonify({"message": "Please verify your account before changing your password"}),
             401,
@@ -585,11 +623,11 @@ def change_password():
     new_password = data["new_password"]
 
     # Check if the current password is correct
-    if not Bcrypt.check_password_hash(user.password, current_password):
+    if not check_password(user.password, current_password):
         return jsonify({"message": "Invalid password"}), 401
 
     # Check if the new password matches the password policy
-    if policy.test(new_password):
+    if get_password_policy().test(new_password):
         return (
             jsonify({
                 "message": "Password must be at least 8 characters long, contain at least 1 uppercase letter, 2 numbers, 1 special character, and 2 non-letter characters"
@@ -608,7 +646,7 @@ def change_password():
             return jsonify({"message": "Invalid 2FA code"}), 401
 
     # Change the password
-    user.password = Bcrypt.generate_password_hash(new_password).decode("utf-8")
+    user.password = hash_password(new_password)
 
     # Save the user
     db.session.commit()
@@ -635,34 +673,26 @@ def change_username():
     if not data or "username" not in data or "password" not in data:
         return jsonify({"message": "Invalid data format"}), 400
 
+    # Look up the current and new usernames in the users, unverified users and banned users tables at once
+    identities = find_identities(usernames=[user.username, data["username"]])
+
     # Check if the user is banned
-    if BannedUsers.query.filter_by(username=user.username).first():
+    banned_user = first_identity(identities, state=BANNED, username=user.username)
+    if banned_user:
         return (
-            jsonify({
-                "message": "You were banned for: "
-                + BannedUsers.query.filter_by(username=user.username).first().ban_reason
-                + ". Please contact the head admin to appeal."
-            }),
+            jsonify({"message": "You were banned for: " + banned_user.ban_reason + ". Please contact the head admin to appeal."}),
             403,
         )
 
     # Check if the user is unverified
-    if UnverifiedUsers.query.filter_by(username=user.username).first():
+    if first_identity(identities, state=UNVERIFIED, username=user.username):
         return (
             jsonify({"message": "Please verify your account before changing your username"}),
             401,
         )
 
-    # Check if the username is already taken in the banned users table
-    if BannedUsers.query.filter_by(username=data["username"]).first():
-        return jsonify({"message": "Username already taken"}), 409
-
-    # Check if the username is already taken in the unverified users table
-    if UnverifiedUsers.query.filter_by(username=data["username"]).first():
-        return jsonify({"message": "Username already taken"}), 409
-
     # Check if the username is already taken
-    if Users.query.filter_by(username=data["username"]).first():
+    if first_identity(identities, username=data["username"]):
         return jsonify({"message": "Username already taken"}), 409
 
     # Ensure the username is valid
@@ -673,7 +703,7 @@ def change_username():
     password = data["password"]
 
     # Check if the current password is correct
-    if not Bcrypt.check_password_hash(user.password, password):
+    if not check_password(user.password, password):
         return jsonify({"message": "Invalid password"}), 401
 
     # If user has 2FA enabled, check if the 2FA code is in the request
@@ -718,34 +748,26 @@ def change_email():
     password = data["password"]
 
     # Check if the current password is correct
-    if not Bcrypt.check_password_hash(user.password, password):
+    if not check_password(user.password, password):
         return jsonify({"message": "Invalid password"}), 401
 
-    # Check if the email is already taken
-    if Users.query.filter_by(email=email).first():
-        return jsonify({"message": "Email already taken"}), 409
-
-    # Check if the email is already taken in the unverified users table
-    if UnverifiedUsers.query.filter_by(email=email).first():
-        return jsonify({"message": "Email already taken"}), 409
+    # Look up the new email and the current username in the users, unverified users and banned users tables at once
+    identities = find_identities(usernames=[user.username], emails=[email])
 
-    # Check if the email is already taken in the banned users table
-    if BannedUsers.query.filter_by(email=email).first():
+    # Check if the email is already taken
+    if first_identity(identities, email=email):
         return jsonify({"message": "Email already taken"}), 409
 
     # Check if the user is banned
-    if BannedUsers.query.filter_by(username=user.username).first():
+    banned_user = first_identity(identities, state=BANNED, username=user.username)
+    if banned_user:
         return (
-            jsonify({
-                "message": "You were banned for: "
-                + BannedUsers.query.filter_by(username=user.username).first().ban_reason
-                + ". Please contact the head admin to appeal."
-            }),
+            jsonify({"message": "You were banned for: " + banned_user.ban_reason + ". Please contact the head admin to appeal."}),
             403,
         )
 
     # Check if the user is unverified
-    if UnverifiedUsers.query.filter_by(username=user.username).first():
+    if first_identity(identities, state=UNVERIFIED, username=user.username):
         return (
             jsonify({"message": "Please verify your account before changing your email"}),
             401,
@@ -775,6 +797,30 @@ def change_email():
 
 
 # Two-factor authentication endpoints
+QR_CODE_FORMATS = {"png": "image/png", "svg": "image/svg+xml"}
+
+
+def make_qr_code(data, image_format="png"):
+    """Render a QR code in memory with the pure Python PNG or SVG writer instead of drawing it with PIL
+
+    Args:
+        data (str): The data to encode, i.e. a provisioning URI
+        image_format (str): png or svg
+
+    Returns:
+        bytes: The image
+    """
+
+    import qrcode
+    from qrcode.image.pure import PyPNGImage
+    from qrcode.image.svg import SvgPathImage
+
+    image_factory = SvgPathImage if image_format == "svg" else PyPNGImage
+    buffer = io.BytesIO()
+    qrcode.make(data, image_factory=image_factory).save(buffer)
+    return buffer.getvalue()
+
+
 @user_endpoints.route("/api/user/2fa/", methods=["POST"])
 @jwt_required()
 def setup_2fa():
@@ -789,6 +835,11 @@ def setup_2fa():
     if not user:
         return jsonify({"message": "Invalid user"}), 401
 
+    # Check the requested image format before changing the user's secret
+    image_format = request.args.get("format", "png")
+    if image_format not in QR_CODE_FORMATS:
+        return jsonify({"message": "Format must be png or svg"}), 400
+
     # Generate a secret key
     secret = pyotp.random_base32()
 
@@ -799,17 +850,11 @@ def setup_2fa():
     # Save the user
     db.session.commit()
 
-    # Generate a QR code for the user to scan
-    uri = pyotp.totp.TOTP(secret).provisioning_uri(name=user.username, issuer_name="Buffet")
-    img = qrcode.make(uri)
-    img.save("qrcode-" + user.username + ".png")
-
     # Return the QR code to the user to scan in base64 format
-    with open("qrcode-" + user.username + ".png", "rb") as f:
-        img_base64 = base64.b64encode(f.read()).decode("utf-8")
-    os.remove("qrcode-" + user.username + ".png")
+    uri = pyotp.totp.TOTP(secret).provisioning_uri(name=user.username, issuer_name="Buffet")
+    img_base64 = base64.b64encode(make_qr_code(uri, image_format)).decode("utf-8")
 
-    return jsonify({"message": "2FA setup", "qr_code": img_base64}), 200
+    return jsonify({"message": "2FA setup", "qr_code": img_base64, "mime_type": QR_CODE_FORMATS[image_format]}), 200
 
 
 @user_endpoints.route("/api/user/2fa/verify/", methods=["POST"])
@@ -870,7 +915,7 @@ def disable_2fa():
     password = data["password"]
 
     # Check if the password is correct
-    if not Bcrypt.check_password_hash(user.password, password):
+    if not check_password(user.password, password):
         return jsonify({"message": "Invalid password"}), 401
 
     # Disable 2FA and clear the secret key
@@ -15,26 +15,40 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import asyncio
-import base64
 import json
 import os
 import re
 import random
 import subprocess
 import socket
+import time
 from datetime import datetime
 
 from dotenv import load_dotenv
-from flask import Blueprint, jsonify, request
-from flask_jwt_extended import get_jwt_identity, jwt_required
-from models import Users, VirtualMachines, db
+from flask import Blueprint, Response, current_app, jsonify, request, stream_with_context
+from flask_jwt_extended import get_jwt, get_jwt_identity, jwt_required
+from models import VirtualMachines, db, read_only
+from catalog import get_catalog
 from config import ApplicationConfig
-from qemu.qmp import QMPClient
+from events import EventHub, watch_model
+from settings import current_settings
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from tracing import span
+from vm_logs import log_directory
+from gevent_support import is_gevent_patched
+from query_log import query_budget
+from rate_limits import hypervisor_key, limiter
+import vm_loop
 
 load_dotenv()
 
 vm_endpoints = Blueprint("vm", __name__)
 
+BOOT_TIMEOUT = 60  # Seconds to wait for a virtual machine to start before giving up on it
+QMP_CONNECT_TIMEOUT = 10  # Seconds to wait for QEMU to open its QMP socket
+QMP_RETRY_INTERVAL = 0.25
+
 
 def create_random_vnc_password():
     """Generates a random password for VNC connections. Note that this password is not hashed or salted.
@@ -62,44 +76,40 @@ def get_hardware_platform():
 
 def get_iso_architecture(iso):
     """Retrieve the architecture of a given ISO."""
-    with open(f"{ApplicationConfig.ISO_DIR}/index.json", "r", encoding="utf-8") as f:
-        data = json.load(f)
-        for iso_data in data:
-            if iso_data["iso"] == iso:
-                return iso_data["arch"]
+    for iso_data in get_catalog()["index"]:
+        if iso_data["iso"] == iso:
+            return iso_data["arch"]
     return None
 
 
 def find_available_port():
     """Find the next available VM port."""
-    max_count = int(ApplicationConfig.MAX_VM_COUNT)
-    for port_int in range(max_count):
-        if not VirtualMachines.query.filter_by(port=port_int + int(ApplicationConfig.VM_PORT_START)).first():
+    settings = current_settings()
+    for port_int in range(settings.MAX_VM_COUNT):
+        if not VirtualMachines.query.filter_by(port=port_int + settings.VM_PORT_START).first():
             return port_int
     return None
 
 
-def create_log_directory(user_id):
-    """Create a log directory for the user if it doesn't exist."""
-    log_dir = f"logs/{datetime.now().date()}/{user_id}"
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
-
-
 def validate_iso(iso_dir):
     """Validate if the ISO file exists."""
     if not os.path.exists(iso_dir):
         raise FileNotFoundError(f"ISO file not found: {iso_dir}")
 
 
-def start_vm_process(arch, iso_dir, port_int, user_id):
-    """Start the virtual machine process."""
+def build_vm_command(arch, iso_dir, port_int, user_id):
+    """Build the QEMU command line for the virtual machine.
+
+    Returns:
+        list: The command
+    """
+    settings = current_settings()
     command = [
         f"qemu-system-{arch}",
         "-m",
-        f"{ApplicationConfig.MAX_VM_MEMORY}M",
+        f"{settings.MAX_VM_MEMORY}M",
         "-smp",
-        str(int(ApplicationConfig.MAX_VM_CORES)),
+        str(settings.MAX_VM_CORES),
         "-device",
         "virtio-balloon",
         "-drive",
@@ -113,17 +123,17 @@ def start_vm_process(arch, iso_dir, port_int, user_id):
         "-device",
         "qemu-xhci",
         "-object",
-        f"filter-dump,id=f1,netdev=net0,file=logs/{datetime.now().date()}/{user_id}/{datetime.now().strftime('%H:%M:%S')}-{iso_dir.split('/')[-1]}.pcap",
+        f"filter-dump,id=f1,netdev=net0,file={log_directory(user_id)}/{datetime.now().strftime('%H:%M:%S')}-{iso_dir.split('/')[-1]}.pcap",
         "-vnc",
-        f":{port_int},to={ApplicationConfig.MAX_VM_COUNT},password=on"
+        f":{port_int},to={settings.MAX_VM_COUNT},password=on"
         if get_host_os_type() != "Darwin"
-        else f":{port_int},to={ApplicationConfig.MAX_VM_COUNT},password=off",
+        else f":{port_int},to={settings.MAX_VM_COUNT},password=off",
         "-qmp",
         f"unix:/tmp/qmp-{user_id}.sock,server,wait=off",
     ]
 
     # If KVM is enabled, add the KVM flag
-    if ApplicationConfig.KVM_ENABLED:
+    if settings.KVM_ENABLED:
         command.extend(["-enable-kvm", "-cpu", "host"])
     # Add HVF accelerator if running on macOS with an M series chip, and ISO is ARM64
     if get_host_os_type() == "Darwin" and get_hardware_platform() == "arm64" and arch == "aarch64":
@@ -132,35 +142,61 @@ def start_vm_process(arch, iso_dir, port_int, user_id):
     # Add HAXM accelerator if running on macOS with an Intel chip
     elif get_host_os_type() == "Darwin" and get_hardware_platform() == "x86_64":
         command.extend(["-machine", "q35,accel=hax", "-device", "virtio-gpu-pci"])
-    elif get_host_os_type() == "Linux" and arch == "x86_64" and not ApplicationConfig.KVM_ENABLED:
+    elif get_host_os_type() == "Linux" and arch == "x86_64" and not settings.KVM_ENABLED:
         # Use standard QEMU VGA if running on Linux
         command.extend(["-cpu", "qemu64", "-device", "virtio-vga"])
 
-    # Print the command for debugging
-    print("Executing command:", " ".join(command))
+    return command
 
-    process = subprocess.Popen(command)
 
-    return process.pid
+async def start_vm_process(command, arch):
+    """Start the virtual machine process.
+
+    Returns:
+        asyncio.subprocess.Process: The QEMU process
+    """
+    with span("qemu.spawn", arch=arch) as spawn:
+        process = await asyncio.create_subprocess_exec(*command)
+        spawn.set_attribute("process.pid", process.pid)
+    return process
 
 
 async def setup_qmp_client(user_id):
-    """Setup QMP client for the virtual machine."""
-    qmp = QMPClient(f"virtual-machine-{user_id}")
-    await qmp.connect(f"/tmp/qmp-{user_id}.sock")
-    return qmp
+    """Setup QMP client for the virtual machine, retrying until QEMU has opened its QMP socket."""
+    from qemu.qmp import ConnectError, QMPClient
 
+    qmp = QMPClient(f"virtual-machine-{user_id}")
+    deadline = asyncio.get_running_loop().time() + QMP_CONNECT_TIMEOUT
+    with span("qmp.connect") as connect:
+        attempts = 0
+        while True:
+            attempts += 1
+            connect.set_attribute("qmp.attempts", attempts)
+            try:
+                await qmp.connect(f"/tmp/qmp-{user_id}.sock")
+                return qmp
+            except ConnectError:
+                if asyncio.get_running_loop().time() >= deadline:
+                    raise
+                await asyncio.sleep(QMP_RETRY_INTERVAL)
+
+
+def build_websockify_command(websocket_port, port):
+    """Build the websockify command line.
 
-def start_websockify(websocket_port, port):
-    """Start the websockify process."""
-    client_url = ApplicationConfig.CLIENT_URL
-    api_url = socket.gethostbyname(socket.gethostname())
+    Returns:
+        list: The command
+    """
+    settings = current_settings()
+    client_url = settings.CLIENT_URL
+    with span("dns.gethostbyname"):
+        api_url = socket.gethostbyname(socket.gethostname())
 
-    if ApplicationConfig.WEBSOCKET_SSL_ENABLED:
-        cert_path = ApplicationConfig.SSL_CERTIFICATE_PATH
-        key_path = ApplicationConfig.SSL_KEY_PATH
+    if settings.WEBSOCKET_SSL_ENABLED:
+        cert_path = settings.SSL_CERTIFICATE_PATH
+        key_path = settings.SSL_KEY_PATH
 
-        process = subprocess.Popen([
+        return [
             "websockify",
             "--cert",
             cert_path,
@@ -169,51 +205,238 @@ def start_websockify(websocket_port, port):
             "--ssl-only",
             f"{client_url}:{websocket_port}",
             f"{api_url}:{port}",
-        ])
-    else:
-        process = subprocess.Popen(["websockify", f"{client_url}:{websocket_port}", f"{api_url}:{port}"])
+        ]
+    return ["websockify", f"{client_url}:{websocket_port}", f"{api_url}:{port}"]
+
+
+async def start_websockify(websocket_port, port):
+    """Start the websockify process.
+
+    Returns:
+        int: The process id of websockify
+    """
+    command = build_websockify_command(websocket_port, port)
+    with span("websockify.spawn") as spawn:
+        process = await asyncio.create_subprocess_exec(*command)
+        spawn.set_attribute("process.pid", process.pid)
     return process.pid
 
 
+async def boot_vm(command, arch, user_id, websocket_port, port):
+    """Start the virtual machine, set its VNC password over QMP and start websockify.
+    This runs on the worker's event loop, so boots from concurrent requests overlap instead of each blocking a thread on its own loop.
+
+    Returns:
+        tuple: The process id of QEMU, the process id of websockify and the VNC password
+    """
+
+    process = await start_vm_process(command, arch)
+    try:
+        # If the host OS is not macOS, setup QMP and VNC password
+        password = None
+        if get_host_os_type() != "Darwin":
+            qmp = await setup_qmp_client(user_id)
+            try:
+                password = create_random_vnc_password()
+                with span("qmp.set_password"):
+                    await qmp.execute("set_password", {"protocol": "vnc", "password": password})
+            finally:
+                await qmp.disconnect()
+
+        # Start websockify process
+        websockify_process_id = await start_websockify(websocket_port, port)
+    except BaseException:
+        # Don't leave a virtual machine running that never makes it into the database
+        process.kill()
+        raise
+
+    return process.pid, websockify_process_id, password
+
+
+def qmp_execute(path, command, arguments, timeout):
+    """Run one QMP command over a plain socket, retrying until QEMU has opened its QMP socket.
+    Under gevent the socket and sleeps are cooperative, where qemu.qmp would need an asyncio loop of its own.
+
+    Args:
+        path (str): The path of the QMP unix socket
+        command (str): The command to run
+        arguments (dict): The arguments of the command
+        timeout (float): Seconds to wait for the socket and for each reply
+
+    Raises:
+        OSError: If the socket could not be reached, or QMP returned an error
+
+    Returns:
+        The return value of the command
+    """
+
+    deadline = time.monotonic() + timeout
+    with span("qmp.connect") as connect:
+        attempts = 0
+        while True:
+            attempts += 1
+            connect.set_attribute("qmp.attempts", attempts)
+            try:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.settimeout(timeout)
+                sock.connect(path)
+                break
+            except OSError:
+                sock.close()
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(QMP_RETRY_INTERVAL)
+
+    with sock, sock.makefile("rwb") as stream:
+
+        def call(execute, args=None):
+            stream.write(json.dumps({"execute": execute, "arguments": args or {}}).encode("utf-8") + b"\n")
+            stream.flush()
+            while True:
+                line = stream.readline()
+                if not line:
+                    raise ConnectionError("QMP socket closed")
+                reply = json.loads(line)
+                # Skip asynchronous events until the reply arrives
+                if "return" in reply:
+                    return reply["return"]
+                if "error" in reply:
+                    raise OSError(f"QMP {execute} failed: {reply['error'].get('desc')}")
+
+        # Read the greeting, then leave capabilities negotiation mode
+        stream.readline()
+        call("qmp_capabilities")
+        with span(f"qmp.{command}"):
+            return call(command, arguments)
+
+
+def boot_vm_cooperative(command, arch, user_id, websocket_port, port):
+    """Start the virtual machine like boot_vm, but with blocking calls that gevent's monkey patching makes cooperative.
+
+    Returns:
+        tuple: The process id of QEMU, the process id of websockify and the VNC password
+    """
+    from gevent import Timeout
+
+    with span("qemu.spawn", arch=arch) as spawn:
+        process = subprocess.Popen(command)
+        spawn.set_attribute("process.pid", process.pid)
+    try:
+        with Timeout(BOOT_TIMEOUT, TimeoutError):
+            # If the host OS is not macOS, setup QMP and VNC password
+            password = None
+            if get_host_os_type() != "Darwin":
+                password = create_random_vnc_password()
+                qmp_execute(f"/tmp/qmp-{user_id}.sock", "set_password", {"protocol": "vnc", "password": password}, QMP_CONNECT_TIMEOUT)
+
+            # Start websockify process
+            command = build_websockify_command(websocket_port, port)
+            with span("websockify.spawn") as spawn:
+                websockify_process = subprocess.Popen(command)
+                spawn.set_attribute("process.pid", websockify_process.pid)
+    except BaseException:
+        # Don't leave a virtual machine running that never makes it into the database
+        process.kill()
+        raise
+
+    return process.pid, websockify_process.pid, password
+
+
+def serialize_user_vm(vm, index):
+    """Describe a user's virtual machine, with the name of the operating system, version and desktop environment
+
+    Args:
+        vm (VirtualMachines): The virtual machine
+        index (list): The index of the ISO files
+
+    Returns:
+        dict: Virtual machine
+    """
+
+    iso = next((iso for iso in index if iso["iso"] == vm.iso), {})
+    return {
+        "id": vm.id,
+        "websocket_port": vm.websocket_port,
+        "iso": vm.iso,
+        "user_id": vm.user_id,
+        "name": iso.get("name"),
+        "version": iso.get("version"),
+        "desktop": iso.get("desktop"),
+        "vnc_password": vm.vnc_password,
+        "homepage": iso.get("homepage"),
+        "desktop_homepage": iso.get("desktop_homepage"),
+    }
+
+
+def load_vm_state(user_ids):
+    """Load the server's capacity and the virtual machines of a set of users, for their event streams
+
+    Args:
+        user_ids (set): The ids of the users
+
+    Returns:
+        tuple: The capacity, and a dict of each user's virtual machine
+    """
+
+    vm_count = db.session.query(func.count(VirtualMachines.id)).scalar()
+    max_vm_count = current_settings().MAX_VM_COUNT
+    capacity = {"vm_count": vm_count, "max_vm_count": max_vm_count, "available": max(max_vm_count - vm_count, 0)}
+
+    vms = VirtualMachines.query.filter(VirtualMachines.user_id.in_(user_ids)).all()
+    index = get_catalog()["index"] if vms else []
+    states = {vm.user_id: serialize_user_vm(vm, index) for vm in vms}
+
+    # Return the connection to the pool, as event streams stay open far longer than the query
+    db.session.remove()
+    return capacity, states
+
+
+# A thread-based worker has only a few threads, and each open stream holds one of them, so few streams are allowed
+# unless the worker runs on gevent, where a stream costs a greenlet
+VM_EVENTS_MAX_STREAMS = ApplicationConfig.VM_EVENTS_MAX_STREAMS or (1000 if is_gevent_patched() else 2)
+
+vm_events = EventHub(
+    load_vm_state, ApplicationConfig.VM_EVENTS_INTERVAL, VM_EVENTS_MAX_STREAMS, ApplicationConfig.VM_EVENTS_MAX_AGE
+)
+watch_model(VirtualMachines, vm_events)
+
+
 @vm_endpoints.route("/api/vm/iso/", methods=["GET"])
+@query_budget(1)
 @jwt_required()
 def index_vm():
     """Index the ISO files
 
     Returns:
-        json: Index of the ISO files with logos
+        json: Index of the ISO files with logos, with its version as the ETag
     """
 
-    # Get the user from the authorization token
-    user = Users.query.filter_by(id=get_jwt_identity()).first()
-    if not user:
-        return jsonify({"message": "Invalid user"}), 401
-
-    with open(f"{ApplicationConfig.ISO_DIR}/index.json", "r", encoding="utf-8") as f:
-        data = json.load(f)
-        for iso in data:
-            logo_path = f"{ApplicationConfig.ISO_DIR}/logos/{iso['logo']}"
-            if os.path.exists(logo_path):
-                with open(logo_path, "rb") as f:
-                    iso["logo"] = base64.b64encode(f.read()).decode("utf-8")
-            else:
-                with open("assets/unknown.png", "rb") as f:
-                    iso["logo"] = base64.b64encode(f.read()).decode("utf-8")
-
-    return jsonify(data), 200
+    # Send the cached catalog, or nothing if the client already has this version
+    catalog = get_catalog()
+    response = Response(catalog["body"], mimetype="application/json")
+    response.set_etag(catalog["version"])
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response.make_conditional(request)
 
 
 @vm_endpoints.route("/api/vm/create/", methods=["POST"])
+@query_budget(6)
+@limiter.limit(ApplicationConfig.RATE_LIMIT_VM_CREATE, override_defaults=False)
+@limiter.limit(
+    ApplicationConfig.RATE_LIMIT_VM_BOOT,
+    key_func=hypervisor_key,
+    override_defaults=False,
+    deduct_when=lambda response: response.status_code == 201,  # Only VMs that were actually booted count
+)
 @jwt_required()
-async def create_vm():
+def create_vm():
     """Create a virtual machine
 
     Returns:
         json: Virtual machine
     """
-    user = Users.query.filter_by(id=get_jwt_identity()).first()
-    if not user:
-        return jsonify({"message": "Invalid user"}), 401
+    # Get the user from the authorization token, which has already been checked against revoked tokens
+    user_id = get_jwt_identity()
 
     data = request.get_json()
     if not data or "iso" not in data:
@@ -230,37 +453,34 @@ async def create_vm():
     if port_int is None:
         return jsonify({"message": "The server is at maximum capacity. Please try again later."}), 500
 
-    websocket_port, port = port_int + int(ApplicationConfig.WEBSOCKET_PORT_START), port_int + int(ApplicationConfig.VM_PORT_START)
+    settings = current_settings()
+    websocket_port, port = port_int + settings.WEBSOCKET_PORT_START, port_int + settings.VM_PORT_START
 
     # Check if user already has a virtual machine
-    if VirtualMachines.query.filter_by(user_id=user.id).count() > 0:
+    if VirtualMachines.query.filter_by(user_id=user_id).count() > 0:
         return jsonify({
             "message": "Users may only have one virtual machine at a time. Please shut down your current virtual machine before creating a new one."
         }), 403
 
     try:
-        create_log_directory(user.id)
         iso_dir = f"{ApplicationConfig.ISO_DIR}/{iso}"
         validate_iso(iso_dir)
 
-        # Start the virtual machine process
-        process_id = start_vm_process(arch, iso_dir, port_int, user.id)
-
-        # If the host OS is not macOS, setup QMP and VNC password
-        password = None
-        if get_host_os_type() != "Darwin":
-            # Wait for VM to start
-            await asyncio.sleep(2)
+        # Build the command here, as the event loop has no app context to log it from
+        command = build_vm_command(arch, iso_dir, port_int, user_id)
+        current_app.logger.debug("Executing command: %s", " ".join(command))
 
-            # Setup QMP and VNC password
-            qmp = await setup_qmp_client(user.id)
-            password = create_random_vnc_password()
-            await qmp.execute("set_password", {"protocol": "vnc", "password": password})
-
-        # Start websockify process
-        websockify_process_id = start_websockify(websocket_port, port)
+        # Start the virtual machine and websockify in this greenlet under gevent, or on the worker's event loop otherwise
+        with span("vm.boot", iso=iso, port=port):
+            if is_gevent_patched():
+                process_id, websockify_process_id, password = boot_vm_cooperative(command, arch, user_id, websocket_port, port)
+            else:
+                process_id, websockify_process_id, password = vm_loop.run(
+                    boot_vm(command, arch, user_id, websocket_port, port), timeout=BOOT_TIMEOUT
+                )
 
-    except subprocess.CalledProcessError:
+    except Exception:
+        current_app.logger.exception("Failed to start virtual machine for user %s", user_id)
         return jsonify({"message": "Critical error creating virtual machine. Please try again later."}), 500
 
     # Create the VM in the database
@@ -270,14 +490,26 @@ async def create_vm():
         iso=iso,
         websockify_process_id=websockify_process_id,
         process_id=process_id,
-        user_id=user.id,
+        user_id=user_id,
         log_file=f"{datetime.now().strftime('%H:%M:%S')}-{iso}.pcap",
         vnc_password=password,
     )
     db.session.add(new_vm)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another request booted a virtual machine on the same port, or for the same user, while this one was starting.
+        # The port and the user id are both unique, so this one is stopped and the other kept.
+        db.session.rollback()
+        for pid in (websockify_process_id, process_id):
+            subprocess.Popen(["kill", str(pid)], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if VirtualMachines.query.filter_by(user_id=user_id).count() > 0:
+            return jsonify({
+                "message": "Users may only have one virtual machine at a time. Please shut down your current virtual machine before creating a new one."
+            }), 403
+        return jsonify({"message": "The server is at maximum capacity. Please try again later."}), 500
 
-    return jsonify({"id": new_vm.id, "websocket_port": websocket_port, "iso": iso, "user_id": user.id}), 201
+    return jsonify({"id": new_vm.id, "websocket_port": websocket_port, "iso": iso, "user_id": user_id}), 201
 
 
 @vm_endpoints.route("/api/vm/delete/", methods=["DELETE"])
@@ -289,10 +521,8 @@ def delete_vm():
         json: Message
     """
 
-    # Get the user from the authorization token
-    user = Users.query.filter_by(id=get_jwt_identity()).first()
-    if not user:
-        return jsonify({"message": "Invalid user"}), 401
+    # Get the user from the authorization token, which has already been checked against revoked tokens
+    user_id = get_jwt_identity()
 
     data = request.get_json()
     if not data or "vm_id" not in data:
@@ -303,7 +533,7 @@ def delete_vm():
         return jsonify({"message": "Invalid virtual machine"}), 404
 
     # Ensure the user is deleting their own virtual machine
-    if vm.user_id != user.id:
+    if vm.user_id != user_id:
         return jsonify({"message": "You can only delete your own virtual machine"}), 403
 
     # Stop the virtual machine
@@ -325,6 +555,8 @@ def delete_vm():
 
 
 @vm_endpoints.route("/api/vm/user/", methods=["GET"])
+@read_only
+@query_budget(2)
 @jwt_required()
 def get_user_vm():
     """Get the virtual machine of the user
@@ -333,47 +565,15 @@ def get_user_vm():
         json: Virtual machine
     """
 
-    # Get the user from the authorization token
-    user = Users.query.filter_by(id=get_jwt_identity()).first()
-    if not user:
-        return jsonify({"message": "Invalid user"}), 401
+    # Get the user from the authorization token, which has already been checked against revoked tokens
+    user_id = get_jwt_identity()
 
     # Get the user's virtual machine
-    vm = VirtualMachines.query.filter_by(user_id=user.id).first()
+    vm = VirtualMachines.query.filter_by(user_id=user_id).first()
     if not vm:
         return jsonify({"message": "Invalid virtual machine"}), 404
 
-    name = None
-    version = None
-    desktop = None
-
-    # Get the name of the operating system, version and desktop environment
-    with open(f"{ApplicationConfig.ISO_DIR}/index.json", "r", encoding="utf-8") as f:
-        data = json.load(f)
-        for iso in data:
-            if iso["iso"] == vm.iso:
-                name = iso["name"]
-                version = iso["version"]
-                desktop = iso["desktop"]
-                homepage = iso["homepage"]
-                desktop_homepage = iso.get("desktop_homepage", None)
-                break
-
-    return (
-        jsonify({
-            "id": vm.id,
-            "websocket_port": vm.websocket_port,
-            "iso": vm.iso,
-            "user_id": vm.user_id,
-            "name": name,
-            "version": version,
-            "desktop": desktop,
-            "vnc_password": vm.vnc_password,
-            "homepage": homepage,
-            "desktop_homepage": desktop_homepage,
-        }),
-        201,
-    )
+    return jsonify(serialize_user_vm(vm, get_catalog()["index"])), 201
 
 
 @vm_endpoints.route("/api/vm/", methods=["GET"])
@@ -385,10 +585,8 @@ def get_vm_by_id():
         json: Virtual machine
     """
 
-    # Get the user from the authorization token
-    user = Users.query.filter_by(id=get_jwt_identity()).first()
-    if not user:
-        return jsonify({"message": "Invalid user"}), 401
+    # Get the user from the authorization token, which has already been checked against revoked tokens
+    user_id = get_jwt_identity()
 
     # Get the virtual machine id from the request
     data = request.get_json()
@@ -401,7 +599,7 @@ def get_vm_by_id():
         return jsonify({"message": "Invalid virtual machine"}), 404
 
     # Ensure the user is getting their own virtual machine
-    if vm.user_id != user.id:
+    if vm.user_id != user_id:
         return jsonify({"message": "You can only get your own virtual machine"}), 403
 
     return (
@@ -411,6 +609,8 @@ def get_vm_by_id():
 
 
 @vm_endpoints.route("/api/vm/count/", methods=["GET"])
+@read_only
+@query_budget(2)
 @jwt_required()
 def get_vm_count():
     """Get the number of virtual machines
@@ -419,12 +619,44 @@ def get_vm_count():
         json: Number of virtual machines
     """
 
-    # Get the user from the authorization token
-    user = Users.query.filter_by(id=get_jwt_identity()).first()
-    if not user:
-        return jsonify({"message": "Invalid user"}), 401
-
     # Get the number of virtual machines
     vm_count = VirtualMachines.query.count()
 
     return jsonify({"vm_count": vm_count}), 200
+
+
+@vm_endpoints.route("/api/vm/events/", methods=["GET"])
+@read_only
+@jwt_required()
+def vm_event_stream():
+    """Stream the server's capacity and the user's virtual machine as Server-Sent Events.
+    A "capacity" event carries the number of virtual machines, and a "vm" event the user's virtual machine or null,
+    each sent on connecting and again whenever it changes. The stream ends after VM_EVENTS_MAX_AGE seconds, or when
+    the token expires, and the browser reconnects.
+
+    Returns:
+        Response: Event stream, or 503 if this worker has VM_EVENTS_MAX_STREAMS open and the client should poll
+    """
+
+    # Get the user from the authorization token, which has already been checked against revoked tokens
+    user_id = get_jwt_identity()
+    expires_at = get_jwt()["exp"]
+
+    # Refuse the stream rather than tie up the last threads of the worker
+    subscriber = vm_events.subscribe(current_app._get_current_object(), user_id)
+    if subscriber is None:
+        response = jsonify({"message": "Too many open event streams. Please try again later."})
+        response.status_code = 503
+        response.headers["Retry-After"] = str(int(ApplicationConfig.VM_EVENTS_MAX_AGE))
+        return response
+
+    response = Response(
+        stream_with_context(vm_events.stream(current_app._get_current_object(), subscriber, expires_at)),
+        mimetype="text/event-stream",
+    )
+    # Free the slot even if the client disconnects before the stream starts
+    response.call_on_close(lambda: vm_events.unsubscribe(subscriber))
+    # Stop proxies from caching or buffering the events
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
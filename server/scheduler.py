@@ -0,0 +1,207 @@
+# scheduler.py - Runs periodic jobs, each in one worker at a time across the whole deployment.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
+
+from models import ScheduledJobs, db
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+from tracing import trace
+
+TICK_INTERVAL = 15  # Seconds between checks for due jobs
+
+# A periodic job. run takes no arguments and returns a short description of what it did.
+# The lease is how long the worker running it holds it, after which another worker may assume it died and run it.
+Job = namedtuple("Job", ["name", "run", "interval", "lease"])
+
+
+def utcnow():
+    """Get the current time in UTC, without a timezone, as stored in the database
+
+    Returns:
+        datetime: The current time
+    """
+
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class Scheduler:
+    """Runs due jobs from a daemon thread in each worker.
+    Every worker checks for due jobs, but claims a job with a conditional update before running it, like the mail
+    sender claims email, so each run happens in exactly one worker. There is no standing leader to fail over:
+    whichever worker claims a job first runs it, and a worker that dies mid-run loses it when its lease expires.
+    """
+
+    def __init__(self, app, jobs):
+        self.app = app
+        self.jobs = jobs
+        self.worker_id = uuid4().hex
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the scheduler thread, once per process so gunicorn workers each get their own after forking"""
+
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self.worker_id = uuid4().hex
+            self._thread = threading.Thread(target=self.run, name="scheduler", daemon=True)
+            self._thread.start()
+
+    def run(self):
+        """Run due jobs until the process exits"""
+
+        while True:
+            time.sleep(TICK_INTERVAL)
+            try:
+                with self.app.app_context():
+                    self.ensure_jobs()
+                    self.run_due()
+            except Exception:
+                self.app.logger.exception("Failed to run scheduled jobs")
+                db.session.rollback()
+
+    def ensure_jobs(self):
+        """Add a row for each job that doesn't have one, due straight away"""
+
+        known = {name for (name,) in db.session.query(ScheduledJobs.name)}
+        for job in self.jobs:
+            if job.name in known:
+                continue
+            db.session.add(ScheduledJobs(name=job.name, next_run=utcnow()))
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # Another worker added it first
+                db.session.rollback()
+
+    def claim(self, job):
+        """Claim a job if it is due and no other worker holds it
+
+        Args:
+            job (Job): The job
+
+        Returns:
+            bool: If this worker claimed the job
+        """
+
+        now = utcnow()
+        claimed = (
+            db.session.query(ScheduledJobs)
+            .filter(ScheduledJobs.name == job.name)
+            .filter(ScheduledJobs.next_run <= now)
+            .filter(or_(ScheduledJobs.claimed_until.is_(None), ScheduledJobs.claimed_until < now))
+            .update({"claimed_by": self.worker_id, "claimed_until": now + timedelta(seconds=job.lease)}, synchronize_session=False)
+        )
+        db.session.commit()
+        return claimed == 1
+
+    def run_due(self):
+        """Run each job that is due and not held by another worker"""
+
+        for job in self.jobs:
+            if not self.claim(job):
+                continue
+
+            start = time.monotonic()
+            started = utcnow()
+            result, error = None, None
+            with trace(f"job.{job.name}") as root:
+                try:
+                    result = job.run()
+                except Exception as e:
+                    db.session.rollback()
+                    self.app.logger.exception("Scheduled job %s failed", job.name)
+                    root.record_exception(e)
+                    error = str(e)[:255]
+
+            # Release the job and schedule its next run, unless another worker took it over after the lease expired
+            db.session.query(ScheduledJobs).filter(ScheduledJobs.name == job.name, ScheduledJobs.claimed_by == self.worker_id).update(
+                {
+                    "next_run": started + timedelta(seconds=job.interval),
+                    "claimed_by": None,
+                    "claimed_until": None,
+                    "last_run": started,
+                    "last_duration": round(time.monotonic() - start, 3),
+                    "last_result": (result or "")[:255] or None,
+                    "last_error": error,
+                },
+                synchronize_session=False,
+            )
+            db.session.commit()
+            if result:
+                self.app.logger.info("Scheduled job %s: %s", job.name, result)
+
+
+def describe_jobs(jobs):
+    """Describe the jobs for the admin endpoint
+
+    Args:
+        jobs (list): The jobs
+
+    Returns:
+        list: Each job's interval, next and last run, and the worker holding it
+    """
+
+    rows = {row.name: row for row in ScheduledJobs.query.all()}
+    described = []
+    for job in jobs:
+        row = rows.get(job.name)
+        described.append({
+            "name": job.name,
+            "interval": job.interval,
+            "next_run": row.next_run.isoformat() if row else None,
+            "claimed_by": row.claimed_by if row else None,
+            "last_run": row.last_run.isoformat() if row and row.last_run else None,
+            "last_duration": row.last_duration if row else None,
+            "last_result": row.last_result if row else None,
+            "last_error": row.last_error if row else None,
+        })
+    return described
+
+
+_scheduler = None
+
+
+def init_scheduler(app, jobs):
+    """Create the scheduler for the app and start it
+
+    Args:
+        app (Flask): The Flask app
+        jobs (list): The jobs to run
+    """
+
+    global _scheduler
+    _scheduler = Scheduler(app, jobs)
+    _scheduler.start()
+
+
+def scheduled_jobs():
+    """Get the jobs the scheduler runs
+
+    Returns:
+        list: The jobs, or an empty list if the scheduler is off
+    """
+
+    return _scheduler.jobs if _scheduler is not None else []
@@ -0,0 +1,244 @@
+# settings.py - Holds the settings admins can change at runtime, typed and versioned.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import threading
+from collections import namedtuple
+from datetime import datetime, timezone
+
+from config import ApplicationConfig
+from flask import current_app
+from limits import parse_many
+from models import ApplicationConfigDb, db
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError, OperationalError, ProgrammingError
+
+VERSION_KEY = "_version"  # The row holding the newest settings version, which every save increments
+
+# validate, if set, raises ValueError for a typed value that is still not allowed
+Setting = namedtuple("Setting", ["type", "default", "validate"], defaults=[None])
+
+# The settings stored in the database, with their type and the value from the .env file used until they are changed
+SCHEMA = {
+    "CLIENT_URL": Setting(str, ApplicationConfig.CLIENT_URL),
+    "KVM_ENABLED": Setting(bool, ApplicationConfig.KVM_ENABLED),
+    "MAX_VM_CORES": Setting(int, ApplicationConfig.MAX_VM_CORES),
+    "MAX_VM_COUNT": Setting(int, ApplicationConfig.MAX_VM_COUNT),
+    "MAX_VM_MEMORY": Setting(int, ApplicationConfig.MAX_VM_MEMORY),
+    "RATE_LIMIT": Setting(str, ApplicationConfig.RATE_LIMIT, parse_many),
+    "SSL_CERTIFICATE_PATH": Setting(str, ApplicationConfig.SSL_CERTIFICATE_PATH),
+    "SSL_KEY_PATH": Setting(str, ApplicationConfig.SSL_KEY_PATH),
+    "VM_PORT_START": Setting(int, ApplicationConfig.VM_PORT_START),
+    "WEBSOCKET_PORT_START": Setting(int, ApplicationConfig.WEBSOCKET_PORT_START),
+    "WEBSOCKET_SSL_ENABLED": Setting(bool, ApplicationConfig.WEBSOCKET_SSL_ENABLED),
+}
+
+# An immutable snapshot of every setting, parsed once, plus the version of the database rows it was built from
+Settings = namedtuple("Settings", ["version", *SCHEMA])
+
+TRUE_VALUES = {"true", "1", "yes", "on"}
+FALSE_VALUES = {"false", "0", "no", "off", ""}
+
+_lock = threading.Lock()
+
+
+def parse_value(key, value):
+    """Convert a value from the .env file, the database or a request to the setting's type
+
+    Args:
+        key (str): The name of the setting
+        value: The value, as a string or already typed
+
+    Raises:
+        ValueError: If the value is not valid for the setting
+
+    Returns:
+        The typed value, or None if it is unset
+    """
+
+    setting = SCHEMA[key]
+    if value is None:
+        return None
+
+    parsed = None
+    if setting.type is bool:
+        if isinstance(value, bool):
+            parsed = value
+        elif isinstance(value, str) and value.strip().lower() in TRUE_VALUES | FALSE_VALUES:
+            parsed = value.strip().lower() in TRUE_VALUES
+    elif setting.type is int:
+        if isinstance(value, int) and not isinstance(value, bool):
+            parsed = value
+        elif isinstance(value, str) and value.strip().lstrip("-").isdigit():
+            parsed = int(value)
+    elif setting.type is str and isinstance(value, str):
+        parsed = value
+
+    if parsed is None:
+        raise ValueError(f"{key} must be of type {setting.type.__name__}")
+    if setting.validate is not None and parsed != "":
+        try:
+            setting.validate(parsed)
+        except ValueError:
+            raise ValueError(f"{key} is not valid: {parsed}") from None
+    return parsed
+
+
+def build_settings(version, overrides):
+    """Build a snapshot from the defaults and the values stored in the database
+
+    Args:
+        version (int): The version of the stored values
+        overrides (dict): The stored values, already typed
+
+    Returns:
+        Settings: The snapshot
+    """
+
+    values = {}
+    for key, setting in SCHEMA.items():
+        value = overrides[key] if overrides.get(key) is not None else parse_value(key, setting.default)
+        # An unset switch is off
+        if value is None and setting.type is bool:
+            value = False
+        values[key] = value
+    return Settings(version=version, **values)
+
+
+_settings = build_settings(0, {})
+
+
+def current_settings():
+    """Get the current settings. Attribute lookups on the snapshot are plain tuple reads, with nothing to parse.
+
+    Returns:
+        Settings: The snapshot
+    """
+
+    return _settings
+
+
+def load_settings():
+    """Read the stored settings and swap in a new snapshot, keeping the current one if the table can't be read
+
+    Returns:
+        Settings: The snapshot
+    """
+
+    global _settings
+
+    try:
+        rows = db.session.query(ApplicationConfigDb).all()
+    except (OperationalError, ProgrammingError):
+        # The database is waiting for "flask db upgrade", so the .env values are used until then
+        db.session.rollback()
+        return _settings
+
+    overrides = {}
+    for row in rows:
+        if row.key not in SCHEMA or row.value is None:
+            continue
+        try:
+            overrides[row.key] = parse_value(row.key, json.loads(row.value))
+        except ValueError as e:
+            current_app.logger.warning("Ignoring stored setting %s: %s", row.key, e)
+
+    version = max((row.version for row in rows), default=0)
+    with _lock:
+        if version >= _settings.version:
+            _settings = build_settings(version, overrides)
+        return _settings
+
+
+def next_version():
+    """Take the next settings version by incrementing the version row. The row stays locked until the caller commits,
+    so concurrent saves get consecutive versions instead of the same one.
+
+    Returns:
+        int: The version
+    """
+
+    bumped = (
+        db.session.query(ApplicationConfigDb)
+        .filter(ApplicationConfigDb.key == VERSION_KEY)
+        .update({"version": ApplicationConfigDb.version + 1}, synchronize_session=False)
+    )
+    if not bumped:
+        # The database was created without the migration that adds the row
+        latest = db.session.query(func.max(ApplicationConfigDb.version)).scalar() or 0
+        db.session.add(ApplicationConfigDb(key=VERSION_KEY, version=latest + 1))
+        try:
+            db.session.flush()
+        except IntegrityError:
+            # Another worker added it first
+            db.session.rollback()
+            return next_version()
+
+    return db.session.query(ApplicationConfigDb.version).filter(ApplicationConfigDb.key == VERSION_KEY).scalar()
+
+
+def update_settings(changes):
+    """Store new values for settings, and swap in a new snapshot. A value of None resets a setting to its default.
+
+    Args:
+        changes (dict): The new values, by setting name
+
+    Raises:
+        KeyError: If a setting doesn't exist
+        ValueError: If a value is not valid for its setting
+
+    Returns:
+        Settings: The new snapshot
+    """
+
+    # Validate every value before storing any of them
+    parsed = {}
+    for key, value in changes.items():
+        if key not in SCHEMA:
+            raise KeyError(key)
+        parsed[key] = parse_value(key, value)
+
+    # Every row changed together gets the next version
+    version = next_version()
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    for key, value in parsed.items():
+        row = db.session.get(ApplicationConfigDb, key) or ApplicationConfigDb(key=key)
+        row.value = None if value is None else json.dumps(value)
+        row.version = version
+        row.updated = now
+        db.session.add(row)
+    db.session.commit()
+
+    return load_settings()
+
+
+def describe_settings(settings):
+    """Describe a snapshot for the config endpoint
+
+    Args:
+        settings (Settings): The snapshot
+
+    Returns:
+        dict: The version, and each setting's value and type
+    """
+
+    values = settings._asdict()
+    version = values.pop("version")
+    return {
+        "version": version,
+        "settings": values,
+        "types": {key: setting.type.__name__ for key, setting in SCHEMA.items()},
+    }
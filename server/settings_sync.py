@@ -0,0 +1,169 @@
+# settings_sync.py - Applies settings changed by an admin in every worker, without restarting the server.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import threading
+import time
+
+from models import ApplicationConfigDb, db
+from settings import current_settings, load_settings
+from sqlalchemy import func
+
+try:
+    import redis
+except ImportError:  # redis is optional, workers poll the database without it
+    redis = None
+
+CHANNEL = "settings"  # The Redis channel new settings versions are published on
+MAX_RECONNECT_DELAY = 30  # Seconds between attempts to reconnect to Redis, doubled from one second after each failure
+
+
+class SettingsSync:
+    """Keeps the settings of a worker up to date with the database.
+    A thread in each worker compares the newest settings version in the database with its own every poll interval,
+    and loads the new settings when it is newer, so a change reaches every worker and node within that interval.
+    With a Redis channel, the worker that made the change publishes its version, and the others check straight away.
+    Each check swaps in a whole new snapshot, so a request never sees half of a change.
+    """
+
+    def __init__(self, app, poll_interval, channel_url):
+        """
+        Args:
+            app (Flask): The Flask app
+            poll_interval (float): Seconds between checks of the database
+            channel_url (str): The Redis URL new versions are published on, or None to only poll
+        """
+
+        self.app = app
+        self.poll_interval = poll_interval
+        self.channel_url = channel_url
+        self._client = None
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+
+        if channel_url and redis is None:
+            app.logger.warning("SETTINGS_CHANNEL_URL is set but redis is not installed, settings are polled instead")
+            self.channel_url = None
+
+    def start(self):
+        """Start the poll and channel threads, once per process so gunicorn workers each get their own after forking"""
+
+        if self._pid == os.getpid() and all(thread.is_alive() for thread in self._threads):
+            return
+        with self._lock:
+            if self._pid == os.getpid() and all(thread.is_alive() for thread in self._threads):
+                return
+            self._pid = os.getpid()
+            self._client = redis.Redis.from_url(self.channel_url) if self.channel_url else None
+            self._threads = [threading.Thread(target=self.poll, name="settings-poll", daemon=True)]
+            if self._client is not None:
+                self._threads.append(threading.Thread(target=self.listen, name="settings-channel", daemon=True))
+            for thread in self._threads:
+                thread.start()
+
+    def publish(self, version):
+        """Tell the other workers about a new settings version
+
+        Args:
+            version (int): The version
+        """
+
+        if self._client is None:
+            return
+        try:
+            self._client.publish(CHANNEL, str(version))
+        except redis.RedisError as e:
+            # The other workers still pick the change up on their next poll
+            self.app.logger.warning("Failed to publish settings version %d: %s", version, e)
+
+    def check(self):
+        """Load the settings if the database has a newer version than this worker
+
+        Returns:
+            bool: If new settings were loaded
+        """
+
+        version = db.session.query(func.max(ApplicationConfigDb.version)).scalar() or 0
+        if version <= current_settings().version:
+            return False
+        settings = load_settings()
+        self.app.logger.info("Loaded settings version %d", settings.version)
+        return True
+
+    def poll(self):
+        """Check for new settings until the process exits"""
+
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            try:
+                with self.app.app_context():
+                    self.check()
+            except Exception:
+                self.app.logger.exception("Failed to check for new settings")
+
+    def listen(self):
+        """Wake the poll thread whenever another worker publishes a newer version, reconnecting to Redis if it drops"""
+
+        delay = 1
+        while True:
+            try:
+                pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CHANNEL)
+                # Changes published while disconnected were missed, so check once on every connect
+                self._wake.set()
+                delay = 1
+                for message in pubsub.listen():
+                    try:
+                        version = int(message["data"])
+                    except (TypeError, ValueError):
+                        continue
+                    if version > current_settings().version:
+                        self._wake.set()
+            except redis.RedisError as e:
+                self.app.logger.warning("Lost the settings channel (%s), reconnecting in %d seconds", e, delay)
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+
+_sync = None
+
+
+def init_settings_sync(app, poll_interval, channel_url):
+    """Keep the settings of every worker up to date, starting the threads on each worker's first request
+
+    Args:
+        app (Flask): The Flask app
+        poll_interval (float): Seconds between checks of the database
+        channel_url (str): The Redis URL new versions are published on, or None to only poll
+    """
+
+    global _sync
+    _sync = SettingsSync(app, poll_interval, channel_url)
+    app.before_request(_sync.start)
+
+
+def publish_settings(version):
+    """Tell the other workers about settings changed by this one
+
+    Args:
+        version (int): The new settings version
+    """
+
+    if _sync is not None:
+        _sync.publish(version)
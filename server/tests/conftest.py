@@ -0,0 +1,139 @@
+# conftest.py - Fixtures that run the server against a temporary SQLite database.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import os
+import sys
+import tempfile
+
+import pytest
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST_DIR = tempfile.mkdtemp(prefix="buffet-tests-")
+NO_PROCESS = 4194304  # Above the highest pid Linux hands out, for virtual machines whose processes the app may try to kill
+
+# The config is read when the app is imported, so the environment has to be set up first
+os.makedirs(f"{TEST_DIR}/iso")
+with open(f"{TEST_DIR}/iso/index.json", "w", encoding="utf-8") as f:
+    f.write("[]")
+os.environ.update(
+    {
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{TEST_DIR}/buffet.sqlite3",
+        "SECRET_KEY": "test-secret",
+        "JWT_SECRET_KEY": "test-jwt-secret",
+        "JWT_TOKEN_LOCATION": "cookies",
+        "JWT_ACCESS_TOKEN_EXPIRES": "1",
+        "JWT_REFRESH_TOKEN_EXPIRES": "1",
+        "JWT_COOKIE_CSRF_PROTECT": "",
+        "BCRYPT_LOG_ROUNDS": "4",
+        "BCRYPT_POOL_SIZE": "2",
+        "ISO_DIR": f"{TEST_DIR}/iso",
+        "LOG_DIR": f"{TEST_DIR}/logs",
+        "MAIL_SUPPRESS_SEND": "1",
+        "MAIL_USERNAME": "noreply@example.com",
+        "MAIL_QUEUE_POLL_INTERVAL": "3600",
+        "MAX_VM_COUNT": "5",
+        "MAX_VM_CORES": "1",
+        "MAX_VM_MEMORY": "256",
+        "VM_PORT_START": "5900",
+        "WEBSOCKET_PORT_START": "6080",
+        "RATE_LIMIT": "1000/minute",
+        "RATE_LIMIT_LOGIN": "1000/minute",
+        "SCHEDULER_ENABLED": "false",
+        "SETTINGS_POLL_INTERVAL": "3600",
+        "QUERY_BUDGET_ENFORCE": "true",
+        "TRACE_SAMPLE_RATE": "1",
+        "TRACE_FILE": f"{TEST_DIR}/traces.jsonl",
+    }
+)
+os.chdir(SERVER_DIR)
+sys.path.insert(0, SERVER_DIR)
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "postgres: runs against the PostgreSQL database in DATABASE_URL, skipped without one")
+
+
+@pytest.fixture(scope="session")
+def app():
+    """The app, imported once for the whole run"""
+
+    from app import app as flask_app
+
+    flask_app.config["TESTING"] = True
+    return flask_app
+
+
+@pytest.fixture(autouse=True)
+def db(app):
+    """Empty every table before each test, and give the test an app context"""
+
+    from models import db as database
+
+    with app.app_context():
+        database.drop_all()
+        database.create_all()
+        yield database
+        database.session.remove()
+        # The app stops the processes of every virtual machine left in the database when it exits
+        for table in reversed(database.metadata.sorted_tables):
+            database.session.execute(table.delete())
+        database.session.commit()
+
+
+@pytest.fixture
+def client(app):
+    """A test client, keeping the JWT cookies it is given"""
+
+    return app.test_client()
+
+
+@pytest.fixture
+def admin(db):
+    """An admin user called admin, with the password admin"""
+
+    from models import Users
+    from passwords import hash_password
+
+    user = Users(username="admin", email="admin@admin.com", password=hash_password("admin"), role="admin")
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+@pytest.fixture
+def admin_client(client, admin):
+    """A test client logged in as the admin"""
+
+    response = client.post("/api/user/login/", json={"username": "admin", "password": "admin"})
+    assert response.status_code == 200, response.get_json()
+    return client
+
+
+@pytest.fixture
+def iso_index():
+    """Write the ISO index, emptying it again after the test
+
+    Returns:
+        function: Writes a list of ISOs to index.json
+    """
+
+    def write(isos):
+        with open(f"{TEST_DIR}/iso/index.json", "w", encoding="utf-8") as f:
+            json.dump(isos, f)
+
+    yield write
+    write([])
@@ -0,0 +1,157 @@
+# test_admin_endpoints.py - Checks the admin panel's listings, exports and bulk actions.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import csv
+import importlib
+import io
+import json
+from datetime import datetime
+
+import pytest
+from conftest import NO_PROCESS
+from models import BannedUsers, Users, VirtualMachines
+from passwords import hash_password
+
+# The routes package exports the blueprint under the name of its module
+admin_endpoints = importlib.import_module("routes.admin_endpoints")
+
+
+@pytest.fixture
+def users(db):
+    """Three users, each with a virtual machine"""
+
+    rows = [Users(id=f"{i:032}", username=f"user{i}", email=f"user{i}@example.com", password="x", role="user") for i in range(3)]
+    db.session.add_all(rows)
+    db.session.flush()
+    db.session.add_all(
+        [
+            VirtualMachines(port=5901 + i, websocket_port=6081 + i, iso="test.iso", websockify_process_id=NO_PROCESS, process_id=NO_PROCESS, user_id=user.id, log_file="vm.log")
+            for i, user in enumerate(rows)
+        ]
+    )
+    db.session.commit()
+    return rows
+
+
+def test_user_vms(admin_client, users):
+    response = admin_client.get("/api/admin/user/vm/", json={"user_id": users[1].id})
+
+    assert response.status_code == 200
+    (vm,) = response.get_json()
+    assert (vm["port"], vm["wsport"], vm["user_id"]) == (5902, 6082, users[1].id)
+
+
+def test_user_vms_of_missing_user(admin_client, users):
+    assert admin_client.get("/api/admin/user/vm/", json={"user_id": "f" * 32}).status_code == 404
+
+
+@pytest.mark.parametrize("batch_size", [1000, 2])
+def test_export_ndjson(admin_client, users, monkeypatch, batch_size):
+    monkeypatch.setattr(admin_endpoints, "EXPORT_BATCH_SIZE", batch_size)
+
+    response = admin_client.get("/api/admin/user/export/?role=user")
+
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    assert response.headers["Content-Disposition"] == "attachment; filename=users.ndjson"
+    rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [row["username"] for row in rows] == ["user0", "user1", "user2"]
+
+
+@pytest.mark.parametrize("batch_size", [1000, 2])
+def test_export_csv(admin_client, users, monkeypatch, batch_size):
+    monkeypatch.setattr(admin_endpoints, "EXPORT_BATCH_SIZE", batch_size)
+
+    response = admin_client.get("/api/admin/vm/export/?format=csv")
+
+    assert response.status_code == 200
+    assert response.mimetype == "text/csv"
+    rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+    assert [(row["port"], row["user_id"]) for row in rows] == [(str(5901 + i), user.id) for i, user in enumerate(users)]
+
+
+def test_export_encodes_like_jsonify(admin_client, users, db):
+    users[0].login_time = datetime(2024, 1, 2, 3, 4, 5)
+    db.session.commit()
+
+    line = admin_client.get("/api/admin/user/export/?search=user0").get_data(as_text=True).splitlines()[0]
+    listed = admin_client.get("/api/admin/user/all/?search=user0").get_json()[0]
+
+    assert json.loads(line)["login_time"] == listed["login_time"] == "2024-01-02T03:04:05+00:00"
+
+
+def test_export_unknown_format(admin_client):
+    assert admin_client.get("/api/admin/user/export/?format=xml").status_code == 400
+
+
+@pytest.fixture
+def kills(monkeypatch):
+    """The arguments of every process started by the admin endpoints, which would be kill commands"""
+
+    calls = []
+    monkeypatch.setattr(admin_endpoints.subprocess, "Popen", lambda args, **kwargs: calls.append(args))
+    return calls
+
+
+def test_bulk_ban_and_unban(admin_client, users, kills, db):
+    user_ids = [users[0].id, users[2].id]
+
+    response = admin_client.put("/api/admin/user/ban/bulk/", json={"user_ids": user_ids + ["f" * 32], "ban_reason": "spam"})
+
+    assert response.get_json() == {"message": "Users banned", "count": 2}
+    # Both users' virtual machines are stopped with a single kill
+    assert kills == [["kill"] + [str(NO_PROCESS)] * 4]
+    assert db.session.query(Users.username).order_by(Users.username).all() == [("admin",), ("user1",)]
+    assert sorted(db.session.query(BannedUsers.user_id, BannedUsers.ban_reason)) == [(user_id, "spam") for user_id in user_ids]
+    assert db.session.query(VirtualMachines.user_id).all() == [(users[1].id,)]
+
+    response = admin_client.put("/api/admin/user/unban/bulk/", json={"user_ids": user_ids})
+
+    assert response.get_json() == {"message": "Users unbanned", "count": 2}
+    assert db.session.query(BannedUsers).count() == 0
+    assert sorted(db.session.query(Users.id, Users.token_version).filter(Users.id.in_(user_ids))) == [(user_id, 1) for user_id in user_ids]
+
+
+def test_bulk_delete_skips_admins(admin_client, admin, users, kills, db):
+    response = admin_client.delete("/api/admin/user/delete/bulk/", json={"user_ids": [admin.id, users[1].id]})
+
+    assert response.get_json() == {"message": "Users deleted", "count": 1}
+    assert kills == [["kill", str(NO_PROCESS), str(NO_PROCESS)]]
+    assert db.session.get(Users, admin.id) is not None
+    assert db.session.get(Users, users[1].id) is None
+    assert db.session.query(VirtualMachines).count() == 2
+
+
+@pytest.mark.parametrize("bulk", [True, False])
+def test_tokens_from_before_a_ban_stay_revoked(app, admin_client, kills, db, bulk):
+    db.session.add(Users(username="mallory", email="mallory@example.com", password=hash_password("password"), role="user"))
+    db.session.commit()
+    user_client = app.test_client()
+    assert user_client.post("/api/user/login/", json={"username": "mallory", "password": "password"}).status_code == 200
+    assert user_client.get("/api/user/").status_code == 200
+    user_id = db.session.query(Users.id).filter_by(username="mallory").scalar()
+
+    if bulk:
+        admin_client.put("/api/admin/user/ban/bulk/", json={"user_ids": [user_id]})
+        admin_client.put("/api/admin/user/unban/bulk/", json={"user_ids": [user_id]})
+    else:
+        admin_client.put("/api/admin/user/ban/", json={"user_id": user_id})
+        admin_client.put("/api/admin/user/unban/", json={"user_id": user_id})
+
+    assert db.session.query(Users.token_version).filter_by(username="mallory").scalar() == 1
+    assert user_client.get("/api/user/").status_code == 401
+    assert user_client.post("/api/user/login/", json={"username": "mallory", "password": "password"}).status_code == 200
+    assert user_client.get("/api/user/").status_code == 200
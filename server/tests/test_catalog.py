@@ -0,0 +1,102 @@
+# test_catalog.py - Checks that the ISO catalog is cached, versioned by its ETag, and rebuilt when its files change.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import base64
+import os
+import shutil
+
+import pytest
+from catalog import get_catalog
+from conftest import TEST_DIR
+
+ISO = {"iso": "test.iso", "name": "Test", "version": "1", "desktop": "None", "arch": "x86_64", "logo": "test.png"}
+LOGO = f"{TEST_DIR}/iso/logos/test.png"
+
+
+@pytest.fixture
+def catalog(iso_index):
+    """An index with one ISO and its logo, removed again after the test"""
+
+    os.makedirs(os.path.dirname(LOGO), exist_ok=True)
+    with open(LOGO, "wb") as f:
+        f.write(b"logo")
+    iso_index([ISO])
+    yield
+    shutil.rmtree(os.path.dirname(LOGO))
+
+
+def touch(path, size_change=b""):
+    """Move a file's modification time forward, as filesystems with coarse timestamps might not for a quick rewrite"""
+
+    if size_change:
+        with open(path, "ab") as f:
+            f.write(size_change)
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+
+def test_catalog_is_cached(catalog):
+    first = get_catalog()
+
+    assert get_catalog() is first
+    assert first["isos"]["test.iso"]["arch"] == "x86_64"
+
+
+def test_logo_is_embedded(admin_client, catalog):
+    response = admin_client.get("/api/vm/iso/")
+
+    assert response.status_code == 200
+    (iso,) = response.get_json()
+    assert base64.b64decode(iso["logo"]) == b"logo"
+    assert response.headers["Cache-Control"] == "private, no-cache"
+
+
+def test_unchanged_catalog_is_not_sent_again(admin_client, catalog):
+    etag = admin_client.get("/api/vm/iso/").headers["ETag"]
+
+    response = admin_client.get("/api/vm/iso/", headers={"If-None-Match": etag})
+
+    assert response.status_code == 304
+    assert response.data == b""
+    assert etag == f'"{get_catalog()["version"]}"'
+    assert admin_client.get("/api/user/bootstrap/").get_json()["catalog_version"] == get_catalog()["version"]
+
+
+@pytest.mark.parametrize("changed", ["index", "logo"])
+def test_changed_file_changes_the_etag(admin_client, catalog, iso_index, changed):
+    etag = admin_client.get("/api/vm/iso/").headers["ETag"]
+
+    if changed == "index":
+        iso_index([{**ISO, "version": "2"}])
+        touch(f"{TEST_DIR}/iso/index.json")
+    else:
+        touch(LOGO, b" v2")
+
+    response = admin_client.get("/api/vm/iso/", headers={"If-None-Match": etag})
+
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+def test_touched_file_rebuilds_with_the_same_etag(catalog):
+    first = get_catalog()
+
+    touch(f"{TEST_DIR}/iso/index.json")
+    rebuilt = get_catalog()
+
+    # The stat changed, so the files were read again, but the version only depends on what they contain
+    assert rebuilt is not first
+    assert rebuilt["version"] == first["version"]
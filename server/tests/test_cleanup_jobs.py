@@ -0,0 +1,40 @@
+# test_cleanup_jobs.py - Checks what the periodic cleanup jobs delete, and what they keep.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from datetime import timedelta
+
+import cleanup_jobs
+from mail_queue import MAX_ATTEMPTS, utcnow
+from models import OutboundEmails
+
+
+def test_prune_failed_email(db, monkeypatch):
+    monkeypatch.setattr(cleanup_jobs, "BATCH_SIZE", 2)
+    old = utcnow() - timedelta(days=cleanup_jobs.FAILED_EMAIL_RETENTION + 1)
+    recent = utcnow() - timedelta(days=1)
+
+    def email(attempts, next_attempt):
+        return OutboundEmails(recipients="a@example.com", subject="Hello", html="", created=old, attempts=attempts, next_attempt=next_attempt)
+
+    given_up = [email(MAX_ATTEMPTS, old) for _ in range(5)]
+    kept = [email(MAX_ATTEMPTS, recent), email(MAX_ATTEMPTS - 1, old)]
+    db.session.add_all(given_up + kept)
+    db.session.commit()
+    kept_ids = {row.id for row in kept}
+
+    assert cleanup_jobs.prune_failed_email() == "Deleted 5 emails that could not be sent"
+    assert {row.id for row in OutboundEmails.query} == kept_ids
+    assert cleanup_jobs.prune_failed_email() is None
@@ -0,0 +1,162 @@
+# test_db_pool.py - Checks the database pool's engine options for each backend, and the statistics it keeps.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import db_pool
+import pytest
+from db_pool import PoolStats, TimedQueuePool, engine_options, init_pool_stats, replica_binds
+from sqlalchemy import create_engine, exc, text
+from sqlalchemy.pool import NullPool
+
+# Pool size, max overflow, pool timeout, pool recycle and pre-ping, as passed to engine_options
+POOL_OPTIONS = (5, 10, 30.0, 1800, True)
+POOLED = {
+    "poolclass": TimedQueuePool,
+    "pool_size": 5,
+    "max_overflow": 10,
+    "pool_timeout": 30.0,
+    "pool_recycle": 1800,
+    "pool_pre_ping": True,
+}
+
+
+@pytest.mark.parametrize(
+    "uri, pgbouncer, options",
+    [
+        (None, False, {}),
+        ("sqlite://", False, {}),
+        ("sqlite:///:memory:", False, {}),
+        ("sqlite:////var/lib/buffet/buffet.sqlite3", False, POOLED),
+        ("postgresql://buffet@localhost/buffet", False, POOLED),
+        ("postgresql+psycopg://buffet@localhost/buffet", False, POOLED),
+        ("mysql+mysqlconnector://buffet@localhost/buffet", False, POOLED),
+        ("postgresql://buffet@localhost:6432/buffet", True, {"poolclass": NullPool}),
+        ("postgresql+psycopg://buffet@localhost:6432/buffet", True, {"poolclass": NullPool, "connect_args": {"prepare_threshold": None}}),
+    ],
+)
+def test_engine_options(uri, pgbouncer, options):
+    assert engine_options(uri, *POOL_OPTIONS, pgbouncer) == options
+
+
+def test_replica_binds():
+    binds = replica_binds(["postgresql://replica-a/buffet", "postgresql://replica-b/buffet"], *POOL_OPTIONS, False)
+
+    assert binds == {
+        "replica_0": {"url": "postgresql://replica-a/buffet", **POOLED},
+        "replica_1": {"url": "postgresql://replica-b/buffet", **POOLED},
+    }
+
+
+@pytest.fixture
+def stats(monkeypatch):
+    """Fresh pool statistics, in place of the worker's own"""
+
+    stats = PoolStats()
+    monkeypatch.setattr(db_pool, "pool_stats", stats)
+    return stats
+
+
+@pytest.fixture
+def engine(tmp_path, stats):
+    """An engine on a SQLite file, with a pool of one connection and no overflow"""
+
+    engine = create_engine(f"sqlite:///{tmp_path}/pool.sqlite3", **engine_options(f"sqlite:///{tmp_path}/pool.sqlite3", 1, 0, 0.1, 1800, True, False))
+    init_pool_stats(engine)
+    yield engine
+    engine.dispose()
+
+
+def test_checkouts_are_timed(engine, stats):
+    for _ in range(3):
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+
+    # The one connection is opened once and reused
+    assert (stats.checkouts, stats.connects, stats.timeouts) == (3, 1, 0)
+    assert 0 <= stats.wait_max <= stats.wait_total
+
+
+def test_checkout_timeout(engine, stats):
+    with engine.connect():
+        with pytest.raises(exc.TimeoutError):
+            engine.connect()
+
+    assert (stats.checkouts, stats.timeouts) == (1, 1)
+
+
+def test_invalidations(engine, stats):
+    with engine.connect() as conn:
+        conn.invalidate()
+
+    assert stats.invalidations == 1
+
+
+def test_snapshot(engine, stats):
+    with engine.connect():
+        snapshot = stats.snapshot(engine.pool)
+
+    assert snapshot["pool"] == "TimedQueuePool"
+    assert (snapshot["checkouts"], snapshot["timeouts"], snapshot["connects"]) == (1, 0, 1)
+    assert (snapshot["size"], snapshot["max_overflow"], snapshot["checked_out"], snapshot["idle"]) == (1, 0, 1, 0)
+    assert snapshot["utilization"] == 1
+
+    snapshot = stats.snapshot(engine.pool)
+
+    assert (snapshot["checked_out"], snapshot["idle"], snapshot["utilization"]) == (0, 1, 0)
+
+
+def test_snapshot_without_a_queue(stats):
+    engine = create_engine("sqlite://", poolclass=NullPool)
+
+    # NullPool keeps nothing open, so only the counters are reported
+    assert stats.snapshot(engine.pool) == {
+        "pid": stats.pid,
+        "pool": "NullPool",
+        "checkouts": 0,
+        "wait_avg_ms": 0,
+        "wait_max_ms": 0,
+        "timeouts": 0,
+        "connects": 0,
+        "invalidations": 0,
+    }
+
+
+def test_snapshot_wait_times(stats):
+    stats.record_checkout(0.001)
+    stats.record_checkout(0.003)
+
+    snapshot = stats.snapshot(NullPool(lambda: None))
+
+    assert (snapshot["wait_avg_ms"], snapshot["wait_max_ms"]) == (2, 3)
+
+
+def test_forked_worker_starts_afresh(stats):
+    stats.record_checkout(0.5)
+    stats.record_timeout()
+    # As if gunicorn had forked the worker after the counters were taken
+    stats.pid = -1
+
+    snapshot = stats.snapshot(NullPool(lambda: None))
+
+    assert (snapshot["checkouts"], snapshot["timeouts"], snapshot["wait_max_ms"]) == (0, 0, 0)
+    assert snapshot["pid"] == stats.pid != -1
+
+
+def test_pool_endpoint(admin_client):
+    response = admin_client.get("/api/admin/db/pool/")
+
+    assert response.status_code == 200
+    assert response.get_json()["pool"] == "TimedQueuePool"
+    assert response.get_json()["checkouts"] >= 1
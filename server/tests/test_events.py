@@ -0,0 +1,138 @@
+# test_events.py - Checks the event hub's fan out, its cap on open streams, and when streams end.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import queue
+import time
+
+import events
+import pytest
+from events import EventHub
+
+
+class FakeState:
+    """The capacity and virtual machines a hub loads, changed by the test instead of the database"""
+
+    def __init__(self):
+        self.capacity = {"vm_count": 0}
+        self.vms = {}
+        self.loads = 0
+
+    def __call__(self, user_ids):
+        self.loads += 1
+        return self.capacity, {user_id: self.vms.get(user_id) for user_id in user_ids}
+
+
+@pytest.fixture
+def state():
+    return FakeState()
+
+
+def make_hub(state, max_streams=10, max_age=60):
+    """Create a hub whose refresh thread never wakes on its own, so the test decides when it refreshes"""
+
+    return EventHub(state, interval=3600, max_streams=max_streams, max_age=max_age)
+
+
+def drain(subscriber):
+    """Get every event waiting on a queue
+
+    Returns:
+        list: The events
+    """
+
+    received = []
+    while True:
+        try:
+            received.append(subscriber.get_nowait())
+        except queue.Empty:
+            return received
+
+
+def test_subscribe_starts_with_current_state(app, state):
+    state.vms["alice"] = {"id": 1}
+    subscriber = make_hub(state).subscribe(app, "alice")
+
+    assert drain(subscriber) == [("capacity", {"vm_count": 0}), ("vm", {"id": 1})]
+
+
+def test_refresh_publishes_only_changes(app, state):
+    hub = make_hub(state)
+    alice, bob = hub.subscribe(app, "alice"), hub.subscribe(app, "bob")
+    drain(alice), drain(bob)
+
+    hub.refresh()
+    assert drain(alice) == [] and drain(bob) == []
+
+    state.vms["alice"] = {"id": 1}
+    hub.refresh()
+    assert drain(alice) == [("vm", {"id": 1})]
+    assert drain(bob) == []
+
+    state.capacity = {"vm_count": 1}
+    hub.refresh()
+    assert drain(alice) == [("capacity", {"vm_count": 1})]
+    assert drain(bob) == [("capacity", {"vm_count": 1})]
+
+
+def test_refresh_loads_every_user_at_once(app, state):
+    hub = make_hub(state)
+    for user_id in ("alice", "bob", "carol"):
+        hub.subscribe(app, user_id)
+    loads = state.loads
+
+    hub.refresh()
+
+    assert state.loads == loads + 1
+
+
+def test_max_streams(app, state):
+    hub = make_hub(state, max_streams=2)
+    first = hub.subscribe(app, "alice")
+    assert hub.subscribe(app, "bob") is not None
+    assert hub.subscribe(app, "carol") is None
+
+    hub.unsubscribe(first)
+    assert hub.subscribe(app, "carol") is not None
+
+
+def test_slow_client_is_disconnected(app, state, monkeypatch):
+    monkeypatch.setattr(events, "QUEUE_SIZE", 2)
+    hub = make_hub(state)
+    subscriber = hub.subscribe(app, "alice")
+
+    # The client never reads, so its queue fills up after a few changes
+    for count in range(1, 5):
+        state.capacity = {"vm_count": count}
+        hub.refresh()
+
+    assert drain(subscriber)[-1] == (None, None)
+    assert hub.subscribe(app, "bob") is not None
+    assert list(hub._subscribers.values()) == ["bob"]
+
+
+@pytest.mark.parametrize("max_age, token_lifetime", [(0.2, 60), (60, 0.2)])
+def test_stream_ends(app, state, max_age, token_lifetime):
+    hub = make_hub(state, max_age=max_age)
+    subscriber = hub.subscribe(app, "alice")
+
+    start = time.monotonic()
+    chunks = list(hub.stream(app, subscriber, time.time() + token_lifetime))
+
+    assert time.monotonic() - start < 5
+    assert chunks[0] == f"retry: {events.RECONNECT_DELAY}\n\n"
+    assert chunks[1:3] == ['event: capacity\ndata: {"vm_count":0}\n\n', "event: vm\ndata: null\n\n"]
+    # The slot is freed for another stream
+    assert hub._subscribers == {}
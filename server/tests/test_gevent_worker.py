@@ -0,0 +1,100 @@
+# test_gevent_worker.py - Runs the app under gunicorn's gevent worker, and checks one worker serves many requests at once.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests
+
+pytest.importorskip("gevent")
+
+STARTUP_TIMEOUT = 30  # Seconds to wait for gunicorn to accept connections
+STREAMS = 4  # Event streams held open at once, more than a worker without gevent accepts
+
+
+@pytest.fixture
+def server(tmp_path):
+    """Start gunicorn with a single gevent worker on a free port, with its own database
+
+    Yields:
+        str: The server's address
+    """
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+
+    env = dict(os.environ, SQLALCHEMY_DATABASE_URI=f"sqlite:///{tmp_path}/buffet.sqlite3", TRACE_SAMPLE_RATE="0")
+    log = open(tmp_path / "gunicorn.log", "w+", encoding="utf-8")
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "--bind", f"127.0.0.1:{port}", "--workers", "1", "--worker-class", "gevent", "--log-level", "warning", "app:app"],
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+
+    url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while True:
+            try:
+                requests.get(f"{url}/api/user/", timeout=5)
+                break
+            except (requests.ConnectionError, requests.Timeout):
+                # Connections are accepted before the worker has loaded the app
+                if process.poll() is not None or time.monotonic() > deadline:
+                    log.seek(0)
+                    pytest.fail(f"gunicorn did not start:\n{log.read()}")
+                time.sleep(0.2)
+        yield url
+    finally:
+        # A quick shutdown, as a graceful one waits for the open event streams to end
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        log.close()
+
+
+def test_one_worker_serves_streams_and_requests(server):
+    session = requests.Session()
+
+    # The password is checked in gevent's native thread pool
+    response = session.post(f"{server}/api/user/login/", json={"username": "admin", "password": "admin"}, timeout=10)
+    assert response.status_code == 200, response.text
+
+    # Event streams hold their request open, which only a gevent worker can do for more than a few at once
+    streams = [session.get(f"{server}/api/vm/events/", stream=True, timeout=10) for _ in range(STREAMS)]
+    try:
+        for stream in streams:
+            assert stream.status_code == 200, stream.text
+            assert next(stream.iter_lines()) == b"retry: 1000"
+
+        # The same worker still answers other requests while the streams are open
+        with ThreadPoolExecutor(8) as executor:
+            responses = list(executor.map(lambda _: session.get(f"{server}/api/user/", timeout=10), range(16)))
+        assert [response.status_code for response in responses] == [200] * 16
+    finally:
+        for stream in streams:
+            stream.close()
@@ -0,0 +1,71 @@
+# test_identity.py - Checks the single query that finds accounts across the active, unverified and banned tables.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+from identity import ACTIVE, BANNED, UNVERIFIED, Identity, find_identities, first_identity
+from models import BannedUsers, UnverifiedUsers, Users
+from scheduler import utcnow
+
+
+@pytest.fixture
+def accounts(db):
+    """One account in each table"""
+
+    db.session.add_all(
+        [
+            Users(id="a" * 32, username="alice", email="alice@example.com", password="x", role="user"),
+            UnverifiedUsers(username="bob", email="bob@example.com", password="x", created=utcnow()),
+            BannedUsers(user_id="c" * 32, username="carol", email="carol@example.com", password="x", role="user", ban_reason="spam"),
+        ]
+    )
+    db.session.commit()
+
+
+def test_finds_each_table(accounts):
+    identities = find_identities(usernames=["alice", "bob"], emails=["carol@example.com"])
+
+    assert sorted((identity.state, identity.username) for identity in identities) == [(ACTIVE, "alice"), (BANNED, "carol"), (UNVERIFIED, "bob")]
+    assert first_identity(identities, state=BANNED) == Identity(BANNED, "c" * 32, "carol", "carol@example.com", "spam")
+
+
+def test_states_limit_the_tables(accounts):
+    identities = find_identities(usernames=["alice", "bob", "carol"], states=(UNVERIFIED, BANNED))
+
+    assert {identity.state for identity in identities} == {UNVERIFIED, BANNED}
+
+
+def test_nothing_asked_for(accounts):
+    assert find_identities(usernames=[""], emails=[None]) == []
+
+
+def test_first_identity_filters():
+    identities = [
+        Identity(ACTIVE, "1", "alice", "alice@example.com", None),
+        Identity(BANNED, "2", "carol", "carol@example.com", "spam"),
+    ]
+
+    assert first_identity(identities, username="carol").id == "2"
+    assert first_identity(identities, email="alice@example.com").id == "1"
+    assert first_identity(identities, state=BANNED, username="alice") is None
+    assert first_identity([], state=ACTIVE) is None
+
+
+def test_first_identity_ignores_case():
+    # A case-insensitive collation, like MySQL's default one, returns the row as it was stored
+    identities = [Identity(BANNED, "2", "Carol", "Carol@Example.com", "spam")]
+
+    assert first_identity(identities, username="carol").id == "2"
+    assert first_identity(identities, email="CAROL@example.com").id == "2"
@@ -0,0 +1,123 @@
+# test_indexes.py - Checks that the hot lookups are answered from an index rather than a scan of the table.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+
+import pytest
+from models import BannedUsers, UnverifiedUsers, Users, VirtualMachines
+from sqlalchemy import create_engine, text
+
+DATABASE_URL = os.environ.get("DATABASE_URL")  # A PostgreSQL database to check the plans on as well, i.e. postgresql://localhost/buffet_test
+
+# Each lookup, and the index that should answer it
+LOOKUPS = [
+    (lambda: Users.query.filter_by(email="a@example.com"), "ix_users_email"),
+    (lambda: UnverifiedUsers.query.filter_by(email="a@example.com"), "ix_unverified_users_email"),
+    (lambda: BannedUsers.query.filter_by(email="a@example.com"), "ix_banned_users_email"),
+    (lambda: BannedUsers.query.filter_by(user_id="0" * 32), "ix_banned_users_user_id"),
+    (lambda: VirtualMachines.query.filter_by(user_id="0" * 32), "ix_virtual_machines_user_id"),
+    (lambda: VirtualMachines.query.filter_by(port=5900), "ix_virtual_machines_port"),
+    (lambda: Users.query.order_by(Users.role, Users.id).limit(50), "ix_users_role"),
+    (lambda: Users.query.filter(Users.login_time.isnot(None)).order_by(Users.login_time, Users.id).limit(50), "ix_users_login_time"),
+]
+
+
+def query_plan(db, query):
+    """Get SQLite's plan for a query
+
+    Args:
+        db (SQLAlchemy): The database
+        query (Query): The query
+
+    Returns:
+        list: The steps of the plan, i.e. "SEARCH users USING INDEX ix_users_email (email=?)"
+    """
+
+    sql = query.statement.compile(db.engine, compile_kwargs={"literal_binds": True})
+    return [row[3] for row in db.session.execute(text(f"EXPLAIN QUERY PLAN {sql}"))]
+
+
+@pytest.mark.parametrize("lookup, index", LOOKUPS)
+def test_lookup_uses_index(db, lookup, index):
+    plan = query_plan(db, lookup())
+
+    # Reading a whole index in order is fine for a page, scanning the table or sorting it is not
+    assert any(index in step for step in plan), plan
+    assert not any(step.startswith("SCAN") and "INDEX" not in step for step in plan), plan
+    assert not any("TEMP B-TREE" in step for step in plan), plan
+
+
+def test_login_lookup_uses_both_indexes(db):
+    # Logins match either the username or the email, which needs an index on each
+    plan = query_plan(db, Users.query.filter((Users.username == "a") | (Users.email == "a")))
+
+    assert any("ix_users_email" in step for step in plan), plan
+    assert any("sqlite_autoindex_users" in step for step in plan), plan
+    assert not any(step.startswith("SCAN") for step in plan), plan
+
+
+@pytest.fixture
+def postgres(db):
+    """A connection to DATABASE_URL with the tables created in a schema of their own, rolled back afterwards
+
+    Yields:
+        Connection: The connection
+    """
+
+    if not DATABASE_URL:
+        pytest.skip("DATABASE_URL is not set")
+    engine = create_engine(DATABASE_URL)
+    if engine.dialect.name != "postgresql":
+        pytest.skip("DATABASE_URL is not a PostgreSQL database")
+
+    # PostgreSQL rolls back schema changes too, so nothing is left behind
+    with engine.connect() as conn:
+        conn.execute(text("CREATE SCHEMA buffet_plans"))
+        conn.execute(text("SET LOCAL search_path TO buffet_plans"))
+        db.metadata.create_all(conn)
+        # The tables are empty, so without this the planner would scan them whatever indexes there are
+        conn.execute(text("SET LOCAL enable_seqscan = off"))
+        yield conn
+        conn.rollback()
+    engine.dispose()
+
+
+def postgres_plan(conn, query):
+    """Get PostgreSQL's plan for a query
+
+    Returns:
+        str: The plan, i.e. "Index Scan using ix_users_email on users ..."
+    """
+
+    sql = query.statement.compile(conn, compile_kwargs={"literal_binds": True})
+    return "\n".join(row[0] for row in conn.execute(text(f"EXPLAIN {sql}")))
+
+
+@pytest.mark.postgres
+@pytest.mark.parametrize("lookup, index", LOOKUPS)
+def test_postgres_lookup_uses_index(postgres, lookup, index):
+    plan = postgres_plan(postgres, lookup())
+
+    assert index in plan, plan
+    assert "Seq Scan" not in plan, plan
+
+
+@pytest.mark.postgres
+def test_postgres_login_lookup_uses_both_indexes(postgres):
+    plan = postgres_plan(postgres, Users.query.filter((Users.username == "a") | (Users.email == "a")))
+
+    assert "ix_users_email" in plan and "users_username_key" in plan, plan
+    assert "Seq Scan" not in plan, plan
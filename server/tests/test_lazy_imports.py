@@ -0,0 +1,52 @@
+# test_lazy_imports.py - Checks that a worker starts without importing the optional dependencies it only needs on first use.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+LAZY_MODULES = ["qrcode", "PIL", "flask_ldap3_login", "ldap3", "qemu", "password_strength", "flask_mail"]
+
+
+def imported_by_app(tmp_path, **env):
+    """Import the app in a fresh interpreter, with its own database
+
+    Returns:
+        list: The lazily loaded modules that were imported anyway
+    """
+
+    code = f"import json, sys, app; print(json.dumps([m for m in {LAZY_MODULES!r} if m in sys.modules]))"
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        env=dict(os.environ, SQLALCHEMY_DATABASE_URI=f"sqlite:///{tmp_path}/buffet.sqlite3", TRACE_SAMPLE_RATE="0", **env),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def test_optional_dependencies_are_not_imported(tmp_path):
+    assert imported_by_app(tmp_path) == []
+
+
+def test_ldap_is_imported_when_enabled(tmp_path):
+    pytest.importorskip("flask_ldap3_login")
+
+    assert imported_by_app(tmp_path, LDAP_ENABLED="true", LDAP_HOST="localhost") == ["flask_ldap3_login", "ldap3"]
@@ -0,0 +1,196 @@
+# test_ldap_auth.py - Checks the pooled LDAP login manager against ldap3's in-process mock directory.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+
+import ldap_auth
+import pytest
+from flask import Flask
+from flask_ldap3_login import AuthenticationResponseStatus, LDAP3LoginManager
+from ldap_auth import LDAPConnectionPool, PooledLDAP3LoginManager, TTLCache
+
+BIND_DN = "cn=svc,dc=example,dc=com"
+ALICE_DN = "uid=alice,ou=people,dc=example,dc=com"
+GROUP_DN = "cn=lab,ou=groups,dc=example,dc=com"
+DIRECTORY = {
+    "entries": [
+        {"dn": BIND_DN, "raw": {"cn": ["svc"], "objectClass": ["person"], "userPassword": ["svc-password"]}},
+        {
+            "dn": ALICE_DN,
+            "raw": {"uid": ["alice"], "cn": ["alice"], "mail": ["alice@example.com"], "objectClass": ["person"], "userPassword": ["alice-password"]},
+        },
+        {"dn": GROUP_DN, "raw": {"cn": ["lab"], "objectClass": ["group"], "uniqueMember": [ALICE_DN]}},
+    ]
+}
+
+
+@pytest.fixture
+def make_manager(tmp_path):
+    """Create a login manager for a directory served by ldap3's MOCK_SYNC strategy instead of an LDAP server"""
+
+    directory = tmp_path / "directory.json"
+    directory.write_text(json.dumps(DIRECTORY), encoding="utf-8")
+
+    def make(cache_ttl=60):
+        app = Flask(__name__)
+        app.config.update(
+            SECRET_KEY="test-secret",
+            LDAP_HOST="localhost",
+            LDAP_BASE_DN="dc=example,dc=com",
+            LDAP_USER_DN="ou=people",
+            LDAP_GROUP_DN="ou=groups",
+            LDAP_USER_RDN_ATTR="cn",
+            LDAP_USER_LOGIN_ATTR="uid",
+            LDAP_BIND_USER_DN=BIND_DN,
+            LDAP_BIND_USER_PASSWORD="svc-password",
+            LDAP_POOL_SIZE=2,
+            LDAP_CACHE_TTL=cache_ttl,
+            LDAP_MOCK_DATA=str(directory),
+        )
+        return app, PooledLDAP3LoginManager(app)
+
+    return make
+
+
+@pytest.fixture
+def directory_logins(monkeypatch):
+    """Count the logins that reach the directory"""
+
+    calls = []
+    authenticate = LDAP3LoginManager.authenticate
+
+    def counting(self, username, password):
+        calls.append(username)
+        return authenticate(self, username, password)
+
+    monkeypatch.setattr(LDAP3LoginManager, "authenticate", counting)
+    return calls
+
+
+def test_login_reuses_bind_connection(make_manager):
+    app, manager = make_manager(cache_ttl=0)
+    created = []
+    get = manager.pool.get
+    manager.pool.get = lambda create: get(lambda: created.append(1) or create())
+
+    for _ in range(3):
+        with app.app_context():
+            response = manager.authenticate("alice", "alice-password")
+            assert response.status == AuthenticationResponseStatus.success
+            assert response.user_dn == ALICE_DN
+            assert [group["dn"] for group in response.user_groups] == [GROUP_DN]
+
+    # Each app context returned the connection to the pool on teardown, and the next one took it back out
+    assert len(created) == 1
+    assert len(manager.pool._idle) == 1
+
+
+def test_successful_login_is_cached(make_manager, directory_logins):
+    app, manager = make_manager()
+
+    for _ in range(3):
+        with app.app_context():
+            assert manager.authenticate("alice", "alice-password").status == AuthenticationResponseStatus.success
+
+    assert directory_logins == ["alice"]
+
+
+def test_failed_login_is_not_cached(make_manager, directory_logins):
+    app, manager = make_manager()
+
+    with app.app_context():
+        assert manager.authenticate("alice", "wrong").status == AuthenticationResponseStatus.fail
+        assert manager.authenticate("alice", "wrong").status == AuthenticationResponseStatus.fail
+        assert manager.authenticate("alice", "alice-password").status == AuthenticationResponseStatus.success
+
+    assert directory_logins == ["alice"] * 3
+
+
+def test_user_lookup(make_manager):
+    app, manager = make_manager()
+
+    with app.app_context():
+        info = manager.get_user_info(ALICE_DN)
+        assert info["mail"] == ["alice@example.com"]
+        assert manager.get_user_info(ALICE_DN) == info
+
+
+def test_cache_expires(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(ldap_auth.time, "monotonic", lambda: now[0])
+    cache = TTLCache(ttl=10)
+    cache.set("key", {"groups": ["lab"]})
+
+    cached, value = cache.get("key")
+    assert cached and value == {"groups": ["lab"]}
+    # Callers get a copy, so changing it doesn't change the cache
+    value["groups"].append("admins")
+    assert cache.get("key") == (True, {"groups": ["lab"]})
+
+    now[0] += 10
+    assert cache.get("key") == (False, None)
+
+
+def test_cache_drops_least_recently_used():
+    cache = TTLCache(ttl=60, max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert cache.get("a") == (True, 1)
+    assert cache.get("b") == (False, None)
+
+
+class FakeConnection:
+    """A connection the pool can hand out, return and unbind"""
+
+    def __init__(self):
+        self.closed = False
+        self.bound = True
+
+    def unbind(self):
+        self.closed = True
+        self.bound = False
+
+
+def test_pool_keeps_up_to_size_idle():
+    pool = LDAPConnectionPool(size=1)
+    first, second = pool.get(FakeConnection), pool.get(FakeConnection)
+    assert first is not second and pool.owns(first) and pool.owns(second)
+
+    pool.put(first)
+    pool.put(second)
+
+    assert not first.closed
+    assert second.closed and not pool.owns(second)
+    assert pool.get(FakeConnection) is first
+
+
+def test_pool_discards_closed_and_idle_connections(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(ldap_auth.time, "monotonic", lambda: now[0])
+    pool = LDAPConnectionPool(size=2)
+    dropped, idle = pool.get(FakeConnection), pool.get(FakeConnection)
+    pool.put(dropped)
+    pool.put(idle)
+    dropped.closed = True
+
+    now[0] += ldap_auth.IDLE_TIMEOUT + 1
+    fresh = pool.get(FakeConnection)
+
+    assert fresh is not dropped and fresh is not idle
+    assert idle.closed
@@ -0,0 +1,209 @@
+# test_mail_queue.py - Checks that each queued email is claimed by one worker, and retried or given up on.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import smtplib
+import socket
+import threading
+from datetime import timedelta
+
+import mail_queue
+import pytest
+from mail_queue import BATCH_SIZE, MAX_ATTEMPTS, MailSender, utcnow
+from models import OutboundEmails
+
+
+def add_emails(db, count, **columns):
+    """Queue emails that are due now
+
+    Returns:
+        list: The ids of the emails
+    """
+
+    now = utcnow()
+    emails = [
+        OutboundEmails(**{"recipients": f"user{i}@example.com", "subject": "Hello", "html": "<p>Hello</p>", "created": now, "next_attempt": now, **columns})
+        for i in range(count)
+    ]
+    db.session.add_all(emails)
+    db.session.commit()
+    return [email.id for email in emails]
+
+
+class FakeConnection:
+    """An SMTP connection that records what it sends, or fails every send"""
+
+    def __init__(self, error=None):
+        self.sent = []
+        self.error = error
+
+    def send(self, message):
+        if self.error:
+            raise self.error
+        self.sent.append(message)
+
+
+def test_claims_are_disjoint(app, db):
+    ids = add_emails(db, BATCH_SIZE + 10)
+    first, second = MailSender(app), MailSender(app)
+
+    claimed_first = {email.id for email in first.claim_batch()}
+    claimed_second = {email.id for email in second.claim_batch()}
+
+    assert len(claimed_first) == BATCH_SIZE
+    assert claimed_first.isdisjoint(claimed_second)
+    assert claimed_first | claimed_second == set(ids)
+    assert first.claim_batch() == []
+
+
+def test_concurrent_claims_are_disjoint(app, db):
+    ids = add_emails(db, BATCH_SIZE * 3)
+    claims, errors = [], []
+
+    def claim():
+        sender = MailSender(app)
+        try:
+            with app.app_context():
+                while emails := sender.claim_batch():
+                    claims.extend(email.id for email in emails)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=claim) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert sorted(claims) == sorted(ids)
+
+
+def test_skips_email_that_is_not_due_or_given_up_on(app, db):
+    add_emails(db, 1, next_attempt=utcnow() + timedelta(minutes=5))
+    add_emails(db, 1, attempts=MAX_ATTEMPTS)
+
+    assert MailSender(app).claim_batch() == []
+
+
+def test_expired_claim_is_taken_over(app, db):
+    add_emails(db, 1, claimed_by="0" * 32, claimed_until=utcnow() + timedelta(minutes=5))
+    ids = add_emails(db, 1, claimed_by="1" * 32, claimed_until=utcnow() - timedelta(seconds=1))
+
+    assert [email.id for email in MailSender(app).claim_batch()] == ids
+
+
+def test_sent_email_is_deleted(app, db, monkeypatch):
+    add_emails(db, 2)
+    sender, connection = MailSender(app), FakeConnection()
+    monkeypatch.setattr(sender, "connect", lambda: connection)
+
+    assert sender.send_batch() is False
+    assert len(connection.sent) == 2
+    assert OutboundEmails.query.count() == 0
+
+
+@pytest.mark.parametrize(
+    "error", [smtplib.SMTPServerDisconnected("Connection lost"), OSError("Network is unreachable"), UnicodeEncodeError("ascii", "é", 0, 1, "bad")]
+)
+def test_failed_email_is_rescheduled(app, db, monkeypatch, error):
+    (email_id,) = add_emails(db, 1)
+    sender = MailSender(app)
+    monkeypatch.setattr(sender, "connect", lambda: FakeConnection(error))
+
+    sender.send_batch()
+
+    email = db.session.get(OutboundEmails, email_id)
+    assert email.attempts == 1
+    assert email.next_attempt > utcnow()
+    assert email.claimed_by is None and email.claimed_until is None
+    assert email.last_error == str(error)
+    assert sender.claim_batch() == []
+
+
+def test_failing_email_is_given_up_on(app, db, monkeypatch):
+    (email_id,) = add_emails(db, 1)
+    sender = MailSender(app)
+    monkeypatch.setattr(sender, "connect", lambda: FakeConnection(ValueError("Bad header")))
+
+    for _ in range(MAX_ATTEMPTS):
+        db.session.get(OutboundEmails, email_id).next_attempt = utcnow()
+        db.session.commit()
+        sender.send_batch()
+
+    assert db.session.get(OutboundEmails, email_id).attempts == MAX_ATTEMPTS
+    db.session.get(OutboundEmails, email_id).next_attempt = utcnow()
+    db.session.commit()
+    assert sender.claim_batch() == []
+
+
+@pytest.fixture
+def smtp_server(app, monkeypatch):
+    """A local SMTP server that Flask-Mail sends to
+
+    Returns:
+        list: The client address and recipients of each message it received, so connections can be told apart
+    """
+
+    controller_module = pytest.importorskip("aiosmtpd.controller")
+    from flask_mail import Mail
+
+    received = []
+
+    class Handler:
+        async def handle_DATA(self, server, session, envelope):
+            received.append((session.peer, envelope.rcpt_tos))
+            return "250 OK"
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    controller = controller_module.Controller(Handler(), hostname="127.0.0.1", port=port)
+    controller.start()
+
+    for key, value in {"MAIL_SERVER": "127.0.0.1", "MAIL_PORT": port, "MAIL_USE_TLS": False, "MAIL_PASSWORD": None, "MAIL_SUPPRESS_SEND": False}.items():
+        monkeypatch.setitem(app.config, key, value)
+    monkeypatch.setitem(app.extensions, "mail", None)
+    Mail(app)
+    yield received
+    controller.stop()
+
+
+def test_connection_is_reused_across_a_batch(app, db, smtp_server):
+    add_emails(db, 5)
+    sender = MailSender(app)
+
+    assert sender.send_batch() is False
+    add_emails(db, 2)
+    assert sender.send_batch() is False
+    sender.close()
+
+    # Every email went over the one connection, which was kept open for the next batch
+    assert len(smtp_server) == 7
+    assert len({peer for peer, recipients in smtp_server}) == 1
+    assert OutboundEmails.query.count() == 0
+
+
+def test_connection_is_reopened_after_a_full_batch(app, db, smtp_server, monkeypatch):
+    monkeypatch.setattr(mail_queue, "BATCH_SIZE", 2)
+    add_emails(db, 5)
+    sender = MailSender(app)
+
+    while sender.send_batch():
+        pass
+    sender.close()
+
+    assert sorted(recipients for peer, recipients in smtp_server) == [[f"user{i}@example.com"] for i in range(5)]
+    assert len({peer for peer, recipients in smtp_server}) == 3
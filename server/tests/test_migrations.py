@@ -0,0 +1,89 @@
+# test_migrations.py - Checks the migrations that change existing rows, on a database with the schema from before them.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import glob
+import importlib.util
+
+import pytest
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.dialects import mysql
+
+
+def load_migration(revision):
+    """Import a migration by its revision id
+
+    Returns:
+        module: The migration
+    """
+
+    (path,) = glob.glob(f"migrations/versions/{revision}_*.py")
+    spec = importlib.util.spec_from_file_location(f"migration_{revision}", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def engine(tmp_path):
+    """A SQLite database of its own, so the schema can be set up as it was before a migration"""
+
+    engine = create_engine(f"sqlite:///{tmp_path}/migrations.sqlite3")
+    yield engine
+    engine.dispose()
+
+
+def upgrade(engine, revision):
+    """Run a migration's upgrade on a database"""
+
+    with engine.begin() as conn, Operations.context(MigrationContext.configure(conn)):
+        load_migration(revision).upgrade()
+
+
+def test_unique_virtual_machine_user_keeps_the_newest(engine):
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE virtual_machines (id INTEGER PRIMARY KEY, user_id VARCHAR(32) NOT NULL)"))
+        conn.execute(text("CREATE INDEX ix_virtual_machines_user_id ON virtual_machines (user_id)"))
+        conn.execute(text("INSERT INTO virtual_machines (id, user_id) VALUES (1, 'a'), (2, 'b'), (3, 'a'), (4, 'a')"))
+
+    upgrade(engine, "f8c2d6e0a471")
+
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT id, user_id FROM virtual_machines ORDER BY id")).all() == [(2, "b"), (4, "a")]
+    (index,) = inspect(engine).get_indexes("virtual_machines")
+    assert index["name"] == "ix_virtual_machines_user_id" and index["unique"]
+
+
+def test_unique_virtual_machine_user_deletes_through_a_derived_table():
+    # MySQL refuses to delete from a table named in a subquery of the same statement, but not one wrapped in a derived table
+    sql = str(load_migration("f8c2d6e0a471").delete_duplicates().compile(dialect=mysql.dialect()))
+
+    assert "FROM (SELECT max(virtual_machines.id) AS id" in sql
+    assert sql.rstrip().endswith("AS keep))")
+
+
+def test_banned_users_token_version_starts_above_zero(engine):
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE banned_users (id INTEGER PRIMARY KEY, user_id VARCHAR(32) NOT NULL)"))
+        conn.execute(text("INSERT INTO banned_users (id, user_id) VALUES (1, 'a')"))
+
+    upgrade(engine, "a3e7c9d1f264")
+
+    with engine.begin() as conn:
+        assert conn.execute(text("SELECT token_version FROM banned_users")).scalar() == 1
+        conn.execute(text("INSERT INTO banned_users (id, user_id) VALUES (2, 'b')"))
+        assert conn.execute(text("SELECT token_version FROM banned_users WHERE id = 2")).scalar() == 0
@@ -0,0 +1,100 @@
+# test_pagination.py - Checks that walking the pages of a listing returns every row once, in order.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from datetime import datetime, timedelta
+
+import pytest
+from models import Users
+from pagination import paginate
+from routes.admin_endpoints import USER_SORT_COLUMNS
+from test_indexes import query_plan
+from werkzeug.datastructures import MultiDict
+
+
+@pytest.fixture
+def users(db):
+    """Users with repeated roles and login times, a third of them never logged in"""
+
+    start = datetime(2024, 1, 1)
+    rows = []
+    for i in range(20):
+        login_time = None if i % 3 == 0 else start + timedelta(hours=i % 4)
+        rows.append(Users(username=f"user{i:02}", email=f"user{i}@example.com", password="x", role=("admin", "user")[i % 2], login_time=login_time))
+    db.session.add_all(rows)
+    db.session.commit()
+    return rows
+
+
+def expected_order(users, sort, descending):
+    """Sort the users the way a listing should: NULLs first ascending and last descending, then by the id
+
+    Returns:
+        list: The ids
+    """
+
+    nulls = sorted((user.id for user in users if getattr(user, sort) is None), reverse=descending)
+    values = sorted(((getattr(user, sort), user.id) for user in users if getattr(user, sort) is not None), reverse=descending)
+    ids = [row_id for _, row_id in values]
+    return ids + nulls if descending else nulls + ids
+
+
+def walk(sort, order, limit):
+    """Follow the cursors of a listing until the last page
+
+    Returns:
+        list: The ids of every row returned
+    """
+
+    ids, cursor = [], None
+    while True:
+        args = MultiDict({"sort": sort, "order": order, "limit": str(limit)})
+        if cursor:
+            args["cursor"] = cursor
+        page = paginate(Users.query, Users.id, USER_SORT_COLUMNS, "username", args)
+        assert len(page["items"]) <= limit
+        ids += [user.id for user in page["items"]]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return ids
+
+
+@pytest.mark.parametrize("sort", ["username", "role", "login_time"])
+@pytest.mark.parametrize("order", ["asc", "desc"])
+@pytest.mark.parametrize("limit", [1, 3, 7, 20, 50])
+def test_walk_returns_every_row_in_order(users, sort, order, limit):
+    assert walk(sort, order, limit) == expected_order(users, sort, order == "desc")
+
+
+def test_count(users):
+    page = paginate(Users.query, Users.id, USER_SORT_COLUMNS, "username", MultiDict({"limit": "5", "count": "true"}))
+
+    assert page["total"] == len(users)
+    assert len(page["items"]) == 5
+
+
+@pytest.mark.parametrize("args", [{"sort": "password"}, {"order": "up"}, {"limit": "0"}, {"cursor": "not a cursor"}])
+def test_invalid_arguments(users, args):
+    with pytest.raises(ValueError):
+        paginate(Users.query, Users.id, USER_SORT_COLUMNS, "username", MultiDict(args))
+
+
+@pytest.mark.parametrize("column, index", [(Users.role, "ix_users_role"), (Users.login_time, "ix_users_login_time")])
+def test_sort_uses_index(db, column, index):
+    # Reading the index in order means no temporary b-tree to sort the whole table
+    plan = query_plan(db, Users.query.filter(column.isnot(None)).order_by(column, Users.id).limit(50))
+
+    assert any(index in step for step in plan), plan
+    assert not any("TEMP B-TREE" in step for step in plan), plan
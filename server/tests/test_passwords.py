@@ -0,0 +1,98 @@
+# test_passwords.py - Checks hashing in the process pool, and refusing work when too much is queued.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import passwords
+import pytest
+
+
+def test_round_trip():
+    pw_hash = passwords.hash_password("correct horse")
+
+    assert passwords.check_password(pw_hash, "correct horse")
+    assert not passwords.check_password(pw_hash, "battery staple")
+    assert not passwords.needs_rehash(pw_hash)
+
+
+def test_needs_rehash():
+    assert passwords.needs_rehash("$2b$12$" + "a" * 53)
+    assert passwords.needs_rehash("not a hash")
+
+
+def test_pool_does_not_fork():
+    # Forking a process that runs other threads can copy a held lock into the child
+    expected = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+    assert passwords._get_pool()._mp_context.get_start_method() == expected
+
+
+def test_concurrent_hashes():
+    words = [f"password {i}" for i in range(16)]
+    with ThreadPoolExecutor(8) as executor:
+        hashes = list(executor.map(passwords.hash_password, words))
+
+    assert len(set(hashes)) == len(words)
+    with ThreadPoolExecutor(8) as executor:
+        assert all(executor.map(passwords.check_password, hashes, words))
+
+
+@pytest.fixture
+def full_pool(monkeypatch):
+    """Take every pending slot, as if the pool were already busy with other requests"""
+
+    pending = threading.BoundedSemaphore(1)
+    pending.acquire()
+    monkeypatch.setattr(passwords, "_pending", pending)
+    monkeypatch.setattr(passwords, "TIMEOUT", 0.01)
+
+
+def test_busy_when_pool_is_full(full_pool):
+    with pytest.raises(passwords.PasswordHasherBusy):
+        passwords.hash_password("correct horse")
+
+
+def test_busy_login_gets_503(admin, client, full_pool):
+    response = client.post("/api/user/login/", json={"username": "admin", "password": "admin"})
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(passwords.RETRY_AFTER)
+    assert response.get_json()["message"] == "The server is busy. Please try again later."
+
+
+def test_busy_when_hash_takes_too_long(monkeypatch):
+    monkeypatch.setattr(passwords, "TIMEOUT", 0.01)
+
+    with pytest.raises(passwords.PasswordHasherBusy):
+        passwords._run(time.sleep, 1)
+
+    # The slot is given back for the next request
+    assert passwords._pending.acquire(timeout=0)
+    passwords._pending.release()
+
+
+def test_slow_login_gets_503(admin, client, monkeypatch):
+    monkeypatch.setattr(passwords, "_get_pool", lambda: ThreadPoolExecutor(1))
+    monkeypatch.setattr(passwords, "_check", lambda pw_hash, password: time.sleep(1))
+    monkeypatch.setattr(passwords, "TIMEOUT", 0.01)
+
+    response = client.post("/api/user/login/", json={"username": "admin", "password": "admin"})
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(passwords.RETRY_AFTER)
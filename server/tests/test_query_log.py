@@ -0,0 +1,90 @@
+# test_query_log.py - Checks that endpoints stay within their query budgets, and that going over fails the request.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+
+import pytest
+from conftest import NO_PROCESS
+from models import BannedUsers, UnverifiedUsers, Users, VirtualMachines
+from scheduler import utcnow
+
+
+@pytest.fixture
+def rows(db, admin):
+    """A few rows in every listed table, so a query per row would go over the budget"""
+
+    users = [Users(username=f"user{i}", email=f"user{i}@example.com", password="x", role="user") for i in range(3)]
+    db.session.add_all(users)
+    db.session.flush()
+    db.session.add_all(
+        [
+            VirtualMachines(port=5901 + i, websocket_port=6081 + i, iso="test.iso", websockify_process_id=NO_PROCESS, process_id=NO_PROCESS, user_id=user.id, log_file="vm.log")
+            for i, user in enumerate(users)
+        ]
+    )
+    db.session.add_all(
+        [BannedUsers(user_id=f"{i:032}", username=f"banned{i}", email=f"banned{i}@example.com", password="x", role="user", ban_reason="spam") for i in range(3)]
+    )
+    db.session.add_all([UnverifiedUsers(username=f"new{i}", email=f"new{i}@example.com", password="x", created=utcnow()) for i in range(3)])
+    db.session.commit()
+
+
+@pytest.mark.parametrize(
+    "path",
+    [
+        "/api/user/",
+        "/api/user/bootstrap/",
+        "/api/vm/iso/",
+        "/api/vm/user/",
+        "/api/vm/count/",
+        "/api/admin/vm/all/",
+        "/api/admin/vm/all/?limit=2&count=true",
+        "/api/admin/user/all/",
+        "/api/admin/user/all/?limit=2&sort=login_time",
+        "/api/admin/user/banned/",
+        "/api/admin/user/unverified/",
+    ],
+)
+def test_endpoint_within_budget(app, admin_client, rows, path):
+    response = admin_client.get(path)
+
+    assert response.status_code in (200, 404), response.get_json()
+    view = app.view_functions[app.url_map.bind("localhost").match(path.split("?")[0])[0]]
+    assert int(response.headers["X-Query-Count"]) <= view.query_budget
+
+
+def test_login_within_budget(app, client, admin):
+    response = client.post("/api/user/login/", json={"username": "admin", "password": "admin"})
+
+    assert response.status_code == 200
+    assert int(response.headers["X-Query-Count"]) <= app.view_functions["user_endpoints.login"].query_budget
+
+
+def test_count_is_per_request(admin_client):
+    counts = [int(admin_client.get("/api/user/").headers["X-Query-Count"]) for _ in range(3)]
+
+    assert counts[1] == counts[2] <= counts[0]
+
+
+def test_over_budget_fails_request(app, admin_client, monkeypatch, caplog):
+    monkeypatch.setattr(app.view_functions["user_endpoints.get_user_info"], "query_budget", 0)
+
+    with caplog.at_level(logging.WARNING):
+        response = admin_client.get("/api/user/")
+
+    assert response.status_code == 500
+    assert "over its budget of 0" in response.get_json()["message"]
+    assert "user_endpoints.get_user_info ran" in caplog.text
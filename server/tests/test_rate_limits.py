@@ -0,0 +1,112 @@
+# test_rate_limits.py - Checks how requests are keyed, weighted and refused by the rate limits.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from types import SimpleNamespace
+
+import pytest
+import rate_limits
+from auth import create_user_token, revoke_user_tokens
+from models import Users
+from passwords import hash_password
+from rate_limits import limiter, request_cost, user_or_ip_key
+
+LIMIT = 10
+
+
+@pytest.fixture
+def limited(app, monkeypatch):
+    """Limit every client to LIMIT requests a minute, with counters kept in memory and emptied before and after the test"""
+
+    assert app.config["RATELIMIT_STORAGE_URI"] == "memory://"
+    monkeypatch.setattr(rate_limits, "current_settings", lambda: SimpleNamespace(RATE_LIMIT=f"{LIMIT}/minute"))
+    limiter.reset()
+    yield
+    limiter.reset()
+
+
+@pytest.fixture
+def user(db):
+    """A user called alice, with the password password"""
+
+    user = Users(username="alice", email="alice@example.com", password=hash_password("password"), role="user")
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def request_with_token(app, token=None, ip="10.0.0.1"):
+    """A request context from an IP address, with an access token cookie if one is given"""
+
+    headers = {"Cookie": f"access_token_cookie={token}"} if token else {}
+    return app.test_request_context("/api/user/", headers=headers, environ_base={"REMOTE_ADDR": ip})
+
+
+def test_logged_out_requests_are_keyed_by_ip(app):
+    with request_with_token(app):
+        assert user_or_ip_key() == "ip:10.0.0.1"
+
+
+def test_logged_in_requests_are_keyed_by_user(app, user):
+    with request_with_token(app, create_user_token(user)):
+        assert user_or_ip_key() == f"user:{user.id}"
+
+
+def test_revoked_token_is_keyed_by_ip(app, db, user):
+    token = create_user_token(user)
+    revoke_user_tokens(user)
+    db.session.commit()
+
+    # The token is checked against the user's token version before the limit is counted, so a revoked one counts against the IP
+    with request_with_token(app, token):
+        assert user_or_ip_key() == "ip:10.0.0.1"
+
+
+def test_request_costs(app):
+    for path, cost in (("/api/user/login/", 5), ("/api/user/register/", 5), ("/api/vm/create/", 10), ("/api/user/", 1)):
+        with app.test_request_context(path, method="POST" if cost > 1 else "GET"):
+            assert request_cost() == cost, path
+
+
+def test_limit_returns_429(limited, client):
+    for _ in range(LIMIT):
+        assert client.get("/api/user/").status_code == 401
+
+    assert client.get("/api/user/").status_code == 429
+
+
+def test_logins_cost_more(limited, client, user):
+    # Two logins use up the limit, which is counted for each endpoint on its own
+    for _ in range(LIMIT // 5):
+        assert client.post("/api/user/login/", json={"username": "alice", "password": "wrong"}).status_code == 401
+
+    assert client.post("/api/user/login/", json={"username": "alice", "password": "password"}).status_code == 429
+    assert client.get("/api/user/").status_code == 401
+
+
+def test_users_on_one_ip_have_their_own_limits(limited, app, client, user, db):
+    db.session.add(Users(username="bob", email="bob@example.com", password=hash_password("password"), role="user"))
+    db.session.commit()
+    alice, bob = app.test_client(), app.test_client()
+    assert alice.post("/api/user/login/", json={"username": "alice", "password": "password"}).status_code == 200
+    assert bob.post("/api/user/login/", json={"username": "bob", "password": "password"}).status_code == 200
+
+    for _ in range(LIMIT):
+        assert alice.get("/api/user/").status_code == 200
+    assert alice.get("/api/user/").status_code == 429
+
+    # Bob, and anyone logged out on the same IP address, are counted separately
+    assert bob.get("/api/user/").status_code == 200
+    assert client.get("/api/user/").status_code == 401
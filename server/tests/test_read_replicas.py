@@ -0,0 +1,144 @@
+# test_read_replicas.py - Checks that read-only endpoints read from a replica, and that writes and the reads after them use the primary.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+
+import pytest
+from flask import Flask, g, jsonify
+from models import STICKY_COOKIE, Users, db, init_read_replicas, read_only
+from sqlalchemy import update
+
+STICKY_SECONDS = 60
+
+
+def usernames():
+    """The usernames in whichever database the session reads from"""
+
+    return [username for (username,) in db.session.query(Users.username).order_by(Users.username)]
+
+
+@pytest.fixture
+def replica_app(tmp_path, monkeypatch):
+    """An app with a primary and a replica on two SQLite files, each holding a user named after it.
+    Replication isn't simulated, so the database a read went to is told by the users it finds.
+    """
+
+    replica_app = Flask(__name__)
+    replica_app.config.update(
+        SQLALCHEMY_DATABASE_URI=f"sqlite:///{tmp_path}/primary.sqlite3",
+        SQLALCHEMY_BINDS={"replica_0": f"sqlite:///{tmp_path}/replica.sqlite3"},
+    )
+    # Registering the replica's bind key adds a metadata for it, which the other tests' apps have no engine for
+    monkeypatch.setattr(db, "metadatas", dict(db.metadatas))
+    db.init_app(replica_app)
+    init_read_replicas(replica_app, STICKY_SECONDS)
+
+    @replica_app.route("/users/", methods=["GET"])
+    @read_only
+    def list_users():
+        return jsonify(usernames()), 200
+
+    @replica_app.route("/users/primary/", methods=["GET"])
+    def list_primary_users():
+        return jsonify(usernames()), 200
+
+    @replica_app.route("/users/", methods=["POST"])
+    def add_user():
+        db.session.add(Users(username="new", email="new@example.com", password="x", role="user"))
+        db.session.commit()
+        return jsonify(usernames()), 201
+
+    with replica_app.app_context():
+        for name, engine in db.engines.items():
+            db.metadata.create_all(engine)
+            with engine.begin() as conn:
+                name = name or "primary"
+                conn.execute(Users.__table__.insert(), {"id": name, "username": name, "email": f"{name}@example.com", "password": "x", "role": "user"})
+
+    yield replica_app
+
+    with replica_app.app_context():
+        for engine in db.engines.values():
+            engine.dispose()
+
+
+def test_read_only_endpoints_read_from_the_replica(replica_app):
+    client = replica_app.test_client()
+
+    assert client.get("/users/").get_json() == ["replica_0"]
+    assert client.get("/users/primary/").get_json() == ["primary"]
+    # Nothing was written, so the client isn't sent to the primary
+    assert client.get_cookie(STICKY_COOKIE) is None
+
+
+def test_writes_go_to_the_primary(replica_app):
+    client = replica_app.test_client()
+
+    # The session reads its own write back from the primary
+    assert client.post("/users/").get_json() == ["new", "primary"]
+    assert client.get("/users/primary/").get_json() == ["new", "primary"]
+
+
+def test_reads_stick_to_the_primary_after_a_write(replica_app):
+    client = replica_app.test_client()
+
+    client.post("/users/")
+    cookie = client.get_cookie(STICKY_COOKIE)
+
+    assert time.time() < float(cookie.value) <= time.time() + STICKY_SECONDS
+    assert client.get("/users/").get_json() == ["new", "primary"]
+
+    # Once the replicas have had time to catch up, the client reads from them again
+    client.set_cookie(STICKY_COOKIE, f"{time.time() - 1:.3f}")
+
+    assert client.get("/users/").get_json() == ["replica_0"]
+
+
+def test_malformed_sticky_cookie(replica_app):
+    client = replica_app.test_client()
+    client.set_cookie(STICKY_COOKIE, "soon")
+
+    assert client.get("/users/").get_json() == ["replica_0"]
+
+
+def test_flush_goes_to_the_primary(replica_app):
+    with replica_app.test_request_context():
+        g.read_replica = True
+
+        assert usernames() == ["replica_0"]
+        db.session.add(Users(username="new", email="new@example.com", password="x", role="user"))
+        db.session.flush()
+
+        # The flush wrote to the primary, and the session's reads follow it there
+        assert db.session.info["wrote"]
+        assert usernames() == ["new", "primary"]
+        db.session.rollback()
+
+
+def test_bulk_update_goes_to_the_primary(replica_app):
+    with replica_app.test_request_context():
+        g.read_replica = True
+
+        db.session.execute(update(Users).values(role="admin"))
+
+        assert db.session.query(Users.username).filter_by(role="admin").all() == [("primary",)]
+        db.session.rollback()
+
+
+def test_without_replicas(app, admin_client):
+    # The app under test has no DB_REPLICA_URIS, so logging in writes without sending the client to the primary
+    assert admin_client.get("/api/user/").status_code == 200
+    assert admin_client.get_cookie(STICKY_COOKIE) is None
@@ -0,0 +1,163 @@
+# test_scheduler.py - Checks that each run of a periodic job is claimed by exactly one worker.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import threading
+from datetime import timedelta
+
+import pytest
+from models import ScheduledJobs
+from scheduler import Job, Scheduler, utcnow
+
+
+class CountingJob:
+    """A job body that counts its runs, and can fail or do something while it runs"""
+
+    def __init__(self, result="Did something", error=None, during=None):
+        self.runs = 0
+        self.result = result
+        self.error = error
+        self.during = during
+
+    def __call__(self):
+        self.runs += 1
+        if self.during:
+            self.during()
+        if self.error:
+            raise self.error
+        return self.result
+
+
+@pytest.fixture
+def body():
+    return CountingJob()
+
+
+@pytest.fixture
+def job(body):
+    return Job("test_job", body, interval=60, lease=30)
+
+
+def workers(app, job, count=2):
+    """Create schedulers for the same job, as each worker would, with its row added
+
+    Returns:
+        list: The schedulers
+    """
+
+    schedulers = [Scheduler(app, [job]) for _ in range(count)]
+    for scheduler in schedulers:
+        scheduler.ensure_jobs()
+    return schedulers
+
+
+def row(db, job):
+    db.session.expire_all()
+    return db.session.get(ScheduledJobs, job.name)
+
+
+def test_ensure_jobs_adds_one_row(app, db, job):
+    workers(app, job, count=3)
+
+    assert db.session.query(ScheduledJobs).count() == 1
+    assert row(db, job).next_run <= utcnow()
+
+
+def test_only_one_worker_claims(app, db, job):
+    first, second = workers(app, job)
+
+    assert first.claim(job) is True
+    assert second.claim(job) is False
+    assert first.claim(job) is False
+    assert row(db, job).claimed_by == first.worker_id
+
+
+def test_concurrent_claims(app, job):
+    schedulers = workers(app, job, count=4)
+    claimed, errors = [], []
+
+    def claim(scheduler):
+        try:
+            with app.app_context():
+                claimed.append(scheduler.claim(job))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=claim, args=(scheduler,)) for scheduler in schedulers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert sorted(claimed) == [False, False, False, True]
+
+
+def test_expired_lease_is_taken_over(app, db, job):
+    first, second = workers(app, job)
+    first.claim(job)
+
+    db.session.query(ScheduledJobs).update({"claimed_until": utcnow() - timedelta(seconds=1)})
+    db.session.commit()
+
+    assert second.claim(job) is True
+    assert row(db, job).claimed_by == second.worker_id
+
+
+def test_run_due_runs_once_and_schedules_next(app, db, job, body):
+    first, second = workers(app, job)
+    before = utcnow()
+
+    first.run_due()
+    second.run_due()
+
+    assert body.runs == 1
+    scheduled = row(db, job)
+    assert scheduled.claimed_by is None and scheduled.claimed_until is None
+    assert scheduled.last_result == "Did something" and scheduled.last_error is None
+    assert before <= scheduled.last_run <= utcnow()
+    assert scheduled.next_run == scheduled.last_run + timedelta(seconds=job.interval)
+
+
+def test_failed_run_is_recorded_and_rescheduled(app, db):
+    body = CountingJob(error=RuntimeError("Disk full"))
+    job = Job("failing_job", body, interval=60, lease=30)
+    (scheduler,) = workers(app, job, count=1)
+
+    scheduler.run_due()
+
+    scheduled = row(db, job)
+    assert body.runs == 1
+    assert scheduled.last_error == "Disk full"
+    assert scheduled.claimed_by is None
+    assert scheduled.next_run > utcnow()
+
+
+def test_worker_that_lost_its_lease_does_not_release(app, db):
+    other = "0" * 32
+
+    def taken_over():
+        # The run outlived its lease and another worker claimed the job
+        db.session.query(ScheduledJobs).update({"claimed_by": other})
+        db.session.commit()
+
+    job = Job("slow_job", CountingJob(during=taken_over), interval=60, lease=30)
+    (scheduler,) = workers(app, job, count=1)
+
+    scheduler.run_due()
+
+    scheduled = row(db, job)
+    assert scheduled.claimed_by == other
+    assert scheduled.last_run is None
@@ -0,0 +1,240 @@
+# test_settings.py - Checks that saved settings get consecutive versions, and that other workers pick them up.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import queue
+import threading
+import time
+from collections import defaultdict
+from types import SimpleNamespace
+
+import pytest
+import settings
+import settings_sync
+from models import ApplicationConfigDb
+from settings import VERSION_KEY, current_settings, update_settings
+from settings_sync import SettingsSync
+
+
+@pytest.fixture(autouse=True)
+def defaults(monkeypatch):
+    """Start each test from the .env values, as if no setting had been changed"""
+
+    monkeypatch.setattr(settings, "_settings", settings.build_settings(0, {}))
+
+
+@pytest.fixture
+def versions(monkeypatch):
+    """The versions handed out by next_version"""
+
+    taken = []
+    next_version = settings.next_version
+
+    def recording():
+        version = next_version()
+        taken.append(version)
+        return version
+
+    monkeypatch.setattr(settings, "next_version", recording)
+    return taken
+
+
+def test_update_applies_new_version():
+    default = current_settings().MAX_VM_COUNT
+
+    first = update_settings({"MAX_VM_COUNT": "7", "KVM_ENABLED": True})
+    assert (first.version, first.MAX_VM_COUNT, first.KVM_ENABLED) == (1, 7, True)
+
+    second = update_settings({"MAX_VM_COUNT": None})
+    assert (second.version, second.MAX_VM_COUNT, second.KVM_ENABLED) == (2, default, True)
+    assert current_settings() is second
+
+
+def test_version_row_counts_saves(db):
+    for count in range(3):
+        update_settings({"MAX_VM_COUNT": count + 1})
+
+    assert db.session.get(ApplicationConfigDb, VERSION_KEY).version == 3
+    assert db.session.get(ApplicationConfigDb, "MAX_VM_COUNT").version == 3
+
+
+@pytest.mark.parametrize("changes, error", [({"NOT_A_SETTING": 1}, KeyError), ({"MAX_VM_COUNT": 1, "MAX_VM_CORES": "many"}, ValueError)])
+def test_invalid_change_stores_nothing(db, changes, error):
+    with pytest.raises(error):
+        update_settings(changes)
+
+    assert db.session.query(ApplicationConfigDb).count() == 0
+    assert current_settings().version == 0
+
+
+def test_concurrent_saves_get_distinct_versions(app, versions):
+    errors = []
+
+    def save(count):
+        try:
+            with app.app_context():
+                update_settings({"MAX_VM_COUNT": count})
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=save, args=(count,)) for count in range(1, 9)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert sorted(versions) == list(range(1, 9))
+    assert current_settings().version == 8
+
+
+def test_sync_loads_newer_version(app, monkeypatch):
+    sync = SettingsSync(app, poll_interval=3600, channel_url=None)
+    assert sync.check() is False
+
+    # Another worker saves, and this one still has the old snapshot
+    stale = current_settings()
+    update_settings({"MAX_VM_COUNT": 9})
+    monkeypatch.setattr(settings, "_settings", stale)
+
+    assert sync.check() is True
+    assert current_settings().MAX_VM_COUNT == 9
+    assert sync.check() is False
+
+
+def test_older_version_is_not_loaded(app):
+    update_settings({"MAX_VM_COUNT": 9})
+    newer = settings.build_settings(5, {"MAX_VM_COUNT": 3})
+    settings._settings = newer
+
+    assert SettingsSync(app, poll_interval=3600, channel_url=None).check() is False
+    assert settings.load_settings() is newer
+
+
+class FakeRedisError(Exception):
+    pass
+
+
+class FakeRedis:
+    """An in-memory stand-in for a Redis server's pub/sub, shared by every client made from it"""
+
+    RedisError = FakeRedisError
+
+    def __init__(self):
+        self.subscribers = defaultdict(list)
+        self.down = False
+        self.Redis = SimpleNamespace(from_url=lambda url: self)
+
+    def publish(self, channel, data):
+        if self.down:
+            raise FakeRedisError("Connection refused")
+        for messages in self.subscribers[channel]:
+            messages.put({"type": "message", "channel": channel.encode(), "data": data.encode()})
+        return len(self.subscribers[channel])
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return FakePubSub(self)
+
+
+class FakePubSub:
+    def __init__(self, server):
+        self.server = server
+        self.messages = queue.Queue()
+
+    def subscribe(self, channel):
+        self.server.subscribers[channel].append(self.messages)
+
+    def listen(self):
+        while True:
+            message = self.messages.get()
+            yield message
+            # Asking for the next message means the last one was handled
+            self.messages.task_done()
+
+
+def wait_for(condition, timeout=5):
+    """Wait for a condition to hold, checking it every 10 milliseconds
+
+    Returns:
+        bool: If it held before the timeout
+    """
+
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.fixture
+def redis_server(monkeypatch):
+    """A fake Redis server, in place of the redis package"""
+
+    server = FakeRedis()
+    monkeypatch.setattr(settings_sync, "redis", server)
+    return server
+
+
+@pytest.fixture
+def workers(app, redis_server):
+    """Two workers subscribed to the settings channel, each counting its checks of the database.
+    Polls are an hour apart, so only a subscribe or a published version makes a worker check.
+    """
+
+    workers = [SettingsSync(app, poll_interval=3600, channel_url="redis://localhost:6379") for _ in range(2)]
+    for worker in workers:
+        check = worker.check
+        worker.checks = []
+        worker.check = lambda worker=worker, check=check: worker.checks.append(check())
+        worker.start()
+
+    # Each worker checks once when it subscribes, for changes made while it wasn't listening
+    assert wait_for(lambda: all(len(worker.checks) == 1 for worker in workers))
+    assert len(redis_server.subscribers[settings_sync.CHANNEL]) == 2
+    return workers
+
+
+def test_published_version_wakes_the_workers(workers, monkeypatch):
+    # The first worker saves, and the process still has the old snapshot, as the second worker would
+    stale = current_settings()
+    version = update_settings({"MAX_VM_COUNT": 9}).version
+    monkeypatch.setattr(settings, "_settings", stale)
+
+    workers[0].publish(version)
+
+    # Both workers share this process's snapshot, so whichever handles the message first loads the new settings,
+    # and the other finds nothing newer unless it checked at the same time
+    assert wait_for(lambda: current_settings().MAX_VM_COUNT == 9)
+    assert current_settings().version == version
+    assert wait_for(lambda: True in [loaded for worker in workers for loaded in worker.checks[1:]])
+
+
+def test_old_and_malformed_versions_are_ignored(workers, redis_server):
+    workers[0].publish(0)
+    redis_server.publish(settings_sync.CHANNEL, "not a version")
+    for messages in redis_server.subscribers[settings_sync.CHANNEL]:
+        messages.join()
+
+    assert not any(worker._wake.is_set() for worker in workers)
+    assert [len(worker.checks) for worker in workers] == [1, 1]
+
+
+def test_publish_failure_is_logged(workers, redis_server, caplog):
+    redis_server.down = True
+
+    workers[0].publish(3)
+
+    assert "Failed to publish settings version 3" in caplog.text
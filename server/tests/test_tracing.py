@@ -0,0 +1,119 @@
+# test_tracing.py - Checks that traced requests record their SQL statements as child spans, and how spans are exported.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import logging
+
+import pytest
+import tracing
+from tracing import Span, SpanExporter
+
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+PARENT_ID = "00f067aa0ba902b7"
+
+
+class Collector:
+    """Collects ended spans in place of the exporter"""
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+    def named(self, name):
+        return [span for span in self.spans if span.name == name]
+
+
+@pytest.fixture
+def spans(monkeypatch):
+    """The spans ended during the test"""
+
+    collector = Collector()
+    monkeypatch.setattr(tracing, "get_exporter", lambda: collector)
+    return collector
+
+
+def test_request_span_has_query_children(admin_client, spans):
+    response = admin_client.get("/api/user/")
+    assert response.status_code == 200
+
+    (root,) = spans.named("GET /api/user/")
+    queries = spans.named("db.query")
+    assert root.parent_id is None
+    assert root.attributes["http.status_code"] == 200
+    assert response.headers["traceparent"] == f"00-{root.trace_id}-{root.span_id}-01"
+    assert queries
+    for query in queries:
+        assert query.trace_id == root.trace_id
+        assert query.parent_id == root.span_id
+        assert query.attributes["db.system"] == "sqlite"
+        assert query.start >= root.start and query.end_time <= root.end_time
+    assert any("FROM users" in query.attributes["db.statement"] for query in queries)
+
+
+def test_continues_callers_trace(admin_client, spans):
+    admin_client.get("/api/user/", headers={"traceparent": f"00-{TRACE_ID}-{PARENT_ID}-01"})
+
+    (root,) = spans.named("GET /api/user/")
+    assert root.trace_id == TRACE_ID
+    assert root.parent_id == PARENT_ID
+
+
+def test_caller_can_turn_sampling_off(admin_client, spans):
+    response = admin_client.get("/api/user/", headers={"traceparent": f"00-{TRACE_ID}-{PARENT_ID}-00"})
+
+    assert response.status_code == 200
+    assert spans.spans == []
+    assert "traceparent" not in response.headers
+
+
+def test_failed_request_records_error(client, spans):
+    response = client.post("/api/user/login/", data="not json", content_type="application/json")
+
+    (root,) = spans.named("POST /api/user/login/")
+    assert root.attributes["http.status_code"] == response.status_code == 400
+
+
+def test_file_exporter_writes_json_lines(tmp_path):
+    exporter = SpanExporter("file", logging.getLogger(__name__))
+    exporter.path = str(tmp_path / "traces.jsonl")
+    root = Span("GET /", TRACE_ID)
+    child = Span("db.query", TRACE_ID, root.span_id, {"db.statement": "SELECT 1"})
+    for span in (child, root):
+        span.end_time = span.start + 1_000_000
+        exporter.export(span)
+
+    exporter.flush()
+
+    lines = [json.loads(line) for line in (tmp_path / "traces.jsonl").read_text(encoding="utf-8").splitlines()]
+    assert [line["name"] for line in lines] == ["db.query", "GET /"]
+    assert lines[0]["parent_id"] == lines[1]["span_id"]
+    assert lines[0]["duration_ms"] == 1.0
+    assert lines[0]["attributes"] == {"db.statement": "SELECT 1"}
+
+
+def test_export_failure_is_logged(tmp_path, caplog):
+    exporter = SpanExporter("file", logging.getLogger(__name__))
+    exporter.path = str(tmp_path / "missing" / "traces.jsonl")
+    span = Span("GET /", TRACE_ID)
+    span.end_time = span.start
+    exporter.export(span)
+
+    with caplog.at_level(logging.WARNING):
+        exporter.flush()
+
+    assert "Failed to export 1 spans" in caplog.text
@@ -0,0 +1,61 @@
+# test_two_factor.py - Checks the two-factor authentication set up, and the QR codes it renders.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import base64
+
+import pyotp
+import pytest
+from models import Users
+from routes.user_endpoints import make_qr_code
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def test_png_qr_code():
+    image = make_qr_code("otpauth://totp/Buffet:admin?secret=JBSWY3DPEHPK3PXP&issuer=Buffet")
+
+    assert image.startswith(PNG_SIGNATURE)
+
+
+def test_svg_qr_code():
+    image = make_qr_code("otpauth://totp/Buffet:admin?secret=JBSWY3DPEHPK3PXP&issuer=Buffet", "svg")
+
+    assert b"<svg" in image and b"<path" in image
+
+
+@pytest.mark.parametrize("image_format, mime_type, starts_with", [("png", "image/png", PNG_SIGNATURE), ("svg", "image/svg+xml", b"<?xml")])
+def test_setup_and_verify(admin_client, db, image_format, mime_type, starts_with):
+    response = admin_client.post(f"/api/user/2fa/?format={image_format}")
+
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["mime_type"] == mime_type
+    assert base64.b64decode(body["qr_code"]).startswith(starts_with)
+
+    # The secret is stored, but only used once the user proves their authenticator has it
+    user = db.session.query(Users).filter_by(username="admin").one()
+    assert user.two_factor_secret and not user.two_factor_enabled
+    response = admin_client.post("/api/user/2fa/verify/", json={"code": pyotp.TOTP(user.two_factor_secret).now()})
+    assert response.status_code == 200
+    db.session.refresh(user)
+    assert user.two_factor_enabled
+
+
+def test_unknown_format_keeps_the_secret(admin_client, db):
+    response = admin_client.post("/api/user/2fa/?format=gif")
+
+    assert response.status_code == 400
+    assert db.session.query(Users.two_factor_secret).filter_by(username="admin").scalar() is None
@@ -0,0 +1,169 @@
+# test_vm_boot.py - Checks that virtual machines are booted on the worker's event loop, and that only one is kept per user.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import importlib
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+
+import pytest
+import vm_loop
+from conftest import NO_PROCESS, TEST_DIR
+from models import VirtualMachines
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+
+# The routes package exports the blueprint under the name of its module
+vm_endpoints = importlib.import_module("routes.vm_endpoints")
+
+# Answers every QMP command with an empty return, like set_password does
+FAKE_QEMU = f"""#!{sys.executable}
+import json, os, socket, sys
+args = sys.argv[1:]
+path = args[args.index("-qmp") + 1].split(",")[0][len("unix:"):]
+if os.path.exists(path):
+    os.unlink(path)
+server = socket.socket(socket.AF_UNIX)
+server.bind(path)
+server.listen(1)
+decoder = json.JSONDecoder()
+while True:
+    conn, _ = server.accept()
+    conn.sendall(json.dumps({{"QMP": {{"version": {{"qemu": {{"micro": 0, "minor": 0, "major": 8}}, "package": ""}}, "capabilities": []}}}}).encode() + b"\\n")
+    buffer = ""
+    while data := conn.recv(4096):
+        buffer += data.decode()
+        # Commands aren't always followed by a newline, so they are parsed one JSON object at a time
+        while buffer.strip():
+            try:
+                command, end = decoder.raw_decode(buffer.lstrip())
+            except ValueError:
+                break
+            buffer = buffer.lstrip()[end:]
+            with open({TEST_DIR + "/qmp.log"!r}, "a") as log:
+                log.write(json.dumps(command) + "\\n")
+            conn.sendall(json.dumps({{"return": {{}}, **({{"id": command["id"]}} if "id" in command else {{}})}}).encode() + b"\\n")
+    conn.close()
+"""
+
+
+@pytest.fixture
+def fake_hypervisor(tmp_path, monkeypatch, iso_index, db):
+    """Put a fake QEMU and websockify first on the PATH and an x86_64 ISO in the index, and stop every virtual machine afterwards"""
+
+    for name, script in (("qemu-system-x86_64", FAKE_QEMU), ("websockify", "#!/bin/sh\nexec sleep 300\n")):
+        (tmp_path / name).write_text(script)
+        (tmp_path / name).chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+    open(f"{TEST_DIR}/iso/test.iso", "wb").close()
+    iso_index([{"iso": "test.iso", "name": "Test", "version": "1", "desktop": "None", "arch": "x86_64", "logo": "test.png"}])
+
+    yield
+
+    for vm in VirtualMachines.query.all():
+        for pid in (vm.process_id, vm.websockify_process_id):
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+
+def test_create_vm_boots_on_the_worker_loop(admin_client, admin, fake_hypervisor, caplog):
+    caplog.set_level(logging.DEBUG, logger="app")
+
+    response = admin_client.post("/api/vm/create/", json={"iso": "test.iso"})
+
+    assert response.status_code == 201, response.get_json()
+    assert any(record.getMessage().startswith("Executing command: qemu-system-x86_64 ") for record in caplog.records)
+    vm = VirtualMachines.query.filter_by(user_id=admin.id).one()
+    assert vm.vnc_password
+    os.kill(vm.process_id, 0)
+    os.kill(vm.websockify_process_id, 0)
+    # The password was set over QMP on the loop that lives on between requests
+    with open(f"{TEST_DIR}/qmp.log", encoding="utf-8") as f:
+        commands = [json.loads(line) for line in f]
+    assert {"execute": "set_password", "arguments": {"protocol": "vnc", "password": vm.vnc_password}} in [
+        {key: command[key] for key in ("execute", "arguments") if key in command} for command in commands
+    ]
+    assert vm_loop._loop.is_running()
+
+
+def test_failed_boot_stops_qemu(admin_client, admin, fake_hypervisor, monkeypatch):
+    started = []
+    start_vm_process = vm_endpoints.start_vm_process
+
+    async def recording(*args):
+        process = await start_vm_process(*args)
+        started.append(process)
+        return process
+
+    async def failing(websocket_port, port):
+        raise OSError("websockify not found")
+
+    monkeypatch.setattr(vm_endpoints, "start_vm_process", recording)
+    monkeypatch.setattr(vm_endpoints, "start_websockify", failing)
+
+    response = admin_client.post("/api/vm/create/", json={"iso": "test.iso"})
+
+    assert response.status_code == 500
+    assert VirtualMachines.query.count() == 0
+    assert vm_loop.run(started[0].wait(), timeout=5) == -signal.SIGKILL
+
+
+def test_one_virtual_machine_per_user(admin, db):
+    for port in (5900, 5901):
+        db.session.add(VirtualMachines(port=port, websocket_port=port + 180, iso="test.iso", websockify_process_id=NO_PROCESS, process_id=NO_PROCESS, user_id=admin.id, log_file="vm.log"))
+
+    with pytest.raises(IntegrityError):
+        db.session.commit()
+    db.session.rollback()
+
+
+@pytest.mark.parametrize(
+    "other_user, status, message",
+    [
+        (False, 403, "Users may only have one virtual machine at a time."),
+        (True, 500, "The server is at maximum capacity. Please try again later."),
+    ],
+)
+def test_raced_boot_is_stopped(admin_client, admin, fake_hypervisor, monkeypatch, db, other_user, status, message):
+    engine = db.engine
+    processes = []
+
+    async def racing_boot(command, arch, user_id, websocket_port, port):
+        # Another request stores a virtual machine on the same port, or for the same user, while this one boots
+        with engine.begin() as conn:
+            conn.execute(
+                insert(VirtualMachines).values(
+                    port=port, websocket_port=websocket_port, iso="test.iso", websockify_process_id=NO_PROCESS, process_id=NO_PROCESS,
+                    user_id="f" * 32 if other_user else user_id, log_file="vm.log",
+                )
+            )
+        processes.extend(subprocess.Popen(["sleep", "300"]) for _ in range(2))
+        return processes[0].pid, processes[1].pid, "password"
+
+    monkeypatch.setattr(vm_endpoints, "boot_vm", racing_boot)
+
+    response = admin_client.post("/api/vm/create/", json={"iso": "test.iso"})
+
+    assert response.status_code == status
+    assert response.get_json()["message"].startswith(message)
+    # Both processes of the virtual machine that lost are stopped, and the other is kept
+    assert [process.wait(timeout=5) for process in processes] == [-signal.SIGTERM, -signal.SIGTERM]
+    assert VirtualMachines.query.count() == 1
@@ -0,0 +1,202 @@
+# test_vm_logs.py - Checks that finished network captures are compressed, and pruned by age and by quota.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import gzip
+import os
+import time
+from datetime import date, timedelta
+
+import pytest
+import vm_logs
+from conftest import NO_PROCESS
+from models import Users, VirtualMachines
+
+ALICE = "a" * 32
+BOB = "b" * 32
+KIB = 1024
+
+
+@pytest.fixture
+def captures(tmp_path, monkeypatch):
+    """An empty log directory, with no age limit or quotas until a test sets them
+
+    Returns:
+        function: Writes a capture
+    """
+
+    monkeypatch.setattr(vm_logs, "VM_LOG_ROOT", str(tmp_path / "logs"))
+    monkeypatch.setattr(vm_logs, "RETENTION_DAYS", 0)
+    monkeypatch.setattr(vm_logs, "USER_QUOTA", 0)
+    monkeypatch.setattr(vm_logs, "TOTAL_QUOTA", 0)
+
+    def write(user_id, name, days_old=0, size=KIB, idle=vm_logs.QUIET_PERIOD + 60):
+        """Write a capture of size bytes, last written idle seconds ago, in the directory of the day days_old ago
+
+        Returns:
+            str: The path of the capture
+        """
+
+        directory = f"{vm_logs.VM_LOG_ROOT}/{date.today() - timedelta(days=days_old)}/{user_id}"
+        os.makedirs(directory, exist_ok=True)
+        path = f"{directory}/{name}"
+        with open(path, "wb") as f:
+            f.write(b"\x00" * size)
+        mtime = time.time() - idle
+        os.utime(path, (mtime, mtime))
+        return path
+
+    return write
+
+
+def running(db, user_id):
+    """Give a user a virtual machine, as if QEMU were still writing their newest capture"""
+
+    db.session.add(Users(id=user_id, username=user_id[:8], email=f"{user_id[:8]}@example.com", password="x", role="user"))
+    db.session.add(VirtualMachines(port=5901, websocket_port=6081, iso="test.iso", websockify_process_id=NO_PROCESS, process_id=NO_PROCESS, user_id=user_id, log_file="vm.pcap"))
+    db.session.commit()
+
+
+def remaining(root):
+    """The captures left under the log directory, relative to it"""
+
+    return sorted(os.path.relpath(log_file.path, root) for log_file in vm_logs.scan_logs())
+
+
+def test_log_directory(captures):
+    assert vm_logs.log_directory(ALICE) == f"{vm_logs.VM_LOG_ROOT}/{date.today()}/{ALICE}"
+    assert os.path.isdir(vm_logs.log_directory(ALICE))
+
+
+def test_compress_finished_captures(captures):
+    path = captures(ALICE, "10:00:00-debian.iso.pcap", size=64 * KIB)
+    mtime = os.path.getmtime(path)
+
+    assert vm_logs.compress_logs() == "Compressed 1 captures, saving 63 KiB"
+
+    assert not os.path.exists(path)
+    with gzip.open(path + vm_logs.COMPRESSED_SUFFIX, "rb") as f:
+        assert f.read() == b"\x00" * 64 * KIB
+    # The compressed capture keeps its age, so retention still counts from when it was written
+    assert os.path.getmtime(path + vm_logs.COMPRESSED_SUFFIX) == mtime
+    assert vm_logs.compress_logs() is None
+
+
+def test_open_captures_are_not_compressed(captures, db):
+    running(db, ALICE)
+    older = captures(ALICE, "09:00:00-debian.iso.pcap", days_old=1)
+    newest = captures(ALICE, "10:00:00-debian.iso.pcap")
+    recent = captures(BOB, "10:00:00-debian.iso.pcap", idle=0)
+
+    assert vm_logs.compress_logs() == "Compressed 1 captures, saving 0 KiB"
+
+    assert os.path.exists(older + vm_logs.COMPRESSED_SUFFIX)
+    # The newest capture of a running virtual machine, and one written to within the quiet period, are left open
+    assert os.path.exists(newest) and os.path.exists(recent)
+
+
+def test_compress_failure_keeps_the_capture(captures, monkeypatch, caplog):
+    path = captures(ALICE, "10:00:00-debian.iso.pcap")
+
+    def disk_full(source, target):
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(vm_logs.shutil, "copyfileobj", disk_full)
+
+    assert vm_logs.compress_logs() == "Compressed 0 captures, saving 0 KiB"
+    assert "No space left on device" in caplog.text
+    assert os.listdir(os.path.dirname(path)) == [os.path.basename(path)]
+
+
+def test_retention_days(captures, monkeypatch):
+    monkeypatch.setattr(vm_logs, "RETENTION_DAYS", 7)
+    captures(ALICE, "old.pcap.gz", days_old=8)
+    captures(ALICE, "week.pcap.gz", days_old=7)
+    captures(BOB, "new.pcap.gz")
+
+    assert vm_logs.enforce_log_retention() == "Deleted 1 captures, freeing 1 KiB"
+
+    assert remaining(vm_logs.VM_LOG_ROOT) == [
+        f"{date.today() - timedelta(days=7)}/{ALICE}/week.pcap.gz",
+        f"{date.today()}/{BOB}/new.pcap.gz",
+    ]
+    assert vm_logs.enforce_log_retention() is None
+
+
+def test_user_quota_deletes_oldest_first(captures, monkeypatch):
+    monkeypatch.setattr(vm_logs, "USER_QUOTA", 2 * KIB)
+    for days_old in (3, 2, 1, 0):
+        captures(ALICE, f"{days_old}.pcap.gz", days_old=days_old)
+    captures(BOB, "0.pcap.gz", size=2 * KIB)
+
+    assert vm_logs.enforce_log_retention() == "Deleted 2 captures, freeing 2 KiB"
+
+    assert remaining(vm_logs.VM_LOG_ROOT) == [
+        f"{date.today() - timedelta(days=1)}/{ALICE}/1.pcap.gz",
+        f"{date.today()}/{ALICE}/0.pcap.gz",
+        f"{date.today()}/{BOB}/0.pcap.gz",
+    ]
+
+
+def test_total_quota_deletes_oldest_first(captures, monkeypatch):
+    monkeypatch.setattr(vm_logs, "TOTAL_QUOTA", 2 * KIB)
+    captures(ALICE, "old.pcap.gz", days_old=2)
+    captures(BOB, "middle.pcap.gz", days_old=1)
+    captures(ALICE, "new.pcap.gz")
+
+    assert vm_logs.enforce_log_retention() == "Deleted 1 captures, freeing 1 KiB"
+
+    assert remaining(vm_logs.VM_LOG_ROOT) == [
+        f"{date.today() - timedelta(days=1)}/{BOB}/middle.pcap.gz",
+        f"{date.today()}/{ALICE}/new.pcap.gz",
+    ]
+
+
+def test_open_captures_are_kept_but_counted(captures, monkeypatch):
+    monkeypatch.setattr(vm_logs, "RETENTION_DAYS", 1)
+    monkeypatch.setattr(vm_logs, "USER_QUOTA", 2 * KIB)
+    captures(ALICE, "old.pcap.gz", days_old=3)
+    captures(ALICE, "yesterday.pcap.gz", days_old=1)
+    # QEMU is still writing this one, past the age limit and over the quota on its own
+    captures(ALICE, "open.pcap", days_old=3, size=3 * KIB, idle=0)
+
+    assert vm_logs.enforce_log_retention() == "Deleted 2 captures, freeing 2 KiB"
+
+    assert remaining(vm_logs.VM_LOG_ROOT) == [f"{date.today() - timedelta(days=3)}/{ALICE}/open.pcap"]
+
+
+@pytest.mark.parametrize(
+    "quota, reserved, deleted",
+    [(0, 0, []), (4 * KIB, 0, []), (3 * KIB, 0, ["a"]), (3 * KIB, KIB, ["a", "b"]), (KIB, 4 * KIB, ["a", "b", "c"])],
+)
+def test_over_quota(quota, reserved, deleted):
+    files = [vm_logs.LogFile(name, "2024-01-01", ALICE, KIB + (name == "c"), 0) for name in "abc"]
+
+    assert [log_file.path for log_file in vm_logs.over_quota(files, quota, reserved)] == deleted
+
+
+def test_log_usage(captures, monkeypatch):
+    monkeypatch.setattr(vm_logs, "TOTAL_QUOTA", 10 * KIB)
+    captures(ALICE, "a.pcap.gz", days_old=1)
+    captures(ALICE, "b.pcap")
+    captures(BOB, "c.pcap.gz", size=2 * KIB)
+
+    usage = vm_logs.log_usage()
+
+    assert usage["days"] == [
+        {"date": str(date.today() - timedelta(days=1)), "files": 1, "bytes": KIB, "compressed_files": 1, "users": 1},
+        {"date": str(date.today()), "files": 2, "bytes": 3 * KIB, "compressed_files": 1, "users": 2},
+    ]
+    assert (usage["total_bytes"], usage["total_quota"]) == (4 * KIB, 10 * KIB)
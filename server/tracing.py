@@ -0,0 +1,496 @@
+# tracing.py - Records sampled requests as trace spans, exported to a file or an OTLP collector.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+
+from config import ApplicationConfig
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+SAMPLE_RATE = ApplicationConfig.TRACE_SAMPLE_RATE  # Fraction of requests traced, 0 turns tracing off
+EXPORTER = ApplicationConfig.TRACE_EXPORTER
+SERVICE_NAME = "buffet"
+EXPORT_BATCH_SIZE = 512  # Spans written or posted at once
+EXPORT_INTERVAL = 5  # Seconds between exports when fewer than a batch of spans are waiting
+MAX_QUEUED_SPANS = 10000  # Spans dropped rather than queued when the exporter falls behind
+MAX_STATEMENT_LENGTH = 1000
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+_current = contextvars.ContextVar("trace_span", default=None)
+_exporter = None
+_exporter_lock = threading.Lock()
+_logger = logging.getLogger(__name__)  # Replaced by the app's logger in init_tracing
+
+
+class Span:
+    """A timed operation within a trace, i.e. a request, a query or starting a process"""
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start", "end_time", "attributes", "error")
+
+    def __init__(self, name, trace_id, parent_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.start = time.time_ns()
+        self.end_time = None
+        self.attributes = dict(attributes or {})
+        self.error = None
+
+    def set_attribute(self, key, value):
+        """Set an attribute on the span
+
+        Args:
+            key (str): The attribute name
+            value: The attribute value
+        """
+
+        self.attributes[key] = value
+
+    def record_exception(self, e):
+        """Mark the span as failed
+
+        Args:
+            e (BaseException): The exception that ended it
+        """
+
+        self.error = f"{type(e).__name__}: {e}"
+
+    def end(self):
+        """End the span and queue it for export"""
+
+        self.end_time = time.time_ns()
+        get_exporter().export(self)
+
+    @property
+    def traceparent(self):
+        """The W3C traceparent header continuing this trace in another service"""
+
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def to_dict(self):
+        """Describe the span for the file exporter
+
+        Returns:
+            dict: The span
+        """
+
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "end": self.end_time,
+            "duration_ms": round((self.end_time - self.start) / 1e6, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class NoopSpan:
+    """Stands in for a span when the current request is not sampled, so callers don't need to check"""
+
+    def set_attribute(self, key, value):
+        pass
+
+    def record_exception(self, e):
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+
+
+def begin_trace(name, traceparent=None, attributes=None):
+    """Start a trace, or continue the one in a W3C traceparent header.
+    A valid header decides sampling itself, otherwise SAMPLE_RATE of traces are kept.
+
+    Args:
+        name (str): The name of the root span
+        traceparent (str): The traceparent header of the caller, if any
+        attributes (dict): The attributes of the root span
+
+    Returns:
+        tuple: The root span, or None if not sampled, and the token that end_trace resets the context with
+    """
+
+    if SAMPLE_RATE <= 0:
+        return None, None
+
+    match = TRACEPARENT.match(traceparent or "")
+    if match:
+        trace_id, parent_id, flags = match.groups()
+        sampled = int(flags, 16) & 1
+    else:
+        trace_id, parent_id = os.urandom(16).hex(), None
+        sampled = random.random() < SAMPLE_RATE
+    if not sampled:
+        return None, None
+
+    root = Span(name, trace_id, parent_id, attributes)
+    return root, _current.set(root)
+
+
+def end_trace(root, token, exc=None):
+    """End a trace started by begin_trace
+
+    Args:
+        root (Span): The root span
+        token (Token): The token returned by begin_trace
+        exc (BaseException): The exception that ended the trace, if any
+    """
+
+    if root is None:
+        return
+    if exc is not None:
+        root.record_exception(exc)
+    try:
+        _current.reset(token)
+    except ValueError:
+        # The trace was started in another context, i.e. by a streamed response
+        _current.set(None)
+    root.end()
+
+
+@contextmanager
+def trace(name, **attributes):
+    """Trace a unit of work outside of a request, i.e. a batch of email
+
+    Args:
+        name (str): The name of the root span
+        attributes: The attributes of the root span
+
+    Yields:
+        Span: The root span, or a no-op span if not sampled
+    """
+
+    root, token = begin_trace(name, attributes=attributes)
+    try:
+        yield root or NOOP_SPAN
+    except BaseException as e:
+        end_trace(root, token, e)
+        raise
+    end_trace(root, token)
+
+
+@contextmanager
+def span(name, **attributes):
+    """Time a step of the current trace. This costs a single lookup when the request is not traced.
+
+    Args:
+        name (str): The name of the span
+        attributes: The attributes of the span
+
+    Yields:
+        Span: The span, or a no-op span if the request is not traced
+    """
+
+    parent = _current.get()
+    if parent is None:
+        yield NOOP_SPAN
+        return
+
+    child = Span(name, parent.trace_id, parent.span_id, attributes)
+    token = _current.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.record_exception(e)
+        raise
+    finally:
+        _current.reset(token)
+        child.end()
+
+
+def bind(coro):
+    """Wrap a coroutine so it continues the current trace wherever it runs.
+    Coroutines handed to another thread's event loop don't inherit the caller's context, so the span is captured here.
+
+    Args:
+        coro (coroutine): The coroutine to wrap
+
+    Returns:
+        coroutine: The wrapped coroutine
+    """
+
+    parent = _current.get()
+
+    async def run():
+        _current.set(parent)
+        return await coro
+
+    return run()
+
+
+class SpanExporter:
+    """Exports ended spans in batches from a background thread, so requests never wait on the file or collector"""
+
+    def __init__(self, exporter, logger):
+        """
+        Args:
+            exporter (str): Where to export spans, "file" or "otlp"
+            logger (Logger): Where export failures are logged, as the thread has no app context
+        """
+
+        self.exporter = exporter
+        self.logger = logger
+        self.pid = os.getpid()
+        self.queue = queue.Queue(MAX_QUEUED_SPANS)
+        self.dropped = 0
+        self.path = ApplicationConfig.TRACE_FILE or f"{ApplicationConfig.LOG_DIR}/traces.jsonl"
+        self.endpoint = ApplicationConfig.TRACE_OTLP_ENDPOINT
+        self.thread = threading.Thread(target=self.run, name="span-exporter", daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def export(self, span):
+        """Queue a span for export, dropping it if the exporter has fallen behind
+
+        Args:
+            span (Span): The ended span
+        """
+
+        try:
+            self.queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        """Export queued spans until the process exits"""
+
+        while True:
+            batch = []
+            item = self.queue.get()
+            deadline = time.monotonic() + EXPORT_INTERVAL
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= EXPORT_BATCH_SIZE:
+                    break
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+            if batch:
+                self.send(batch)
+            if item is None:
+                return
+
+    def flush(self):
+        """Export the spans still queued when the worker exits"""
+
+        try:
+            self.queue.put(None, timeout=1)
+        except queue.Full:
+            return
+        self.thread.join(10)
+
+    def send(self, batch):
+        """Export a batch of spans, logging rather than raising if the file or collector is unavailable
+
+        Args:
+            batch (list): The spans
+        """
+
+        try:
+            if self.exporter == "otlp":
+                self.post(batch)
+            else:
+                self.write(batch)
+        except (OSError, ValueError) as e:
+            self.logger.warning("Failed to export %d spans: %s", len(batch), e)
+        if self.dropped:
+            self.logger.warning("Dropped %d spans as the exporter fell behind", self.dropped)
+            self.dropped = 0
+
+    def write(self, batch):
+        """Append spans to the trace file, one JSON object per line
+
+        Args:
+            batch (list): The spans
+        """
+
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.writelines(json.dumps(span.to_dict(), default=str) + "\n" for span in batch)
+
+    def post(self, batch):
+        """Send spans to an OpenTelemetry collector using OTLP over HTTP with JSON encoding
+
+        Args:
+            batch (list): The spans
+        """
+
+        body = {
+            "resourceSpans": [{
+                "resource": {"attributes": otlp_attributes({"service.name": SERVICE_NAME})},
+                "scopeSpans": [{"scope": {"name": SERVICE_NAME}, "spans": [otlp_span(span) for span in batch]}],
+            }]
+        }
+        request = urllib.request.Request(
+            self.endpoint, data=json.dumps(body).encode("utf-8"), headers={"Content-Type": "application/json"}, method="POST"
+        )
+        with urllib.request.urlopen(request, timeout=10) as response:
+            response.read()
+
+
+def otlp_attributes(attributes):
+    """Convert attributes to OTLP key-value pairs
+
+    Args:
+        attributes (dict): The attributes
+
+    Returns:
+        list: The OTLP attributes
+    """
+
+    values = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            values.append({"key": key, "value": {"boolValue": value}})
+        elif isinstance(value, int):
+            values.append({"key": key, "value": {"intValue": str(value)}})
+        elif isinstance(value, float):
+            values.append({"key": key, "value": {"doubleValue": value}})
+        else:
+            values.append({"key": key, "value": {"stringValue": str(value)}})
+    return values
+
+
+def otlp_span(span):
+    """Convert a span to OTLP
+
+    Args:
+        span (Span): The span
+
+    Returns:
+        dict: The OTLP span
+    """
+
+    otlp = {
+        "traceId": span.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        "kind": 2 if "http.method" in span.attributes else 1,  # Server for requests, internal otherwise
+        "startTimeUnixNano": str(span.start),
+        "endTimeUnixNano": str(span.end_time),
+        "attributes": otlp_attributes(span.attributes),
+        "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+    }
+    if span.parent_id:
+        otlp["parentSpanId"] = span.parent_id
+    return otlp
+
+
+def get_exporter():
+    """Get the worker's span exporter, starting it on first use after gunicorn forks
+
+    Returns:
+        SpanExporter: The exporter
+    """
+
+    global _exporter
+    with _exporter_lock:
+        if _exporter is None or _exporter.pid != os.getpid():
+            _exporter = SpanExporter(EXPORTER, _logger)
+        return _exporter
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """Start a span for a SQL statement run while a request is traced"""
+
+    parent = _current.get()
+    if parent is None or context is None:
+        return
+    context._trace_span = Span(
+        "db.query",
+        parent.trace_id,
+        parent.span_id,
+        {"db.system": conn.dialect.name, "db.statement": statement[:MAX_STATEMENT_LENGTH]},
+    )
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """End the span of a SQL statement"""
+
+    child = getattr(context, "_trace_span", None)
+    if child is not None:
+        context._trace_span = None
+        child.set_attribute("db.rows", cursor.rowcount)
+        child.end()
+
+
+def handle_error(exception_context):
+    """End the span of a SQL statement that failed"""
+
+    context = exception_context.execution_context
+    child = getattr(context, "_trace_span", None)
+    if child is not None:
+        context._trace_span = None
+        child.record_exception(exception_context.original_exception)
+        child.end()
+
+
+def init_tracing(app):
+    """Trace sampled requests, and the SQL statements they run
+
+    Args:
+        app (Flask): The Flask app
+    """
+
+    from flask import g, request
+
+    global _logger
+    _logger = app.logger
+
+    if SAMPLE_RATE <= 0:
+        return
+
+    event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+    event.listen(Engine, "handle_error", handle_error)
+
+    @app.before_request
+    def start_request_trace():
+        route = request.url_rule.rule if request.url_rule else request.path
+        g.trace = begin_trace(
+            f"{request.method} {route}",
+            request.headers.get("traceparent"),
+            {"http.method": request.method, "http.route": route, "http.client_ip": request.remote_addr or ""},
+        )
+
+    @app.after_request
+    def record_response(response):
+        root = g.get("trace", (None, None))[0]
+        if root is not None:
+            root.set_attribute("http.status_code", response.status_code)
+            # Let the client or proxy find this request's trace
+            response.headers["traceparent"] = root.traceparent
+        return response
+
+    @app.teardown_request
+    def end_request_trace(exc):
+        root, token = g.pop("trace", (None, None))
+        end_trace(root, token, exc)
@@ -0,0 +1,284 @@
+# vm_logs.py - Compresses the virtual machines' network captures, and keeps them within their age and size limits.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import gzip
+import os
+import shutil
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+from config import ApplicationConfig
+from flask import current_app
+from models import VirtualMachines, db
+from scheduler import Job
+
+VM_LOG_ROOT = "logs"  # Where each user's captures are kept, as logs/<date>/<user id>/, relative to the server directory
+COMPRESSED_SUFFIX = ".gz"
+COMPRESS_WORKERS = ApplicationConfig.LOG_COMPRESS_WORKERS  # Files compressed at once, so compression can't starve QEMU of CPU or disk
+COMPRESS_LEVEL = 6
+RETENTION_DAYS = ApplicationConfig.LOG_RETENTION_DAYS  # Days captures are kept, 0 keeps them until a quota is reached
+USER_QUOTA = ApplicationConfig.LOG_USER_QUOTA * 1024 * 1024  # Bytes of captures kept per user, 0 for no limit
+TOTAL_QUOTA = ApplicationConfig.LOG_TOTAL_QUOTA * 1024 * 1024  # Bytes of captures kept in total, 0 for no limit
+QUIET_PERIOD = 600  # Seconds since a capture was last written before it may be closed
+
+# A capture on disk. day is the date directory it is in, which sorts oldest first.
+LogFile = namedtuple("LogFile", ["path", "day", "user_id", "size", "mtime"])
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def log_directory(user_id):
+    """Get today's log directory for a user, creating it if it doesn't exist
+
+    Args:
+        user_id (str): The id of the user
+
+    Returns:
+        str: The path of the directory
+    """
+
+    log_dir = f"{VM_LOG_ROOT}/{date.today()}/{user_id}"
+    os.makedirs(log_dir, exist_ok=True)
+    return log_dir
+
+
+def scan_logs():
+    """List every capture under the log directory
+
+    Returns:
+        list: The files, oldest day first
+    """
+
+    files = []
+    if not os.path.isdir(VM_LOG_ROOT):
+        return files
+
+    for day in sorted(os.listdir(VM_LOG_ROOT)):
+        day_dir = os.path.join(VM_LOG_ROOT, day)
+        if not os.path.isdir(day_dir):
+            continue
+        for user_id in os.listdir(day_dir):
+            user_dir = os.path.join(day_dir, user_id)
+            if not os.path.isdir(user_dir):
+                continue
+            with os.scandir(user_dir) as entries:
+                for entry in sorted(entries, key=lambda entry: entry.name):
+                    if entry.is_file(follow_symlinks=False):
+                        stat = entry.stat(follow_symlinks=False)
+                        files.append(LogFile(entry.path, day, user_id, stat.st_size, stat.st_mtime))
+    return files
+
+
+def open_log_files(files):
+    """Find the captures QEMU may still be writing, which must not be compressed or deleted. Each boot starts a new
+    capture and a user has one virtual machine at a time, so that is the newest capture of each user with a virtual
+    machine. Captures written to recently are included too, for virtual machines that are still booting.
+
+    Args:
+        files (list): The files, oldest first
+
+    Returns:
+        set: Their paths
+    """
+
+    running = {user_id for (user_id,) in db.session.query(VirtualMachines.user_id)}
+    db.session.commit()
+
+    newest = {}
+    in_use = set()
+    recent = time.time() - QUIET_PERIOD
+    for log_file in files:
+        if log_file.user_id in running:
+            newest[log_file.user_id] = log_file.path
+        if log_file.mtime > recent:
+            in_use.add(log_file.path)
+    return in_use | set(newest.values())
+
+
+def get_pool():
+    """Get the thread pool that compresses captures, creating it once per process so gunicorn workers each get their own
+
+    Returns:
+        ThreadPoolExecutor: The pool
+    """
+
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPoolExecutor(max_workers=COMPRESS_WORKERS, thread_name_prefix="log-compress")
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def compress_file(path):
+    """Compress a capture with gzip, keeping its modification time. The original is only removed once the
+    compressed copy is complete, so a crash leaves one or the other.
+
+    Args:
+        path (str): The path of the capture
+
+    Returns:
+        int: The bytes saved
+    """
+
+    stat = os.stat(path)
+    compressed = path + COMPRESSED_SUFFIX
+    partial = compressed + ".tmp"
+    try:
+        with open(path, "rb") as source, gzip.open(partial, "wb", compresslevel=COMPRESS_LEVEL) as target:
+            shutil.copyfileobj(source, target)
+        os.utime(partial, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        os.replace(partial, compressed)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    os.remove(path)
+    return stat.st_size - os.path.getsize(compressed)
+
+
+def compress_logs():
+    """Compress every capture QEMU has finished writing, COMPRESS_WORKERS at a time
+
+    Returns:
+        str: What was compressed
+    """
+
+    files = scan_logs()
+    in_use = open_log_files(files)
+    closed = [
+        log_file.path for log_file in files if not log_file.path.endswith((COMPRESSED_SUFFIX, ".tmp")) and log_file.path not in in_use
+    ]
+    if not closed:
+        return None
+
+    compressed, saved = 0, 0
+    for path, future in [(path, get_pool().submit(compress_file, path)) for path in closed]:
+        try:
+            saved += future.result()
+            compressed += 1
+        except OSError as e:
+            current_app.logger.warning("Failed to compress %s: %s", path, e)
+    return f"Compressed {compressed} captures, saving {saved // 1024} KiB"
+
+
+def over_quota(files, quota, reserved=0):
+    """Pick the oldest files to delete so the rest fit in a quota
+
+    Args:
+        files (list): The files that may be deleted, oldest first
+        quota (int): The bytes allowed, 0 for no limit
+        reserved (int): The bytes counted against the quota by files that can't be deleted
+
+    Returns:
+        list: The files to delete
+    """
+
+    excess = sum(log_file.size for log_file in files) + reserved - quota
+    if not quota or excess <= 0:
+        return []
+
+    chosen = []
+    for log_file in files:
+        if excess <= 0:
+            break
+        chosen.append(log_file)
+        excess -= log_file.size
+    return chosen
+
+
+def enforce_log_retention():
+    """Delete captures older than RETENTION_DAYS, then the oldest captures of each user over USER_QUOTA,
+    then the oldest captures overall until they fit in TOTAL_QUOTA. Captures QEMU is still writing are kept.
+
+    Returns:
+        str: What was deleted
+    """
+
+    files = scan_logs()
+    in_use = open_log_files(files)
+    kept = [log_file for log_file in files if log_file.path in in_use]
+    files = [log_file for log_file in files if log_file.path not in in_use]
+    doomed = set()
+
+    # Captures past their age
+    if RETENTION_DAYS:
+        cutoff = (date.today() - timedelta(days=RETENTION_DAYS)).isoformat()
+        doomed.update(log_file for log_file in files if log_file.day < cutoff)
+
+    # Each user's oldest captures beyond their quota
+    by_user = {}
+    for log_file in files:
+        if log_file not in doomed:
+            by_user.setdefault(log_file.user_id, []).append(log_file)
+    for user_id, user_files in by_user.items():
+        reserved = sum(log_file.size for log_file in kept if log_file.user_id == user_id)
+        doomed.update(over_quota(user_files, USER_QUOTA, reserved))
+
+    # Everyone's oldest captures beyond the total quota
+    reserved = sum(log_file.size for log_file in kept)
+    doomed.update(over_quota([log_file for log_file in files if log_file not in doomed], TOTAL_QUOTA, reserved))
+
+    deleted, freed = 0, 0
+    for log_file in doomed:
+        try:
+            os.remove(log_file.path)
+        except FileNotFoundError:
+            continue
+        deleted += 1
+        freed += log_file.size
+    return f"Deleted {deleted} captures, freeing {freed // 1024} KiB" if deleted else None
+
+
+def log_usage():
+    """Describe the disk used by captures, per day and in total, and the space left on the disk
+
+    Returns:
+        dict: The usage
+    """
+
+    days = {}
+    for log_file in scan_logs():
+        day = days.setdefault(log_file.day, {"date": log_file.day, "files": 0, "bytes": 0, "compressed_files": 0, "users": set()})
+        day["files"] += 1
+        day["bytes"] += log_file.size
+        day["compressed_files"] += log_file.path.endswith(COMPRESSED_SUFFIX)
+        day["users"].add(log_file.user_id)
+
+    for day in days.values():
+        day["users"] = len(day["users"])
+
+    disk = shutil.disk_usage(VM_LOG_ROOT if os.path.isdir(VM_LOG_ROOT) else ".")
+    return {
+        "days": list(days.values()),
+        "total_bytes": sum(day["bytes"] for day in days.values()),
+        "total_quota": TOTAL_QUOTA,
+        "user_quota": USER_QUOTA,
+        "retention_days": RETENTION_DAYS,
+        "disk_free": disk.free,
+        "disk_total": disk.total,
+    }
+
+
+LOG_JOBS = [
+    Job("compress_logs", compress_logs, interval=300, lease=1800),
+    Job("enforce_log_retention", enforce_log_retention, interval=900, lease=600),
+]
@@ -0,0 +1,66 @@
+# vm_loop.py - Runs one long-lived asyncio event loop per worker for starting virtual machines.
+# Copyright (C) 2024, Kieran Gordon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import os
+import threading
+
+import tracing
+
+_loop = None
+_loop_pid = None
+_loop_lock = threading.Lock()
+
+
+def get_loop():
+    """Get the worker's event loop, starting it in a daemon thread on first use.
+    Like the password pool, it is created in each gunicorn worker rather than in the master before forking.
+
+    Returns:
+        asyncio.AbstractEventLoop: The running event loop
+    """
+
+    global _loop, _loop_pid
+    with _loop_lock:
+        if _loop is None or _loop_pid != os.getpid():
+            _loop = asyncio.new_event_loop()
+            _loop_pid = os.getpid()
+            threading.Thread(target=_loop.run_forever, name="vm-loop", daemon=True).start()
+        return _loop
+
+
+def run(coro, timeout=None):
+    """Run a coroutine on the worker's event loop and wait for its result.
+    QMP sessions, child processes and sleeps from every request share the loop, so boots in other threads overlap.
+    The coroutine continues the caller's trace.
+
+    Args:
+        coro (coroutine): The coroutine to run
+        timeout (float): Seconds to wait for the result
+
+    Raises:
+        TimeoutError: If the coroutine did not finish in time, in which case it is cancelled
+
+    Returns:
+        The result of the coroutine
+    """
+
+    future = asyncio.run_coroutine_threadsafe(tracing.bind(coro), get_loop())
+    try:
+        return future.result(timeout)
+    except TimeoutError:
+        future.cancel()
+        raise